@@ -1,10 +1,39 @@
 from django.contrib import admin
+from apps.sales.models import ItemPurgeJob
 from .models import Item
 
 
 class ItemAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'price', 'created_at', 'updated_at')
+    list_display = ('id', 'name', 'price', 'units_sold', 'revenue',
+                    'last_saled_at', 'created_at', 'updated_at')
     list_display_links = ('id', 'name')
+    # 販売情報の果物欄（autocomplete_fields）の検索用
+    search_fields = ('name',)
+    ordering = ('-updated_at', '-id')
+
+    def get_queryset(self, request):
+        # 削除（論理削除）した果物は一覧・選択肢に出さない
+        return super().get_queryset(request).active()
+
+    def get_deleted_objects(self, objs, request):
+        """
+        削除の確認画面には果物だけを表示する
+        関連する販売情報は削除ジョブが少しずつ削除するため、集めて表示しない
+        """
+        deleted_objects = [str(obj) for obj in objs]
+        model_count = {self.model._meta.verbose_name_plural:
+                       len(deleted_objects)}
+        perms_needed = set()
+        if not self.has_delete_permission(request):
+            perms_needed.add(self.model._meta.verbose_name)
+        return deleted_objects, model_count, perms_needed, []
+
+    def delete_model(self, request, obj):
+        ItemPurgeJob.enqueue(obj, request.user)
+
+    def delete_queryset(self, request, queryset):
+        for item in queryset:
+            ItemPurgeJob.enqueue(item, request.user)
 
 
 admin.site.register(Item, ItemAdmin)
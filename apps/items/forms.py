@@ -1,8 +1,58 @@
-from django.forms import ModelForm
+from django.core.exceptions import ValidationError
+from django.forms import ModelForm, ModelChoiceField
+from django.forms.models import ModelChoiceIterator
 from .models import Item
 
 
+class CachedItemChoiceIterator(ModelChoiceIterator):
+    # 選択肢をDBではなく果物マスタのキャッシュから作る
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for item in Item.get_catalogue().items:
+            yield self.choice(item)
+
+    def __len__(self):
+        return (len(Item.get_catalogue().items) +
+                (1 if self.field.empty_label is not None else 0))
+
+
+class ItemChoiceField(ModelChoiceField):
+    """
+    果物の選択欄。選択肢の表示・入力値の検証に果物マスタのキャッシュを使う
+    """
+    iterator = CachedItemChoiceIterator
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('queryset', Item.objects.all())
+        super().__init__(**kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            item = Item.get_cached_or_none(int(value))
+        except (ValueError, TypeError):
+            item = None
+        if item is None:
+            raise ValidationError(self.error_messages['invalid_choice'],
+                                  code='invalid_choice')
+        return item
+
+
 class ItemForm(ModelForm):
     class Meta:
         model = Item
         fields = ['name', 'price']
+
+    def clean_name(self):
+        # 名称の一意制約は条件付きのため、ModelForm の検証では確認されない
+        name = self.cleaned_data['name']
+        items = Item.objects.active().filter(name=name)
+        if self.instance.pk is not None:
+            items = items.exclude(pk=self.instance.pk)
+        if items.exists():
+            raise ValidationError(
+                "果物「{}」は登録されています".format(name), code='unique')
+        return name
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.4 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(
+                fields=['updated_at', 'id'], name='items_item_updated_at_id_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:10
+
+from django.db import migrations, models
+from django.db.models import Sum, Max
+
+
+def fill_counters(apps, schema_editor):
+    # 累計個数・売上は月別集計（アーカイブ済みの年を含む）から、
+    # 最終販売日時は稼働中のDBの販売情報から求める
+    # （アーカイブDBだけに販売情報のある果物は manage.py reconcile_item_counters）
+    Item = apps.get_model('items', 'Item')
+    MonthlySaleRollup = apps.get_model('sales', 'MonthlySaleRollup')
+    Sale = apps.get_model('sales', 'Sale')
+
+    totals = (MonthlySaleRollup.objects.order_by().values('item_id')
+              .annotate(units=Sum('item_num'), revenue=Sum('amount')))
+    for row in totals:
+        Item.objects.filter(id=row['item_id']).update(
+            units_sold=row['units'], revenue=row['revenue'])
+    latest = (Sale.objects.order_by().values('item_id')
+              .annotate(latest=Max('saled_at')))
+    for row in latest:
+        Item.objects.filter(id=row['item_id']).update(
+            last_saled_at=row['latest'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0002_keyset_pagination_indexes'),
+        ('sales', '0016_importjob_file_blank'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='last_saled_at',
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name='最終販売日時'),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='revenue',
+            field=models.BigIntegerField(
+                default=0, editable=False, verbose_name='累計売上'),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='units_sold',
+            field=models.BigIntegerField(
+                default=0, editable=False, verbose_name='累計販売個数'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(
+                fields=['units_sold', 'id'], name='items_item_units_sold_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(
+                fields=['revenue', 'id'], name='items_item_revenue_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(
+                fields=['last_saled_at', 'id'], name='items_item_last_saled_id_idx'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0003_item_sale_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='deleted_at',
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name='削除日時'),
+        ),
+    ]
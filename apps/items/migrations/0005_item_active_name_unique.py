@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0004_item_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='item',
+            name='name',
+            field=models.CharField(max_length=190, verbose_name='名称'),
+        ),
+        migrations.AddConstraint(
+            model_name='item',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(deleted_at__isnull=True),
+                fields=('name',), name='items_item_active_name_uniq'),
+        ),
+    ]
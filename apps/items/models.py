@@ -1,31 +1,212 @@
-from django.db import models
+import threading
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.shortcuts import get_object_or_404
+from django.utils.timezone import now
+
+CATALOGUE_VERSION_KEY = 'items:catalogue:version'
+
+
+def catalogue_cache():
+    return caches[getattr(settings, 'ITEM_CATALOGUE_CACHE', 'default')]
+
+
+class ItemCatalogue:
+    """
+    果物マスタのプロセス内キャッシュ（名称・IDから果物を引く）
+    果物の登録・更新・削除時に、プロセス間で共有するキャッシュ上の
+    バージョンを更新し、各プロセスは次に参照したときに読み直す
+    保持している Item インスタンスは共有されるため、変更しないこと
+    """
+    _lock = threading.Lock()
+    _current = None
+
+    def __init__(self, version, items):
+        self.version = version
+        self.items = items
+        self.by_id = {item.id: item for item in items}
+        self.by_name = {item.name: item for item in items}
+
+    @staticmethod
+    def current_version():
+        cache = catalogue_cache()
+        version = cache.get(CATALOGUE_VERSION_KEY)
+        if version is None:
+            cache.add(CATALOGUE_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(CATALOGUE_VERSION_KEY)
+        return version
+
+    @classmethod
+    def get(cls):
+        version = cls.current_version()
+        catalogue = cls._current
+        if catalogue is not None and catalogue.version == version:
+            return catalogue
+        with cls._lock:
+            if cls._current is None or cls._current.version != version:
+                # 読み込み中に更新された場合は、次回のバージョン確認で読み直す
+                cls._current = cls(version, list(
+                    Item.objects.active().order_by('id')))
+            return cls._current
+
+    @staticmethod
+    def bump_version():
+        catalogue_cache().set(
+            CATALOGUE_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+    @classmethod
+    def invalidate(cls):
+        # 同じトランザクション内の参照のため直ちに、
+        # コミット前に読み直したプロセスのためコミット後にも更新する
+        cls.bump_version()
+        transaction.on_commit(cls.bump_version)
+
+
+class ItemQuerySet(models.QuerySet):
+
+    def active(self):
+        # 削除（論理削除）されていない果物
+        return self.filter(deleted_at__isnull=True)
+
+    def update(self, **kwargs):
+        ItemCatalogue.invalidate()
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def delete(self):
+        ItemCatalogue.invalidate()
+        return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
 
 
 class Item(models.Model):
-    name = models.CharField("名称", max_length=190, unique=True)
+    # 名称は削除していない果物の間で一意（削除中の果物と同じ名称で登録できる）
+    name = models.CharField("名称", max_length=190)
     price = models.PositiveIntegerField("単価")
     created_at = models.DateTimeField("登録日時", auto_now_add=True)
     updated_at = models.DateTimeField("更新日時", auto_now=True)
+    # 販売実績（累計）。販売情報の登録・更新・削除時に add_sales で更新する
+    units_sold = models.BigIntegerField("累計販売個数", default=0, editable=False)
+    revenue = models.BigIntegerField("累計売上", default=0, editable=False)
+    last_saled_at = models.DateTimeField(
+        "最終販売日時", null=True, blank=True, editable=False)
+    # 削除した日時。販売情報をバックグラウンドで削除し終えるまで行を残す
+    deleted_at = models.DateTimeField(
+        "削除日時", null=True, blank=True, editable=False)
+
+    objects = ItemQuerySet.as_manager()
+
+    # 販売実績の列（果物の編集では保存しない）
+    COUNTER_FIELDS = ('units_sold', 'revenue', 'last_saled_at')
+
+    class Meta:
+        indexes = [
+            # 一覧のカーソル方式ページネーション用
+            models.Index(fields=['updated_at', 'id'],
+                         name='items_item_updated_at_id_idx'),
+            # 一覧の販売実績順の並べ替え用
+            models.Index(fields=['units_sold', 'id'],
+                         name='items_item_units_sold_id_idx'),
+            models.Index(fields=['revenue', 'id'],
+                         name='items_item_revenue_id_idx'),
+            models.Index(fields=['last_saled_at', 'id'],
+                         name='items_item_last_saled_id_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name'], condition=Q(deleted_at__isnull=True),
+                name='items_item_active_name_uniq'),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # 販売実績は add_sales で直接更新するため、読み込み時の古い値で上書きしない
+        if (not self._state.adding and kwargs.get('update_fields') is None
+                and not kwargs.get('force_insert')):
+            kwargs['update_fields'] = [
+                field.attname for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.COUNTER_FIELDS]
+        super().save(*args, **kwargs)
+        ItemCatalogue.invalidate()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        ItemCatalogue.invalidate()
+        return result
+
+    @classmethod
+    def add_sales(cls, item_id, units, revenue, saled_at=None):
+        """
+        販売実績に増減を加える（F式のUPDATEなので同時に更新しても失われない）
+        saled_at を指定すると、最終販売日時より新しければ置き換える
+        果物マスタのキャッシュには含めないため、キャッシュは更新しない
+        """
+        values = {
+            'units_sold': F('units_sold') + units,
+            'revenue': F('revenue') + revenue,
+        }
+        if saled_at is not None:
+            saled_at = Value(saled_at, output_field=models.DateTimeField())
+            values['last_saled_at'] = Greatest(
+                Coalesce('last_saled_at', saled_at), saled_at)
+        return models.QuerySet.update(cls.objects.filter(id=item_id), **values)
+
+    @classmethod
+    def set_last_saled_at(cls, item_id, saled_at):
+        return models.QuerySet.update(
+            cls.objects.filter(id=item_id), last_saled_at=saled_at)
+
+    @staticmethod
+    def get_catalogue():
+        return ItemCatalogue.get()
+
+    @classmethod
+    def get_cached_or_none(cls, id):
+        # 果物マスタのキャッシュからIDで取得する
+        return cls.get_catalogue().by_id.get(id)
+
+    @classmethod
+    def attach_to(cls, objects, field='item'):
+        # objects の外部キー field に、キャッシュ済みの果物を設定する
+        by_id = cls.get_catalogue().by_id
+        for obj in objects:
+            item = by_id.get(getattr(obj, field + '_id'))
+            if item is not None:
+                setattr(obj, field, item)
+        return objects
+
+    @property
+    def is_deleted(self):
+        return self.deleted_at is not None
+
     @classmethod
     def get_all_objects(cls):
-        return cls.objects.all().order_by('-updated_at')
+        return cls.objects.active().order_by('-updated_at')
 
     @classmethod
     def get_by_id_or_404(cls, id):
-        return get_object_or_404(cls, id=id)
+        return get_object_or_404(cls.objects.active(), id=id)
 
     @classmethod
     def get_by_name_or_none(cls, name):
-        try:
-            return cls.objects.get(name=name)
-        except cls.DoesNotExist:
-            return None
+        return cls.get_catalogue().by_name.get(name)
 
     @classmethod
     def delete_by_id(cls, id):
-        cls.objects.get(id=id).delete()
+        """
+        果物を論理削除する（一覧・選択肢・果物マスタのキャッシュから外す）
+        販売情報の削除と行の削除は ItemPurgeJob（apps.sales）で行う
+        """
+        deleted = cls.objects.active().filter(id=id).update(deleted_at=now())
+        if not deleted:
+            raise cls.DoesNotExist()
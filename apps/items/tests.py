@@ -1,3 +1,94 @@
+import datetime
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
 from django.test import TestCase
+from django.urls import reverse
+from django.utils.timezone import make_aware
+from .forms import ItemForm
+from .models import Item
 
-# Create your tests here.
+
+class ItemCatalogueTests(TestCase):
+
+    def test_reflects_changes(self):
+        item = Item.objects.create(name="りんご", price=100)
+        self.assertEqual(Item.get_by_name_or_none("りんご"), item)
+
+        item.price = 120
+        item.save()
+        self.assertEqual(Item.get_cached_or_none(item.id).price, 120)
+
+        Item.objects.filter(id=item.id).update(name="ふじ")
+        self.assertIsNone(Item.get_by_name_or_none("りんご"))
+        self.assertEqual(Item.get_by_name_or_none("ふじ").id, item.id)
+
+        Item.objects.filter(id=item.id).delete()
+        self.assertIsNone(Item.get_cached_or_none(item.id))
+
+    def test_reuses_loaded_catalogue(self):
+        Item.objects.create(name="バナナ", price=50)
+        Item.get_catalogue()
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(Item.get_by_name_or_none("バナナ"))
+
+
+class ItemIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('staff', password='pw')
+        cls.apple = Item.objects.create(name="りんご", price=100)
+        cls.banana = Item.objects.create(name="バナナ", price=50)
+        Item.objects.create(name="みかん", price=30)
+        Item.add_sales(cls.apple.id, 1, 100,
+                       make_aware(datetime.datetime(2018, 12, 2, 10, 0)))
+        Item.add_sales(cls.banana.id, 3, 150,
+                       make_aware(datetime.datetime(2018, 12, 1, 10, 0)))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_sort_by_sales(self):
+        url = reverse('items:index')
+        response = self.client.get(url, {'sort': 'units_sold'})
+        self.assertEqual([item.name for item in response.context['items']],
+                         ["バナナ", "りんご", "みかん"])
+        # 販売実績の無い果物は最終販売日時の並べ替えでは最後に並ぶ
+        response = self.client.get(url, {'sort': 'last_saled_at'})
+        self.assertEqual([item.name for item in response.context['items']],
+                         ["りんご", "バナナ", "みかん"])
+        self.assertEqual(response.context['items_count'], 3)
+        response = self.client.get(url, {'sort': 'price'})
+        self.assertEqual(response.context['sort'], 'updated_at')
+
+
+class ItemNameTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('staff', password='pw')
+        cls.item = Item.objects.create(name="りんご", price=100)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def register(self, name, price):
+        response = self.client.post(reverse('items:register'),
+                                    {'name': name, 'price': price},
+                                    follow=True)
+        return [str(message) for message in response.context['messages']]
+
+    def test_name_is_reusable_after_soft_delete(self):
+        self.assertEqual(self.register("りんご", 120),
+                         ["登録に失敗しました。", "果物「りんご」は登録されています"])
+        # 名称を変えずに編集できる
+        form = ItemForm({'name': "りんご", 'price': 110}, instance=self.item)
+        self.assertTrue(form.is_valid())
+
+        # 削除中（販売情報の削除を待っている）の果物と同じ名称で登録できる
+        Item.delete_by_id(self.item.id)
+        self.assertEqual(self.register("りんご", 120), ["登録が完了しました。"])
+        self.assertEqual(Item.get_by_name_or_none("りんご").price, 120)
+        self.assertEqual(Item.objects.filter(name="りんご").count(), 2)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Item.objects.create(name="りんご", price=130)
@@ -1,20 +1,38 @@
+from collections import OrderedDict
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
 from django.contrib import messages
-from django.core.paginator import Paginator
+from fruitshopadmin.pagination import KeysetPaginator
+from apps.sales.models import ItemPurgeJob
 from .models import Item
 from .forms import ItemForm
 
 
+# 一覧の並べ替え（?sort=）=> 列（いずれもインデックスあり、降順）
+SORT_FIELDS = OrderedDict((
+    ('updated_at', "更新日時"),
+    ('units_sold', "累計販売個数"),
+    ('revenue', "累計売上"),
+    ('last_saled_at', "最終販売日時"),
+))
+
+
 @login_required
 def index(request):
-    items = Item.get_all_objects()
-    paginator = Paginator(items, 10)
-    page = request.GET.get('page')
-    items = paginator.get_page(page)
+    sort = request.GET.get('sort')
+    if sort not in SORT_FIELDS:
+        sort = 'updated_at'
+    # 販売実績の無い果物（最終販売日時がNULL）は、最終販売日時の並べ替えでは最後に並ぶ
+    paginator = KeysetPaginator(Item.get_all_objects(), sort, 10)
+    cursor = request.GET.get('cursor')
+    items = paginator.get_page(cursor)
     return render(request, 'items/index.html', {
         'items': items,
+        'items_count': paginator.cached_count('items:index:count'),
+        'sort': sort,
+        'sort_fields': SORT_FIELDS,
+        'purge_jobs': ItemPurgeJob.get_unfinished(),
     })
 
 
@@ -27,6 +45,9 @@ def register(request):
             messages.success(request, "登録が完了しました。")
         else:
             messages.error(request, "登録に失敗しました。")
+            # 名称の誤り（登録済みなど）は理由も表示する
+            for error in form.errors.get('name', []):
+                messages.error(request, error)
         return redirect('items:index')
     form = ItemForm
     return render(request, 'items/register.html', {
@@ -44,6 +65,9 @@ def edit(request, id):
             messages.success(request, "更新しました。")
         else:
             messages.error(request, "更新に失敗しました。")
+            # 名称の誤り（登録済みなど）は理由も表示する
+            for error in form.errors.get('name', []):
+                messages.error(request, error)
         return redirect('items:index')
     else:
         form = ItemForm(instance=item)
@@ -56,5 +80,8 @@ def edit(request, id):
 @login_required
 @require_POST
 def delete(request, id):
-    Item.delete_by_id(id)
-    return redirect('items:index')
+    # 一覧からはすぐに外し、販売情報はバックグラウンドで削除する
+    item = Item.get_by_id_or_404(id)
+    job = ItemPurgeJob.enqueue(item, request.user)
+    messages.success(request, "削除しました。販売情報は順に削除します。")
+    return redirect('sales:item_purge_job', id=job.pk)
@@ -1,10 +1,140 @@
-from django.contrib import admin
-from .models import Sale
+from dateutil.relativedelta import relativedelta
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.db.models import Min, Max
+from django.template.response import TemplateResponse
+from django.utils.timezone import localdate
+from fruitshopadmin.pagination import EstimatedCountPaginator
+from apps.items.models import Item
+from .bulk import BulkDelete
+from .models import Sale, SaleQuerySet, start_of_day
+
+# date_hierarchy の単位 => (期間の初日, 次の期間までの差)
+DATE_HIERARCHY_KINDS = {
+    'year': (lambda date: date.replace(month=1, day=1),
+             relativedelta(years=1)),
+    'month': (lambda date: date.replace(day=1), relativedelta(months=1)),
+    'day': (lambda date: date, relativedelta(days=1)),
+}
+
+
+class SaleAdminQuerySet(SaleQuerySet):
+    """
+    管理画面の一覧用。date_hierarchy が使う dates() を、
+    全件の DISTINCT ではなく、期間ごとの存在確認（インデックスの範囲検索）で求める
+    """
+
+    def aggregate(self, *args, **kwargs):
+        # date_hierarchy の最初と最後の日時は、最小・最大を別々の文で求める
+        # （SQLiteは1文に MIN と MAX があるとインデックスの端を読む最適化をしない）
+        if (not args and set(kwargs) == {'first', 'last'} and
+                isinstance(kwargs['first'], Min) and
+                isinstance(kwargs['last'], Max) and
+                kwargs['first'].source_expressions ==
+                kwargs['last'].source_expressions):
+            field_name = kwargs['first'].source_expressions[0].name
+            return self.bounds(field_name)
+        return super().aggregate(*args, **kwargs)
+
+    def bounds(self, field_name):
+        # {'first': 最小値, 'last': 最大値}（それぞれインデックスの端を1行読む）
+        values = self.order_by().values_list(field_name, flat=True)
+        return {
+            'first': values.order_by(field_name).first(),
+            'last': values.order_by('-' + field_name).first(),
+        }
+
+    def dates(self, field_name, kind, order='ASC'):
+        bounds = self.bounds(field_name)
+        if bounds['first'] is None:
+            return []
+        start_of, step = DATE_HIERARCHY_KINDS[kind]
+        date = start_of(localdate(bounds['first']))
+        last = localdate(bounds['last'])
+        dates = []
+        while date <= last:
+            following = date + step
+            if self.filter(**{
+                field_name + '__gte': start_of_day(date),
+                field_name + '__lt': start_of_day(following),
+            }).exists():
+                dates.append(date)
+            date = following
+        return dates if order == 'ASC' else dates[::-1]
+
+
+class ItemListFilter(admin.SimpleListFilter):
+    # 選択肢は果物マスタのキャッシュから作る（item_id のインデックスで絞り込む）
+    title = "果物"
+    parameter_name = 'item'
+
+    def lookups(self, request, model_admin):
+        return [(str(item.id), item.name)
+                for item in Item.get_catalogue().items]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        try:
+            return queryset.filter(item_id=int(self.value()))
+        except ValueError:
+            return queryset.none()
 
 
 class SaleAdmin(admin.ModelAdmin):
     list_display = ('id', 'item', 'item_num', 'amount', 'saled_at')
     list_display_links = ('id', 'item')
+    list_select_related = ('item',)
+    list_filter = (ItemListFilter,)
+    # (saled_at, id)・(item, saled_at) のインデックスの順に並べる
+    ordering = ('-saled_at', '-id')
+    sortable_by = ('id', 'saled_at')
+    date_hierarchy = 'saled_at'
+    autocomplete_fields = ('item',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['delete_sales']
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return SaleAdminQuerySet(model=queryset.model,
+                                 query=queryset.query.chain(),
+                                 using=queryset._db)
+
+    def get_actions(self, request):
+        # 1件ずつ読み込んで削除する標準の「削除」は使わない
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def delete_sales(self, request, queryset):
+        """
+        選択した（または絞り込んだ全件の）販売情報を BulkDelete で削除する
+        ID順にチャンクごとのDELETE文で削除し、集計テーブルも更新する
+        """
+        operation = BulkDelete(queryset.order_by())
+        if request.POST.get('post'):
+            result = operation.run()
+            self.message_user(
+                request,
+                "{}件の販売情報を削除しました（{:.1f}秒）".format(
+                    result.affected, result.elapsed),
+                messages.SUCCESS)
+            return None
+        return TemplateResponse(
+            request, 'admin/sales/sale/delete_sales_confirmation.html', {
+                **self.admin_site.each_context(request),
+                'title': "販売情報の一括削除",
+                'opts': self.model._meta,
+                'count': operation.count(),
+                'selected': request.POST.getlist(
+                    helpers.ACTION_CHECKBOX_NAME),
+                'select_across': request.POST.get('select_across') == '1',
+                'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+            })
+
+    delete_sales.allowed_permissions = ('delete',)
+    delete_sales.short_description = "選択した販売情報を一括削除"
 
 
 admin.site.register(Sale, SaleAdmin)
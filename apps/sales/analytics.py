@@ -0,0 +1,312 @@
+"""
+販売情報の列指向スナップショットによる集計（アドホック分析用）
+
+販売情報を果物ID・販売日時・売上・個数の配列として保持し、
+期間・果物単位の集計をNumPyのベクトル演算で行う。
+ファイルへ保存したスナップショットはメモリマップで開けるため、
+複数のワーカーでDBを読み直さずに共有できる。
+"""
+import datetime
+import json
+import os
+import numpy as np
+from django.utils.timezone import get_current_timezone
+from .models import Sale
+
+# 一度にDBから読み込む件数
+LOAD_CHUNK_SIZE = 100000
+
+GRANULARITIES = ('hour', 'day', 'week', 'month', 'hour_of_day', 'weekday')
+
+SECONDS_PER_HOUR = 60 * 60
+SECONDS_PER_DAY = 24 * SECONDS_PER_HOUR
+
+
+def to_epoch(dt):
+    return int(dt.timestamp())
+
+
+def local_seconds(epoch_seconds):
+    """
+    UNIX時刻（秒）の配列を、現在のタイムゾーンの壁時計時刻（秒）に変換する
+    UTCオフセットは時間単位で変わるため、ユニークな時間ごとに1回だけ求める
+    """
+    if not len(epoch_seconds):
+        return epoch_seconds.astype(np.int64)
+    tz = get_current_timezone()
+    hours, inverse = np.unique(epoch_seconds // SECONDS_PER_HOUR,
+                               return_inverse=True)
+    offsets = np.array([
+        datetime.datetime.fromtimestamp(
+            int(hour) * SECONDS_PER_HOUR, tz).utcoffset().total_seconds()
+        for hour in hours
+    ], dtype=np.int64)
+    return epoch_seconds + offsets[inverse.reshape(-1)]
+
+
+def period_codes(granularity, local_at):
+    # 壁時計時刻（秒）を期間コードに変換する
+    days = local_at // SECONDS_PER_DAY
+    if granularity == 'hour':
+        return local_at // SECONDS_PER_HOUR
+    if granularity == 'day':
+        return days
+    if granularity == 'week':
+        # 1970-01-01は木曜日。ISO週の月曜日の日数を週のコードにする
+        return days - (days + 3) % 7
+    if granularity == 'month':
+        return (days.astype('datetime64[D]')
+                    .astype('datetime64[M]')
+                    .astype(np.int64))
+    if granularity == 'hour_of_day':
+        return local_at % SECONDS_PER_DAY // SECONDS_PER_HOUR
+    if granularity == 'weekday':
+        # 0: 月曜日 〜 6: 日曜日
+        return (days + 3) % 7
+    raise ValueError("unknown granularity: {}".format(granularity))
+
+
+def period_values(granularity, codes):
+    # 期間コードを表示用の値（datetime64 または整数）に変換する
+    if granularity == 'hour':
+        return codes.astype('datetime64[h]')
+    if granularity in ('day', 'week'):
+        return codes.astype('datetime64[D]')
+    if granularity == 'month':
+        return codes.astype('datetime64[M]')
+    return codes
+
+
+class SalesSnapshot:
+    """
+    販売情報の列指向スナップショット
+
+    item_ids  : int32  果物ID
+    saled_at  : int64  販売日時（UNIX時刻・秒）
+    local_at  : int64  販売日時（現在のタイムゾーンの壁時計時刻・秒）
+    amounts   : uint32 売上
+    item_nums : uint32 個数
+    """
+    COLUMNS = (
+        ('item_ids', np.int32),
+        ('saled_at', np.int64),
+        ('local_at', np.int64),
+        ('amounts', np.uint32),
+        ('item_nums', np.uint32),
+    )
+    VALUES = {'amount': 'amounts', 'item_num': 'item_nums'}
+
+    def __init__(self, columns=None, last_id=0):
+        if columns is None:
+            columns = {name: np.empty(0, dtype=dtype)
+                       for name, dtype in self.COLUMNS}
+        self.columns = columns
+        # 取り込み済みの販売情報IDの最大値（差分取り込み用）
+        self.last_id = last_id
+        # 期間コード・float64に変換した値などの派生列（再利用する）
+        self._derived = {}
+
+    def __len__(self):
+        return len(self.columns['saled_at'])
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def _derive(self, key, compute):
+        if key not in self._derived:
+            self._derived[key] = compute()
+        return self._derived[key]
+
+    def codes(self, granularity):
+        # (最小値からの相対的な期間コード, 最小値)
+        def compute():
+            codes = period_codes(granularity, self.local_at)
+            offset = int(codes.min()) if len(codes) else 0
+            return codes - offset, offset
+        return self._derive(('codes', granularity), compute)
+
+    def weights(self, value):
+        # np.bincount の重みはfloat64に変換されるため、変換結果を再利用する
+        return self._derive(('weights', value),
+                            lambda: self.columns[self.VALUES[value]]
+                                        .astype(np.float64))
+
+    @property
+    def is_sorted(self):
+        # 販売日時順に並んでいれば、期間の絞り込みを二分探索で行える
+        return self._derive('sorted', lambda: bool(
+            np.all(self.saled_at[1:] >= self.saled_at[:-1])))
+
+    @classmethod
+    def from_queryset(cls, queryset=None, chunk_size=LOAD_CHUNK_SIZE):
+        snapshot = cls()
+        snapshot.refresh(queryset, chunk_size)
+        return snapshot
+
+    def refresh(self, queryset=None, chunk_size=LOAD_CHUNK_SIZE):
+        """
+        last_id より後に登録された販売情報を追加し、追加件数を返す
+        （販売情報の更新・削除は反映されないため、必要に応じて作り直す）
+        """
+        if queryset is None:
+            queryset = Sale.objects.all()
+        rows = (queryset.filter(id__gt=self.last_id)
+                        .order_by('id')
+                        .values_list('id', 'item_id', 'saled_at',
+                                     'amount', 'item_num')
+                        .iterator(chunk_size=chunk_size))
+        chunks = []
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                chunks.append(self._to_columns(chunk))
+                chunk = []
+        if chunk:
+            chunks.append(self._to_columns(chunk))
+        if not chunks:
+            return 0
+
+        added = sum(len(columns['saled_at']) for columns in chunks)
+        self.columns = {
+            name: np.concatenate(
+                [self.columns[name]] + [columns[name] for columns in chunks])
+            for name, _ in self.COLUMNS
+        }
+        self.last_id = int(chunks[-1].pop('last_id'))
+        self._derived = {}
+        return added
+
+    def _to_columns(self, rows):
+        ids, item_ids, saled_at, amounts, item_nums = zip(*rows)
+        epoch = np.fromiter((to_epoch(dt) for dt in saled_at),
+                            dtype=np.int64, count=len(rows))
+        return {
+            'last_id': ids[-1],
+            'item_ids': np.array(item_ids, dtype=np.int32),
+            'saled_at': epoch,
+            'local_at': local_seconds(epoch),
+            'amounts': np.array(amounts, dtype=np.uint32),
+            'item_nums': np.array(item_nums, dtype=np.uint32),
+        }
+
+    def save(self, path):
+        # path のディレクトリに列ごとの .npy ファイルとメタ情報を保存する
+        os.makedirs(path, exist_ok=True)
+        for name, _ in self.COLUMNS:
+            np.save(os.path.join(path, name + '.npy'), self.columns[name])
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'last_id': self.last_id,
+                'rows': len(self),
+                'timezone': str(get_current_timezone()),
+            }, f)
+
+    @classmethod
+    def open(cls, path, mmap=True):
+        """
+        保存したスナップショットを（既定ではメモリマップで）開く
+        保存時と現在のタイムゾーンが異なる場合は、壁時計時刻を求め直す
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        columns = {
+            name: np.load(os.path.join(path, name + '.npy'),
+                          mmap_mode='r' if mmap else None)
+            for name, _ in cls.COLUMNS
+        }
+        if meta.get('timezone') != str(get_current_timezone()):
+            columns['local_at'] = local_seconds(
+                np.asarray(columns['saled_at']))
+        return cls(columns, last_id=meta['last_id'])
+
+    def _selection(self, start=None, end=None, item_ids=None):
+        """
+        [start, end) と果物IDで絞り込む
+        販売日時順に並んでいる場合は、コピーの発生しないスライスを返す
+        """
+        if self.is_sorted:
+            lo = 0 if start is None else int(np.searchsorted(
+                self.saled_at, to_epoch(start), side='left'))
+            hi = len(self) if end is None else int(np.searchsorted(
+                self.saled_at, to_epoch(end), side='left'))
+            selection = slice(lo, hi)
+            if item_ids is None:
+                return selection
+            mask = np.zeros(len(self), dtype=bool)
+            mask[selection] = np.isin(self.item_ids[selection],
+                                      list(item_ids))
+            return mask
+
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.saled_at >= to_epoch(start)
+        if end is not None:
+            mask &= self.saled_at < to_epoch(end)
+        if item_ids is not None:
+            mask &= np.isin(self.item_ids, list(item_ids))
+        return mask
+
+    def group_by(self, granularity, value='amount', by_item=True,
+                 start=None, end=None, item_ids=None):
+        """
+        期間（と果物）ごとの合計を返す
+        => (期間の配列, 果物IDの配列（by_item=Falseのときはなし）, 合計の配列)
+        販売情報が1件も無い組み合わせは含まない
+        """
+        selection = self._selection(start, end, item_ids)
+        codes, offset = self.codes(granularity)
+        codes = codes[selection]
+        items = self.item_ids[selection]
+        values = self.weights(value)[selection]
+        if not len(codes):
+            empty = np.empty(0, dtype=np.int64)
+            return (period_values(granularity, empty),
+                    empty if by_item else None, empty)
+
+        # np.bincount の長さが絞り込んだ範囲の期間数・果物数で済むよう、
+        # 期間は絞り込んだ中の最小値から、果物は出現したものだけで番号を振り直す
+        first = int(codes.min())
+        codes = codes - first
+        offset += first
+        if by_item:
+            item_values, item_index = np.unique(items, return_inverse=True)
+            slots = len(item_values)
+            keys = codes * slots + item_index.reshape(-1)
+        else:
+            slots = 1
+            keys = codes
+        counts = np.bincount(keys)
+        sums = np.bincount(keys, weights=values, minlength=len(counts))
+        present = np.flatnonzero(counts)
+        totals = np.rint(sums[present]).astype(np.int64)
+        periods = period_values(granularity, present // slots + offset)
+        if by_item:
+            return (periods, item_values[present % slots].astype(np.int32),
+                    totals)
+        return periods, None, totals
+
+    def top_items(self, n=10, value='amount', start=None, end=None):
+        # 合計の多い順に上位n件の (果物ID, 合計) を返す
+        selection = self._selection(start, end)
+        items = self.item_ids[selection]
+        values = self.weights(value)[selection]
+        if not len(items):
+            return []
+        item_values, item_index = np.unique(items, return_inverse=True)
+        sums = np.rint(np.bincount(item_index.reshape(-1), weights=values,
+                                   minlength=len(item_values))
+                       ).astype(np.int64)
+        order = np.argsort(-sums, kind='stable')[:n]
+        return [(int(item_values[i]), int(sums[i])) for i in order]
+
+    def running_total(self, granularity, value='amount', start=None,
+                      end=None, item_ids=None):
+        # 期間ごとの累計 => (期間の配列, 累計の配列)
+        periods, _, totals = self.group_by(
+            granularity, value, by_item=False, start=start, end=end,
+            item_ids=item_ids)
+        return periods, np.cumsum(totals)
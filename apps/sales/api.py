@@ -0,0 +1,177 @@
+"""
+販売情報・期間別売上情報のJSON API（読み取り専用）
+
+レスポンスのETagは販売情報・果物マスタのデータバージョンから作るため、
+データが変わっていなければDBを読まずに 304 Not Modified を返す。
+"""
+import hashlib
+import re
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
+from django.utils.timezone import localdate, localtime
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition, require_GET
+from fruitshopadmin.pagination import KeysetPaginator
+from apps.items.models import Item, ItemCatalogue
+from .forms import SaleFilterForm, StatisticsForm
+from .models import Sale, HourlySaleRollup, MonthlySaleRollup
+from . import report_cache
+
+# 公開するフィールド => values() に渡すフィールド（Noneは果物マスタから引く）
+SALE_FIELDS = {
+    'id': 'id',
+    'item': 'item_id',
+    'item_name': None,
+    'item_num': 'item_num',
+    'amount': 'amount',
+    'saled_at': 'saled_at',
+}
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+DEFAULT_SPAN = 3
+
+_ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+
+def data_etag(request):
+    """
+    データバージョン・クエリ・日付（直近の期間が変わるため。時間単位の集計は
+    時刻の時まで）・圧縮の有無から強いETagを作る
+    """
+    accepts_gzip = bool(_ACCEPTS_GZIP.search(
+        request.META.get('HTTP_ACCEPT_ENCODING', '')))
+    if request.GET.get('granularity') == 'hourly':
+        period = localtime().strftime('%Y-%m-%dT%H')
+    else:
+        period = localdate().isoformat()
+    key = '|'.join([
+        report_cache.data_version(),
+        ItemCatalogue.current_version(),
+        request.get_full_path(),
+        period,
+        'gzip' if accepts_gzip else 'identity',
+    ])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def bad_request(errors):
+    return JsonResponse({'errors': errors}, status=400)
+
+
+def parse_int(value, default, maximum):
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    if not 1 <= value <= maximum:
+        return None
+    return value
+
+
+def parse_fields(value):
+    if not value:
+        return list(SALE_FIELDS)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    if not fields or any(field not in SALE_FIELDS for field in fields):
+        return None
+    return fields
+
+
+@login_required
+@require_GET
+@condition(etag_func=data_etag)
+@gzip_page
+def sales(request):
+    """
+    販売情報の一覧（販売日時の新しい順）
+    ?fields=id,item,item_name,item_num,amount,saled_at
+    &start_date=YYYY-MM-DD&end_date=YYYY-MM-DD&item=<果物ID>
+    &limit=<件数>&cursor=<next/previousの値>
+    """
+    form = SaleFilterForm(request.GET)
+    if not form.is_valid():
+        return bad_request(form.errors)
+    fields = parse_fields(request.GET.get('fields'))
+    if fields is None:
+        return bad_request({'fields': "指定できるのは {} です".format(
+            ','.join(SALE_FIELDS))})
+    limit = parse_int(request.GET.get('limit'), DEFAULT_LIMIT, MAX_LIMIT)
+    if limit is None:
+        return bad_request({'limit': "1〜{}で指定してください".format(MAX_LIMIT)})
+
+    # カーソルを作るため id・saled_at は常に取得する
+    columns = {'id', 'saled_at'}
+    columns.update(SALE_FIELDS[field] for field in fields
+                   if SALE_FIELDS[field] is not None)
+    if 'item_name' in fields:
+        columns.add('item_id')
+    queryset = form.filter_queryset(Sale.get_all_object()).values(*columns)
+    page = KeysetPaginator(queryset, 'saled_at', limit).get_page(
+        request.GET.get('cursor'))
+
+    items = Item.get_catalogue().by_id
+    results = []
+    for row in page:
+        result = {}
+        for field in fields:
+            if field == 'item_name':
+                item = items.get(row['item_id'])
+                result[field] = item.name if item is not None else None
+            elif field == 'saled_at':
+                result[field] = localtime(row['saled_at']).isoformat()
+            else:
+                result[field] = row[SALE_FIELDS[field]]
+        results.append(result)
+
+    return JsonResponse({
+        'results': results,
+        'next': page.next_cursor() if page.has_next else None,
+        'previous': page.previous_cursor() if page.has_previous else None,
+    })
+
+
+@login_required
+@require_GET
+@condition(etag_func=data_etag)
+@gzip_page
+def statistics(request):
+    """
+    全期間の売上と、直近span期間分の期間別売上情報
+    ?granularity=monthly|weekly|daily|hourly&span=<期間数>
+    ?granularity=heatmap&span=<日数>&item=<果物ID>
+      => 曜日（月〜日）×時間帯（0〜23時）の売上
+    """
+    params = {'granularity': 'monthly', 'span': DEFAULT_SPAN}
+    params.update(request.GET.dict())
+    form = StatisticsForm(params)
+    if not form.is_valid():
+        return bad_request(form.errors)
+    granularity = form.cleaned_data['granularity']
+    span = form.cleaned_data['span']
+    response = {
+        'entire_amount': MonthlySaleRollup.get_entire_amount(),
+        'granularity': granularity,
+    }
+    if form.rollup is None:
+        response['heatmap'] = HourlySaleRollup.get_heatmap(
+            span, form.cleaned_data['item'])
+        return JsonResponse(response)
+
+    reports = form.rollup.get_recent_reports(span)
+    response.update({
+        'reports': [
+            {
+                'period': '-'.join('{:02d}'.format(part) for part in key),
+                'amount': report['amount'],
+                'items': [
+                    {'name': name, 'amount': item_report['amount'],
+                     'item_num': item_report['item_num']}
+                    for name, item_report in report['item_reports'].items()
+                ],
+            }
+            for key, report in reports.items()
+        ],
+    })
+    return JsonResponse(response)
@@ -0,0 +1,264 @@
+"""
+締めた年の販売情報を、年ごとのアーカイブDB（SQLite）へ移す
+
+アーカイブDBは settings.SALES_ARCHIVE_DIR の sales_<年>.sqlite3 で、
+見つかったものを DATABASES に sales_archive_<年> として登録する。
+集計テーブル（日別・月別）はアーカイブ後もそのまま残すため、
+統計画面は稼働中のDBだけで表示できる。販売情報そのものを読む処理は
+Sale.sources() で稼働中のDBとアーカイブDBをまとめて扱う。
+"""
+import datetime
+import os
+import re
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.db.models import Count, Min, Max
+from django.utils.timezone import localdate
+from .models import (
+    Sale, ArchivedSale, MonthlySaleRollup, ImportJob, start_of_day)
+from apps.items.models import Item
+
+# 1トランザクションで移す件数
+ARCHIVE_CHUNK_SIZE = 5000
+# 登録キーを IN で検索する件数（SQLiteの変数の上限より少なくする）
+KEY_LOOKUP_CHUNK_SIZE = 500
+
+ARCHIVE_FILENAME = re.compile(r'^sales_(\d{4})\.sqlite3$')
+ARCHIVE_FIELDS = ('id', 'item_id', 'item_num', 'amount', 'saled_at',
+                  'import_job_id', 'import_key')
+KEY_INDEX = ARCHIVE_FIELDS.index('import_key')
+
+ArchiveResult = namedtuple('ArchiveResult', ('year', 'moved', 'elapsed'))
+
+
+def archive_dir():
+    return getattr(settings, 'SALES_ARCHIVE_DIR',
+                   os.path.join(settings.BASE_DIR, 'archive'))
+
+
+def archive_path(year):
+    return os.path.join(archive_dir(), 'sales_{}.sqlite3'.format(year))
+
+
+def archive_alias(year):
+    return 'sales_archive_{}'.format(year)
+
+
+def register(year):
+    # アーカイブDBを DATABASES に登録し、DBのエイリアスを返す
+    alias = archive_alias(year)
+    if alias not in connections.databases:
+        connections.databases[alias] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': archive_path(year),
+        }
+        if os.path.exists(archive_path(year)):
+            ensure_schema(alias)
+    return alias
+
+
+def unregister(year):
+    # アーカイブDBの接続を閉じ、DATABASES から外す
+    alias = archive_alias(year)
+    if alias not in connections.databases:
+        return
+    connections[alias].close()
+    del connections[alias]
+    del connections.databases[alias]
+
+
+def archived_years():
+    # アーカイブDBのある年（昇順）。見つかったDBはすべて登録する
+    try:
+        names = os.listdir(archive_dir())
+    except FileNotFoundError:
+        return []
+    years = sorted(int(match.group(1)) for match in
+                   (ARCHIVE_FILENAME.match(name) for name in names) if match)
+    for year in years:
+        register(year)
+    return years
+
+
+def year_range(year):
+    # その年の [開始, 終了)（ローカル時間）
+    return (start_of_day(datetime.date(year, 1, 1)),
+            start_of_day(datetime.date(year + 1, 1, 1)))
+
+
+def archived_querysets(start=None, end=None):
+    # [start, end) と重なる年のアーカイブDBのクエリセット
+    querysets = []
+    for year in archived_years():
+        year_start, year_end = year_range(year)
+        if start is not None and year_end <= start:
+            continue
+        if end is not None and end <= year_start:
+            continue
+        querysets.append(ArchivedSale.objects.using(archive_alias(year)))
+    return querysets
+
+
+def ensure_schema(alias):
+    """
+    アーカイブDBのテーブル・インデックスを作る（無いものだけ）
+    ArchivedSale は managed=False のため、create_model は Meta.indexes の
+    インデックスを作らない。ここで個別に作る
+    """
+    connection = connections[alias]
+    table = ArchivedSale._meta.db_table
+    with connection.schema_editor() as editor:
+        if table not in connection.introspection.table_names():
+            editor.create_model(ArchivedSale)
+        with connection.cursor() as cursor:
+            columns = {column.name for column in connection.introspection
+                       .get_table_description(cursor, table)}
+            constraints = connection.introspection.get_constraints(
+                cursor, table)
+        if 'import_key' not in columns:
+            # 登録キーの追加前に作ったアーカイブDB（既存の行はNULL）
+            # SQLiteの add_field はテーブルを作り直すため、列だけ追加する
+            field = ArchivedSale._meta.get_field('import_key')
+            definition, params = editor.column_sql(ArchivedSale, field)
+            editor.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                editor.quote_name(table), editor.quote_name(field.column),
+                definition), params)
+        for index in ArchivedSale._meta.indexes:
+            if index.name not in constraints:
+                editor.add_index(ArchivedSale, index)
+
+
+def archive_year(year, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    year の販売情報を稼働中のDBからアーカイブDBへ移す
+    chunk_size 件ごとに、アーカイブDBへ書き込んでから稼働中のDBから削除する
+    途中で止まっても、もう一度実行すれば続きから移せる
+    """
+    if year >= localdate().year:
+        raise ValueError("{}年はまだ締まっていないためアーカイブできません".format(year))
+    started = time.monotonic()
+    os.makedirs(archive_dir(), exist_ok=True)
+    alias = register(year)
+    ensure_schema(alias)
+    archived = ArchivedSale.objects.using(alias)
+    hot = Sale.find_in_range(*year_range(year))
+
+    moved = 0
+    while True:
+        rows = list(hot.order_by('id').values_list(*ARCHIVE_FIELDS)
+                    [:chunk_size])
+        if not rows:
+            break
+        lo, hi = rows[0][0], rows[-1][0]
+        with transaction.atomic(using=alias):
+            # 前回の途中で書き込んだ行があれば書き直す
+            archived.filter(id__gte=lo, id__lte=hi).delete()
+            archived.bulk_create(
+                ArchivedSale(**dict(zip(ARCHIVE_FIELDS, row)))
+                for row in rows)
+        with transaction.atomic():
+            # 集計テーブルはアーカイブ分も含めたままにするため、
+            # SaleQuerySet.delete（集計の減算）は通さない
+            models.QuerySet.delete(hot.filter(id__gte=lo, id__lte=hi))
+        moved += len(rows)
+    return ArchiveResult(year=year, moved=moved,
+                         elapsed=time.monotonic() - started)
+
+
+def restore_year(year, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    year のアーカイブDBの販売情報を稼働中のDBへ戻し、アーカイブDBを削除する
+    削除済みの果物の販売情報は戻さない（削除したジョブとの関連は外す）
+    登録キーが稼働中のDBの販売情報と重なる行は、登録キーを外して戻す
+    """
+    if year not in archived_years():
+        raise ValueError("{}年のアーカイブはありません".format(year))
+    started = time.monotonic()
+    alias = archive_alias(year)
+    archived = ArchivedSale.objects.using(alias)
+    items = Item.get_catalogue().by_id
+    job_ids = set(ImportJob.objects.values_list('id', flat=True))
+
+    moved = 0
+    while True:
+        rows = list(archived.order_by('id').values_list(*ARCHIVE_FIELDS)
+                    [:chunk_size])
+        if not rows:
+            break
+        lo, hi = rows[0][0], rows[-1][0]
+        # 稼働中のDBで使われている登録キー
+        # （前回の途中で戻した、この範囲のIDの行は書き直すため除く）
+        keys = [row[KEY_INDEX] for row in rows if row[KEY_INDEX] is not None]
+        used_keys = set()
+        for i in range(0, len(keys), KEY_LOOKUP_CHUNK_SIZE):
+            used_keys.update(
+                Sale.objects.filter(
+                    import_key__in=keys[i:i + KEY_LOOKUP_CHUNK_SIZE])
+                .exclude(id__gte=lo, id__lte=hi)
+                .values_list('import_key', flat=True))
+        sales = []
+        for row in rows:
+            values = dict(zip(ARCHIVE_FIELDS, row))
+            if values['item_id'] not in items:
+                continue
+            if values['import_job_id'] not in job_ids:
+                values['import_job_id'] = None
+            if values['import_key'] in used_keys:
+                values['import_key'] = None
+            sales.append(Sale(**values))
+        with transaction.atomic():
+            # 前回の途中で戻した行があれば書き直す（集計テーブルは変更しない）
+            models.QuerySet.delete(Sale.find_in_range(*year_range(year))
+                                       .filter(id__gte=lo, id__lte=hi))
+            Sale.objects.bulk_create(sales)
+        with transaction.atomic(using=alias):
+            archived.filter(id__gte=lo, id__lte=hi).delete()
+        moved += len(sales)
+
+    unregister(year)
+    os.remove(archive_path(year))
+    return ArchiveResult(year=year, moved=moved,
+                         elapsed=time.monotonic() - started)
+
+
+def verify_year(year):
+    """
+    year のアーカイブを検証し、問題点の説明のリストを返す（問題なければ空）
+    ・稼働中のDBに year の販売情報が残っていないか
+    ・アーカイブDBに year 以外の販売情報が無いか
+    ・月別集計テーブルと、販売情報（稼働中のDB・アーカイブDB）の集計が一致するか
+    """
+    if year not in archived_years():
+        return ["{}年のアーカイブはありません".format(year)]
+    start, end = year_range(year)
+    problems = []
+
+    remaining = Sale.find_in_range(start, end).count()
+    if remaining:
+        problems.append("稼働中のDBに{}年の販売情報が{}件残っています".format(
+            year, remaining))
+
+    archived = ArchivedSale.objects.using(archive_alias(year))
+    bounds = archived.aggregate(
+        first=Min('saled_at'), last=Max('saled_at'), count=Count('id'))
+    if bounds['count'] and (bounds['first'] < start or bounds['last'] >= end):
+        problems.append("アーカイブDBに{}年以外の販売情報があります".format(year))
+
+    expected = MonthlySaleRollup.compute_from_sales(start, end)
+    stored = {
+        (period, item_id): [amount, item_num, count]
+        for period, item_id, amount, item_num, count
+        in MonthlySaleRollup.objects.filter(
+            period__gte=datetime.date(year, 1, 1),
+            period__lt=datetime.date(year + 1, 1, 1),
+        ).values_list('period', 'item_id', 'amount', 'item_num',
+                      'sale_count')
+    }
+    for key in sorted(set(expected) | set(stored)):
+        if expected.get(key) != stored.get(key):
+            problems.append(
+                "集計テーブルと一致しません: {} 果物ID={} 集計={} 販売情報={}".format(
+                    key[0], key[1], stored.get(key), expected.get(key)))
+    return problems
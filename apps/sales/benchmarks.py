@@ -0,0 +1,216 @@
+"""
+販売情報まわりの性能ベンチマーク
+
+manage.py benchmark_sales から実行する。各ベンチマークの実行時間・クエリ数・
+ピークメモリを計測し、保存済みのベースラインと比較する。
+登録を伴うベンチマークはトランザクション内で実行し、最後にロールバックする。
+"""
+import csv
+import datetime
+import io
+import os
+import random
+import statistics
+import time
+import tracemalloc
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
+from django.test import Client
+from django.urls import reverse
+from django.utils.timezone import localtime, now
+from apps.items.models import Item
+from fruitshopadmin import metrics
+from fruitshopadmin.pagination import encode_cursor
+from .importers import SALE_CSV_DATETIME_FORMAT
+from .jobs import run_job
+from .models import (
+    Sale, ImportJob, HourlySaleRollup, DailySaleRollup, MonthlySaleRollup)
+
+
+class Rollback(Exception):
+    pass
+
+
+def measure(func, repeat):
+    """
+    func を repeat 回実行し、実行時間（中央値・最大）・クエリ数・ピークメモリを返す
+    クエリ数・メモリは計測のオーバーヘッドが大きいため、別に1回実行して測る
+    クエリ数は replica などを含むすべてのDB接続と、画面のセクションの
+    スレッドで発行したものを数える
+    """
+    query_metrics = metrics.RequestMetrics()
+    tracemalloc.start()
+    try:
+        with metrics.recording(query_metrics):
+            func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    queries = query_metrics.queries
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {
+        'wall_median': statistics.median(timings),
+        'wall_max': max(timings),
+        'queries': queries,
+        'peak_memory': peak,
+    }
+
+
+def client_host():
+    """
+    ベンチマークの要求に使うホスト名
+    Client の既定の 'testserver' はテストランナーの外では ALLOWED_HOSTS に
+    含まれず拒否されるため、許可されているホスト名を使う
+    """
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*':
+            return host.lstrip('.')
+    # 空（DEBUG時は localhost を許可）または '*'
+    return 'localhost'
+
+
+def rolled_back(func):
+    # 登録・更新を伴う処理を、DBに残さず計測するためのラッパー
+    def wrapper():
+        try:
+            with transaction.atomic():
+                func()
+                raise Rollback
+        except Rollback:
+            pass
+    return wrapper
+
+
+def make_csv(rows, item_names, rng=None):
+    # rng を指定しなければ、行数が同じなら同じ内容になる
+    if rng is None:
+        rng = random.Random(rows)
+    f = io.StringIO()
+    writer = csv.writer(f)
+    end = localtime(now())
+    for _ in range(rows):
+        saled_at = end - datetime.timedelta(
+            minutes=rng.randrange(60 * 24 * 365))
+        item_num = rng.randint(1, 10)
+        writer.writerow([
+            rng.choice(item_names), item_num, item_num * 100,
+            saled_at.strftime(SALE_CSV_DATETIME_FORMAT),
+        ])
+    return f.getvalue().encode('utf-8')
+
+
+class SalesBenchmark:
+
+    def __init__(self, user, repeat=5, depths=(1, 100, 1000),
+                 csv_sizes=(10000, 100000)):
+        self.client = Client(HTTP_HOST=client_host())
+        self.client.force_login(user)
+        self.user = user
+        self.repeat = repeat
+        self.depths = depths
+        self.csv_sizes = csv_sizes
+
+    def cases(self):
+        # (名前, 関数, 繰り返し回数)
+        yield 'sales:index first', self.get_index(None), self.repeat
+        for depth in self.depths:
+            cursor = self.cursor_at(depth)
+            if cursor is not None:
+                yield ('sales:index page {}'.format(depth),
+                       self.get_index(cursor), self.repeat)
+        yield 'sales:index last', self.get_index('last'), self.repeat
+        yield ('sales:statistics',
+               self.get(reverse('sales:statistics')), self.repeat)
+        yield ('Sale.get_entire_amount', Sale.get_entire_amount,
+               self.repeat)
+        yield ('Sale.get_recent_monthly_reports(3)',
+               lambda: Sale.get_recent_monthly_reports(3), self.repeat)
+        yield ('Sale.get_recent_daily_reports(3)',
+               lambda: Sale.get_recent_daily_reports(3), self.repeat)
+        yield ('MonthlySaleRollup.get_recent_reports(3)',
+               lambda: MonthlySaleRollup.get_recent_reports(3), self.repeat)
+        yield ('DailySaleRollup.get_recent_reports(3)',
+               lambda: DailySaleRollup.get_recent_reports(3), self.repeat)
+        yield ('HourlySaleRollup.get_recent_reports(24 * 365)',
+               lambda: HourlySaleRollup.get_recent_reports(24 * 365),
+               self.repeat)
+        yield ('HourlySaleRollup.get_heatmap(365)',
+               lambda: HourlySaleRollup.get_heatmap(365), self.repeat)
+        item_names = list(
+            Item.objects.active().values_list('name', flat=True))
+        if item_names:
+            for rows in self.csv_sizes:
+                data = make_csv(rows, item_names)
+                yield ('csv_upload {} rows'.format(rows),
+                       rolled_back(self.upload_and_import(data)), 1)
+
+    def get(self, url):
+        def request():
+            response = self.client.get(url)
+            assert response.status_code == 200, response.status_code
+        return request
+
+    def get_index(self, cursor):
+        url = reverse('sales:index')
+        if cursor is not None:
+            url += '?cursor=' + cursor
+        return self.get(url)
+
+    def cursor_at(self, depth):
+        # depthページ目を開くカーソル（準備用のため、OFFSETで求める）
+        offset = depth * 10 - 1
+        sale = (Sale.objects.order_by('-saled_at', '-id')
+                            .only('id', 'saled_at')[offset:offset + 1]
+                            .first())
+        if sale is None:
+            return None
+        return encode_cursor('next', sale.saled_at, sale.pk)
+
+    def upload_and_import(self, data):
+        def upload():
+            response = self.client.post(reverse('sales:csv_upload'), {
+                'file': SimpleUploadedFile('sales.csv', data,
+                                           content_type='text/csv'),
+            })
+            assert response.status_code == 302, response.status_code
+            job = ImportJob.objects.latest('id')
+            try:
+                run_job(job)
+            finally:
+                path = job.file.path
+                if os.path.exists(path):
+                    os.remove(path)
+        return upload
+
+    def run(self, only=None):
+        results = {}
+        for name, func, repeat in self.cases():
+            if only and not any(pattern in name for pattern in only):
+                continue
+            results[name] = measure(func, repeat)
+        return results
+
+
+def compare(results, baseline, threshold):
+    """
+    ベースラインと比べて、実行時間が threshold（割合）以上遅くなったもの、
+    またはクエリ数が増えたものを返す => [(名前, 理由), ...]
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['wall_median'] > base['wall_median'] * (1 + threshold):
+            regressions.append((name, "実行時間 {:.1f}ms -> {:.1f}ms".format(
+                base['wall_median'] * 1000, result['wall_median'] * 1000)))
+        if result['queries'] > base['queries']:
+            regressions.append((name, "クエリ数 {} -> {}".format(
+                base['queries'], result['queries'])))
+    return regressions
@@ -0,0 +1,120 @@
+"""
+販売情報の一括操作（削除・果物の付け替え・販売日時のずらし）
+
+対象は SaleQuerySet（IDの指定や、期間・果物・一括登録ジョブでの絞り込み）で渡す。
+ID順に chunk_size 件ずつ、それぞれ1トランザクション・数回のクエリで処理するため、
+大量の行でもSQLiteのデータベースを長時間ロックしない。
+集計テーブルは、処理した行から作った増減で更新する。
+"""
+import time
+from collections import namedtuple
+from django.db import models, transaction
+from django.db.models import F
+from .models import Sale, SALE_DELTA_FIELDS, sale_delta
+
+# 1トランザクションで処理する件数
+BULK_CHUNK_SIZE = 2000
+
+BulkResult = namedtuple('BulkResult', ('affected', 'chunks', 'elapsed'))
+
+
+class BulkOperation:
+    """
+    一括操作の基底クラス
+    apply(chunk) で対象の行を変更し、new_values(row) で変更後の
+    (果物ID, 販売日時, 売上, 個数) を返す（削除の場合はNone）
+    on_progress を指定すると、チャンクごとに処理済みの件数を渡して呼ぶ
+    """
+    label = None
+
+    def __init__(self, queryset, chunk_size=None, on_progress=None):
+        self.queryset = queryset
+        self.chunk_size = chunk_size or BULK_CHUNK_SIZE
+        self.on_progress = on_progress
+
+    def count(self):
+        # 実行せずに対象件数だけを返す（確認表示用）
+        return self.queryset.count()
+
+    def run(self):
+        started = time.monotonic()
+        affected = 0
+        chunks = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                rows = list(self.queryset.select_for_update()
+                                .filter(id__gt=last_id)
+                                .order_by('id')
+                                .values_list('id', *SALE_DELTA_FIELDS)
+                            [:self.chunk_size])
+                if not rows:
+                    break
+                upper = rows[-1][0]
+                # IN句を使わず、IDの範囲と元の条件で対象を指定する
+                self.apply(self.queryset.filter(id__gt=last_id,
+                                                id__lte=upper))
+                Sale.record_deltas(self.deltas(rows))
+            affected += len(rows)
+            chunks += 1
+            last_id = upper
+            if self.on_progress is not None:
+                self.on_progress(affected)
+        return BulkResult(affected=affected, chunks=chunks,
+                          elapsed=time.monotonic() - started)
+
+    def deltas(self, rows):
+        for row in rows:
+            old = row[1:]
+            yield sale_delta(*old, sign=-1)
+            new = self.new_values(old)
+            if new is not None:
+                yield sale_delta(*new)
+
+    def apply(self, chunk):
+        raise NotImplementedError
+
+    def new_values(self, old):
+        raise NotImplementedError
+
+
+class BulkDelete(BulkOperation):
+    label = "削除"
+
+    def apply(self, chunk):
+        # 集計テーブルはこちらで更新するため、SaleQuerySet.delete は通さない
+        models.QuerySet.delete(chunk)
+
+    def new_values(self, old):
+        return None
+
+
+class BulkReassignItem(BulkOperation):
+    label = "果物の付け替え"
+
+    def __init__(self, queryset, item, chunk_size=None):
+        super().__init__(queryset, chunk_size)
+        self.item = item
+
+    def apply(self, chunk):
+        chunk.update(item=self.item)
+
+    def new_values(self, old):
+        item_id, saled_at, amount, item_num = old
+        return self.item.id, saled_at, amount, item_num
+
+
+class BulkShiftSaledAt(BulkOperation):
+    label = "販売日時のずらし"
+
+    def __init__(self, queryset, shift, chunk_size=None):
+        # shift: datetime.timedelta
+        super().__init__(queryset, chunk_size)
+        self.shift = shift
+
+    def apply(self, chunk):
+        chunk.update(saled_at=F('saled_at') + self.shift)
+
+    def new_values(self, old):
+        item_id, saled_at, amount, item_num = old
+        return item_id, saled_at + self.shift, amount, item_num
@@ -0,0 +1,69 @@
+import csv
+import heapq
+import zlib
+from django.utils.timezone import localtime
+from apps.items.models import Item
+from .importers import SALE_CSV_DATETIME_FORMAT
+
+# 1回のfetchで取得する件数
+EXPORT_CHUNK_SIZE = 2000
+
+
+class Echo:
+    # csv.writer の書き込み先。書き込まれた文字列をそのまま返す
+    def write(self, value):
+        return value
+
+
+def iter_sale_csv_lines(querysets):
+    """
+    販売情報をCSV一括登録と同じ形式（果物名, 個数, 売上, 販売日時）の
+    行として1行ずつ返す。モデルインスタンスは作らず、chunk単位で取得する
+    querysets（稼働中のDBとアーカイブDB）の行は販売日時順に合流させる
+    果物名は結合せず、果物マスタのキャッシュから引く
+    """
+    writer = csv.writer(Echo())
+    items = Item.get_catalogue().by_id
+    rows = heapq.merge(*(
+        queryset.order_by('saled_at', 'id')
+                .values_list('saled_at', 'id', 'item_id', 'item_num',
+                             'amount')
+                .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        for queryset in querysets
+    ))
+    for saled_at, _, item_id, item_num, amount in rows:
+        # アーカイブDBに残った削除済みの果物の販売情報は出力しない
+        if item_id not in items:
+            continue
+        yield writer.writerow([
+            items[item_id].name,
+            item_num,
+            amount,
+            localtime(saled_at).strftime(SALE_CSV_DATETIME_FORMAT),
+        ])
+
+
+def iter_chunks(lines, chunk_size=64 * 1024):
+    # 細かい行をまとめてから送る
+    buffer = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def iter_gzip(chunks):
+    # gzip形式で逐次圧縮する
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
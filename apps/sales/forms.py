@@ -1,8 +1,154 @@
+import datetime
+from django import forms
 from django.forms import ModelForm
-from .models import Sale
+from apps.items.forms import ItemChoiceField
+from .models import Sale, SALE_ROLLUPS, start_of_day
+from .bulk import BulkDelete, BulkReassignItem, BulkShiftSaledAt
 
 
 class SaleForm(ModelForm):
     class Meta:
         model = Sale
         fields = ['item', 'item_num', 'saled_at']
+        field_classes = {'item': ItemChoiceField}
+
+
+class SaleFilterForm(forms.Form):
+    start_date = forms.DateField(label="開始日", required=False)
+    end_date = forms.DateField(label="終了日", required=False)
+    item = ItemChoiceField(label="果物", required=False)
+
+    def filter_queryset(self, queryset):
+        # 開始日・終了日はどちらも含む
+        start_date = self.cleaned_data['start_date']
+        end_date = self.cleaned_data['end_date']
+        item = self.cleaned_data['item']
+        if start_date is not None:
+            queryset = queryset.filter(saled_at__gte=start_of_day(start_date))
+        if end_date is not None:
+            queryset = queryset.filter(
+                saled_at__lt=start_of_day(end_date + datetime.timedelta(1)))
+        if item is not None:
+            queryset = queryset.filter(item=item)
+        return queryset
+
+    def filter_sources(self):
+        # 稼働中のDBとアーカイブDBのクエリセットを、それぞれ絞り込んで返す
+        start_date = self.cleaned_data['start_date']
+        end_date = self.cleaned_data['end_date']
+        return [self.filter_queryset(queryset) for queryset in Sale.sources(
+            start_of_day(start_date) if start_date is not None else None,
+            start_of_day(end_date + datetime.timedelta(1))
+            if end_date is not None else None)]
+
+
+class SaleExportForm(SaleFilterForm):
+    gzip = forms.BooleanField(label="gzip圧縮", required=False)
+
+
+class SaleBulkForm(SaleFilterForm):
+    """
+    販売情報の一括操作。対象はIDの指定か、期間・果物・一括登録ジョブで絞り込む
+    """
+    DELETE = 'delete'
+    REASSIGN_ITEM = 'reassign_item'
+    SHIFT_SALED_AT = 'shift_saled_at'
+    OPERATION_CHOICES = (
+        (DELETE, BulkDelete.label),
+        (REASSIGN_ITEM, BulkReassignItem.label),
+        (SHIFT_SALED_AT, BulkShiftSaledAt.label),
+    )
+    # IDで指定できる件数の上限（それ以上は絞り込み条件で指定する）
+    MAX_IDS = 500
+
+    ids = forms.CharField(label="ID（カンマ区切り）", required=False)
+    import_job = forms.IntegerField(label="一括登録ジョブID", required=False)
+    operation = forms.ChoiceField(label="操作", choices=OPERATION_CHOICES)
+    new_item = ItemChoiceField(label="付け替え先の果物", required=False)
+    shift_minutes = forms.IntegerField(label="ずらす時間（分）", required=False)
+
+    def clean_ids(self):
+        value = self.cleaned_data['ids']
+        try:
+            ids = [int(id) for id in value.replace(' ', '').split(',') if id]
+        except ValueError:
+            raise forms.ValidationError("IDは数値をカンマで区切って入力して下さい")
+        if len(ids) > self.MAX_IDS:
+            raise forms.ValidationError(
+                "IDで指定できるのは{}件までです".format(self.MAX_IDS))
+        return ids
+
+    def clean(self):
+        cleaned_data = super().clean()
+        # 条件の指定漏れで全件を操作しないようにする
+        if not any(cleaned_data.get(name) for name in (
+                'ids', 'start_date', 'end_date', 'item', 'import_job')):
+            raise forms.ValidationError("対象のIDか絞り込み条件を指定して下さい")
+        operation = cleaned_data.get('operation')
+        if (operation == self.REASSIGN_ITEM and
+                cleaned_data.get('new_item') is None):
+            self.add_error('new_item', "付け替え先の果物を選択して下さい")
+        if (operation == self.SHIFT_SALED_AT and
+                not cleaned_data.get('shift_minutes')):
+            self.add_error('shift_minutes', "ずらす時間を入力して下さい")
+        return cleaned_data
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.cleaned_data['ids']:
+            queryset = queryset.filter(id__in=self.cleaned_data['ids'])
+        if self.cleaned_data['import_job'] is not None:
+            queryset = queryset.filter(
+                import_job_id=self.cleaned_data['import_job'])
+        return queryset
+
+    def get_operation(self, queryset):
+        queryset = self.filter_queryset(queryset)
+        operation = self.cleaned_data['operation']
+        if operation == self.REASSIGN_ITEM:
+            return BulkReassignItem(queryset, self.cleaned_data['new_item'])
+        if operation == self.SHIFT_SALED_AT:
+            return BulkShiftSaledAt(queryset, datetime.timedelta(
+                minutes=self.cleaned_data['shift_minutes']))
+        return BulkDelete(queryset)
+
+
+class StatisticsForm(forms.Form):
+    """
+    販売統計情報の表示条件（集計単位・期間数）
+    heatmap は直近span日分の曜日×時間帯の売上（果物を選択できる）
+    """
+    HEATMAP = 'heatmap'
+    ROLLUPS = {rollup.granularity: rollup for rollup in SALE_ROLLUPS}
+    GRANULARITY_CHOICES = (
+        ('monthly', "月別"),
+        ('weekly', "週別"),
+        ('daily', "日別"),
+        ('hourly', "時間帯別"),
+        (HEATMAP, "曜日×時間帯"),
+    )
+    HEATMAP_MAX_SPAN = 366
+
+    granularity = forms.ChoiceField(label="集計単位", choices=GRANULARITY_CHOICES)
+    span = forms.IntegerField(label="期間数", min_value=1, initial=3)
+    item = ItemChoiceField(label="果物（曜日×時間帯のみ）", required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        granularity = cleaned_data.get('granularity')
+        span = cleaned_data.get('span')
+        if granularity is None or span is None:
+            return cleaned_data
+        max_span = (self.HEATMAP_MAX_SPAN if granularity == self.HEATMAP
+                    else self.ROLLUPS[granularity].max_span)
+        if span > max_span:
+            self.add_error('span', "期間数は{}以下で指定して下さい".format(max_span))
+        return cleaned_data
+
+    @property
+    def granularity_label(self):
+        return dict(self.GRANULARITY_CHOICES)[self.cleaned_data['granularity']]
+
+    @property
+    def rollup(self):
+        return self.ROLLUPS.get(self.cleaned_data['granularity'])
@@ -0,0 +1,285 @@
+import csv
+import datetime
+import sqlite3
+import time
+from collections import namedtuple, defaultdict
+from django.db import IntegrityError, transaction
+from django.utils.timezone import make_aware
+from apps.items.models import Item
+from .models import Sale, SaleDelta, sale_delta
+
+# CSVの列: 果物名, 個数, 売上, 販売日時
+SALE_CSV_DATETIME_FORMAT = "%Y-%m-%d %H:%M"
+
+# 同じ内容の行の出現回数をメモリに置いておく範囲（処理中の行の販売日時の前後）
+OCCURRENCE_WINDOW = datetime.timedelta(days=1)
+# メモリに置いた販売日時がこの数を超えたら、範囲外の分を一時DBに移す
+OCCURRENCE_PRUNE_THRESHOLD = 4096
+# 同時に同じ行が登録された（登録キーが重複した）バッチを登録し直す回数
+INSERT_RETRIES = 3
+
+RowError = namedtuple('RowError', ('line', 'reason'))
+
+
+class ImportResult:
+    """
+    CSV一括登録の結果（登録件数・重複件数・エラー行・処理時間）
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.created = 0
+        # 既に登録済みのため登録しなかった行数
+        self.duplicates = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def failed(self):
+        return len(self.errors)
+
+    @property
+    def rows_per_sec(self):
+        if not self.elapsed:
+            return 0.0
+        return self.total / self.elapsed
+
+
+class OccurrenceCounter:
+    """
+    CSVの中で同じ内容（登録キー）の行が何回目かを数える
+
+    出現回数は販売日時ごとにメモリに置き、販売日時の種類が
+    OCCURRENCE_PRUNE_THRESHOLD を超えたら、処理中の行から離れたものから
+    一時DB（SQLiteの一時ファイル。close() で削除される）に移す。
+    移した範囲の販売日時は一時DBも参照するため、販売日時順でないCSVでも
+    回数は正しい。販売日時順のCSVなら一時DBはほとんど使わない。
+    """
+
+    def __init__(self):
+        # {販売日時: {登録キー: 回数}}
+        self.recent = {}
+        self.spill = None
+        # 一時DBに移した販売日時の範囲 (最小, 最大)
+        self.spilled_range = None
+
+    def next_occurrence(self, saled_at, key):
+        # key の行が既に何回あったか（0から）を返し、1回分数える
+        counts = self.recent.get(saled_at)
+        if counts is None:
+            counts = self.recent[saled_at] = {}
+            if len(self.recent) > OCCURRENCE_PRUNE_THRESHOLD:
+                self.prune(saled_at)
+        occurrence = counts.get(key)
+        if occurrence is None:
+            occurrence = self.spilled_count(saled_at, key)
+        counts[key] = occurrence + 1
+        return occurrence
+
+    def spilled_count(self, saled_at, key):
+        if self.spilled_range is None:
+            return 0
+        first, last = self.spilled_range
+        if not first <= saled_at <= last:
+            return 0
+        row = self.spill.execute(
+            'SELECT count FROM occurrences WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def prune(self, saled_at):
+        # 処理中の行から OCCURRENCE_WINDOW 以上離れた販売日時を移す
+        # 範囲内だけで多すぎる場合は、離れた順に半分まで移す
+        by_distance = sorted(self.recent,
+                             key=lambda other: abs(other - saled_at))
+        keep = OCCURRENCE_PRUNE_THRESHOLD // 2
+        expired = [other for i, other in enumerate(by_distance)
+                   if i >= keep or abs(other - saled_at) > OCCURRENCE_WINDOW]
+        if self.spill is None:
+            self.spill = sqlite3.connect('')
+            self.spill.execute(
+                'CREATE TABLE occurrences (key TEXT PRIMARY KEY, '
+                'count INTEGER NOT NULL) WITHOUT ROWID')
+        for other in expired:
+            self.spill.executemany(
+                'INSERT OR REPLACE INTO occurrences (key, count) '
+                'VALUES (?, ?)', self.recent.pop(other).items())
+            if self.spilled_range is None:
+                self.spilled_range = (other, other)
+            else:
+                self.spilled_range = (min(self.spilled_range[0], other),
+                                      max(self.spilled_range[1], other))
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.recent = {}
+        self.spilled_range = None
+
+
+class SaleCsvImporter:
+    """
+    販売情報CSVを1行ずつ検証し、batch_size件ごとにbulk_createで登録する
+    果物名は最初に一括で取得し、1行ごとのクエリは発行しない
+
+    atomic=True のときは全体を1トランザクションで登録する。
+    atomic=False のときはbatch_size件ごとにコミットし、
+    on_progress(result) を呼び出す（バックグラウンド処理の進捗表示用）
+    import_job を指定すると、登録した販売情報にジョブを記録する
+
+    各行には内容から作った登録キー（Sale.import_key、ユニーク）を付け、
+    登録済みのキーの行は登録しない。同じCSVを何度登録しても結果は変わらない。
+    """
+    batch_size = 2000
+
+    def __init__(self, batch_size=None, atomic=True, on_progress=None,
+                 import_job=None):
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.atomic = atomic
+        self.on_progress = on_progress
+        self.import_job = import_job
+        self.result = ImportResult()
+        self.items = Item.get_catalogue().by_name
+        self.batch = []
+        self.last_saled_at = (None, None)
+        # 内容が同じ行の出現回数
+        self.occurrences = OccurrenceCounter()
+        # 集計テーブルへの増減は（販売日, 時, 果物）単位でまとめて最後に反映する
+        self.deltas = defaultdict(lambda: [0, 0, 0, None])
+
+    def parse_row(self, row):
+        # 行を検証し、Saleを返す（不正な行はValueErrorに理由を入れて送出）
+        if len(row) < 4:
+            raise ValueError("列が不足しています")
+        item = self.items.get(row[0])
+        if item is None:
+            raise ValueError("果物「{}」は登録されていません".format(row[0]))
+        try:
+            item_num = int(row[1])
+            amount = int(row[2])
+        except ValueError:
+            raise ValueError("個数・売上が数値ではありません")
+        if item_num < 0 or amount < 0:
+            raise ValueError("個数・売上が負の値です")
+        saled_at = self.parse_saled_at(row[3])
+        return Sale(
+            item_id=item.id,
+            item_num=item_num,
+            amount=amount,
+            saled_at=saled_at,
+            import_job=self.import_job,
+            import_key=self.import_key(item.id, item_num, amount, saled_at),
+        )
+
+    def parse_saled_at(self, text):
+        # CSVは販売日時順のことが多いため、直前の行と同じ日時は解析し直さない
+        if text == self.last_saled_at[0]:
+            return self.last_saled_at[1]
+        try:
+            saled_at = datetime.datetime.strptime(
+                text, SALE_CSV_DATETIME_FORMAT)
+        except ValueError:
+            raise ValueError("販売日時の形式が正しくありません")
+        saled_at = make_aware(saled_at)
+        self.last_saled_at = (text, saled_at)
+        return saled_at
+
+    def import_key(self, item_id, item_num, amount, saled_at):
+        key = Sale.make_import_key(item_id, item_num, amount, saled_at)
+        occurrence = self.occurrences.next_occurrence(saled_at, key)
+        if occurrence:
+            key = Sale.make_import_key(
+                item_id, item_num, amount, saled_at, occurrence)
+        return key
+
+    def add_row(self, line, row):
+        self.result.total += 1
+        try:
+            sale = self.parse_row(row)
+        except ValueError as e:
+            self.result.errors.append(RowError(line=line, reason=str(e)))
+            return
+        self.batch.append(sale)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.atomic:
+            self._insert_batch()
+            return
+        with transaction.atomic():
+            self._insert_batch()
+            self.record_deltas()
+        if self.on_progress is not None:
+            self.on_progress(self.result)
+
+    def _insert_batch(self):
+        if not self.batch:
+            return
+        # 登録済みの行を除いてから登録する
+        # 同時に同じ行が登録された（ユニーク制約に違反した）場合は、違反を
+        # 無視せず（登録した行だけを集計するため）、登録済みの行を調べ直す
+        saled_ats = [sale.saled_at for sale in self.batch]
+        start = min(saled_ats)
+        end = max(saled_ats) + datetime.timedelta(microseconds=1)
+        for attempt in range(INSERT_RETRIES):
+            existing = Sale.find_existing_import_keys(
+                (sale.import_key for sale in self.batch), start, end)
+            sales = [sale for sale in self.batch
+                     if sale.import_key not in existing]
+            try:
+                with transaction.atomic():
+                    Sale.objects.bulk_create(sales)
+            except IntegrityError:
+                if attempt == INSERT_RETRIES - 1:
+                    raise
+            else:
+                break
+        self.result.duplicates += len(self.batch) - len(sales)
+        for sale in sales:
+            delta = sale_delta(sale.item_id, sale.saled_at, sale.amount,
+                               sale.item_num)
+            bucket = self.deltas[(delta.date, delta.hour, delta.item_id)]
+            bucket[0] += delta.amount
+            bucket[1] += delta.item_num
+            bucket[2] += delta.count
+            if bucket[3] is None or delta.saled_at > bucket[3]:
+                bucket[3] = delta.saled_at
+        self.result.created += len(sales)
+        self.batch = []
+
+    def record_deltas(self):
+        Sale.record_deltas(
+            SaleDelta(item_id=item_id, date=date, hour=hour, amount=amount,
+                      item_num=item_num, count=count, saled_at=saled_at)
+            for (date, hour, item_id), (amount, item_num, count, saled_at)
+            in self.deltas.items()
+        )
+        self.deltas.clear()
+
+    def finish(self):
+        self.flush()
+        if self.atomic:
+            self.record_deltas()
+        self.occurrences.close()
+
+    def import_rows(self, rows):
+        # rows: CSVの各行（リスト）のiterable。行番号は1から数える
+        started = time.monotonic()
+        if self.atomic:
+            with transaction.atomic():
+                self._import_rows(rows)
+        else:
+            self._import_rows(rows)
+        self.result.elapsed = time.monotonic() - started
+        return self.result
+
+    def _import_rows(self, rows):
+        for line, row in enumerate(rows, start=1):
+            self.add_row(line, row)
+        self.finish()
+
+    def import_file(self, f):
+        # f: テキストモードのファイルオブジェクト
+        return self.import_rows(csv.reader(f))
@@ -0,0 +1,193 @@
+import csv
+import io
+import json
+import logging
+import os
+import socket
+import time
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from apps.items.models import Item
+from .bulk import BulkDelete
+from .importers import SaleCsvImporter
+from .models import Sale, ImportJob, ItemPurgeJob
+
+logger = logging.getLogger(__name__)
+
+# ImportJob.errors に保存するエラー行の上限
+MAX_STORED_ERRORS = 1000
+# 進捗をDBへ書き込む最小間隔（秒）
+PROGRESS_INTERVAL = 1.0
+# 処理中のジョブがこの秒数応答しなければ、ワーカーが停止したとみなして
+# 別のワーカーが確保し直す（最初からやり直す）
+STALE_JOB_TIMEOUT = 600
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def claim_next_job(worker, model=ImportJob, stale_timeout=STALE_JOB_TIMEOUT):
+    """
+    待機中のジョブ（model: ImportJob・ItemPurgeJob）を1件確保して返す
+    （無ければNone）
+    処理中のまま stale_timeout 秒以上応答の無いジョブも、停止したワーカーから
+    確保し直す（やり直せないジョブは失敗にする）
+    status・最終応答日時を条件にしたUPDATEで確保するため、SQLiteでも
+    複数プロセスで同じジョブを処理することはない
+    """
+    stale = model.stale_filter(stale_timeout)
+    model.objects.filter(stale).exclude(model.resumable_filter()).update(
+        status=model.FAILED,
+        message="処理中にワーカーが停止しました",
+        finished_at=now(),
+    )
+    claimable = Q(status=model.QUEUED) | (stale & model.resumable_filter())
+    candidates = (model.objects.filter(claimable)
+                               .order_by('created_at', 'id')
+                               .values_list('id', 'status')[:10])
+    for job_id, status in candidates:
+        claimed = (model.objects.filter(claimable, id=job_id)
+                                .update(status=model.RUNNING,
+                                        worker=worker,
+                                        started_at=now(),
+                                        heartbeat_at=now()))
+        if claimed:
+            if status == model.RUNNING:
+                logger.warning("worker %s re-claimed stale job %s",
+                               worker, job_id)
+            return model.objects.get(id=job_id)
+    return None
+
+
+def count_rows(f):
+    return sum(1 for _ in csv.reader(f))
+
+
+def progress_saver(job):
+    # SaleCsvImporter の on_progress に渡す、進捗をDBへ書き込む関数
+    last_saved = [0.0]
+
+    def save_progress(result):
+        if time.monotonic() - last_saved[0] < PROGRESS_INTERVAL:
+            return
+        last_saved[0] = time.monotonic()
+        ImportJob.objects.filter(id=job.id).update(
+            rows_done=result.total,
+            rows_created=result.created,
+            rows_duplicated=result.duplicates,
+            rows_failed=result.failed,
+            heartbeat_at=now(),
+        )
+    return save_progress
+
+
+def finish_job(job, result, status, message=''):
+    ImportJob.objects.filter(id=job.id).update(
+        status=status,
+        message=message,
+        rows_done=result.total,
+        rows_created=result.created,
+        rows_duplicated=result.duplicates,
+        rows_failed=result.failed,
+        errors=json.dumps(
+            [list(error) for error in result.errors[:MAX_STORED_ERRORS]],
+            ensure_ascii=False),
+        finished_at=now(),
+    )
+
+
+def run_job(job):
+    # 確保済み（RUNNING）のジョブを処理する
+    importer = SaleCsvImporter(atomic=False, on_progress=progress_saver(job),
+                               import_job=job)
+    try:
+        with job.file.open('rb') as raw:
+            f = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            # ETA表示のため、先に行数だけ数えておく
+            total_rows = count_rows(f)
+            ImportJob.objects.filter(id=job.id).update(
+                total_rows=total_rows, heartbeat_at=now())
+            f.seek(0)
+            result = importer.import_file(f)
+    except Exception as e:
+        logger.exception("import job %s failed", job.id)
+        result = importer.result
+        status, message = ImportJob.FAILED, str(e)
+    else:
+        status, message = ImportJob.DONE, ''
+
+    finish_job(job, result, status, message)
+    return status
+
+
+def run_purge_job(job, chunk_size=None):
+    """
+    確保済み（RUNNING）の果物の削除ジョブを処理する
+    販売情報は BulkDelete でチャンクごとに削除する（集計テーブルも減算する）
+    すべて削除し終えたら、同じトランザクションで残りが無いことを確かめて
+    果物の行を削除する
+    """
+    last_saved = [0.0]
+
+    def save_progress(deleted):
+        if time.monotonic() - last_saved[0] < PROGRESS_INTERVAL:
+            return
+        last_saved[0] = time.monotonic()
+        ItemPurgeJob.objects.filter(id=job.id).update(
+            sales_deleted=deleted, heartbeat_at=now())
+
+    deleted = 0
+    try:
+        if job.item_id is not None:
+            sales = Sale.objects.filter(item_id=job.item_id)
+            # 果物ごとの件数は item_id のインデックスだけで数えられる
+            ItemPurgeJob.objects.filter(id=job.id).update(
+                total_sales=sales.count(), heartbeat_at=now())
+            deleted = BulkDelete(sales, chunk_size,
+                                 on_progress=save_progress).run().affected
+            with transaction.atomic():
+                # 論理削除の前に読み込んだ果物で登録された販売情報があれば消す
+                deleted += BulkDelete(sales, chunk_size).run().affected
+                Item.objects.filter(id=job.item_id).delete()
+    except Exception as e:
+        logger.exception("item purge job %s failed", job.id)
+        status, message = ItemPurgeJob.FAILED, str(e)
+    else:
+        status, message = ItemPurgeJob.DONE, ''
+
+    ItemPurgeJob.objects.filter(id=job.id).update(
+        status=status,
+        message=message,
+        sales_deleted=deleted,
+        finished_at=now(),
+    )
+    return status
+
+
+def run_worker(poll_interval=2.0, once=False):
+    """
+    ジョブを確保して処理し続ける
+    once=True のときは待機中のジョブが無くなった時点で終了する
+    """
+    name = worker_name()
+    while True:
+        close_old_connections()
+        job = claim_next_job(name)
+        if job is not None:
+            logger.info("worker %s started import job %s", name, job.id)
+            status = run_job(job)
+            logger.info("worker %s finished import job %s (%s)",
+                        name, job.id, status)
+            continue
+        job = claim_next_job(name, ItemPurgeJob)
+        if job is not None:
+            logger.info("worker %s started item purge job %s", name, job.id)
+            status = run_purge_job(job)
+            logger.info("worker %s finished item purge job %s (%s)",
+                        name, job.id, status)
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
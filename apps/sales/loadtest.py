@@ -0,0 +1,310 @@
+"""
+販売情報まわりの負荷試験（複数のログイン済みユーザーの同時操作）
+
+manage.py loadtest から実行する。起動中のサーバー（runserver など）に、
+仮想ユーザーごとのスレッドから、指定した割合で次の操作を繰り返し送る。
+・index       販売情報一覧を開き、「次へ」で数ページ進む
+・register    登録画面を開き、販売情報を1件登録する
+・edit        編集画面を開き、既存の販売情報を更新する
+・csv_upload  数行のCSVファイルをアップロードする（受信しながら登録）
+・statistics  集計画面を開く
+エンドポイントごとに件数・スループット・処理時間のパーセンタイル・
+エラー数（うちDBのロック待ちのタイムアウト）を集計する。
+
+登録・更新・CSVの登録は実際にDBに残るため、開発用のDBに対して実行すること。
+仮想ユーザーのセッションはこのプロセスから作るため、
+サーバーと同じDB（セッションの保存先）を使う設定で実行する。
+"""
+import http.client
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+from django.conf import settings
+from django.test import Client
+from django.urls import reverse
+from django.utils.timezone import localtime, now
+from fruitshopadmin.metrics import percentile
+from .benchmarks import make_csv
+
+OPERATIONS = ('index', 'register', 'edit', 'csv_upload', 'statistics')
+DEFAULT_MIX = {
+    'index': 40,
+    'register': 30,
+    'edit': 10,
+    'csv_upload': 5,
+    'statistics': 15,
+}
+
+# サーバーのエラー画面（DEBUG=True）に含まれる、ロック待ちのタイムアウトの例外
+LOCK_TIMEOUT_MARKERS = (
+    b'database is locked',
+    b'Lock wait timeout exceeded',
+    b'deadlock detected',
+    b'could not obtain lock',
+)
+
+_NEXT_CURSOR = re.compile(r'href="\?cursor=([A-Za-z0-9_=-]+)"[^>]*>次へ')
+
+
+def parse_mix(values):
+    # ["index=40", "register=30", ...] => {操作: 重み}
+    mix = {}
+    for value in values:
+        name, _, weight = value.partition('=')
+        if name not in OPERATIONS:
+            raise ValueError("操作「{}」はありません（{}）".format(
+                name, ', '.join(OPERATIONS)))
+        try:
+            mix[name] = int(weight)
+        except ValueError:
+            raise ValueError("重みは整数で指定して下さい: {}".format(value))
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError("重みが1以上の操作を1つ以上指定して下さい")
+    return mix
+
+
+def create_session(user):
+    # ログイン済みのセッションのクッキー（仮想ユーザーごとに別のセッション）
+    client = Client()
+    client.force_login(user)
+    return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+
+class Sample:
+    __slots__ = ('endpoint', 'duration', 'status', 'lock_timeout')
+
+    def __init__(self, endpoint, duration, status, lock_timeout=False):
+        self.endpoint = endpoint
+        self.duration = duration
+        # 接続できない・応答が無い場合はNone
+        self.status = status
+        self.lock_timeout = lock_timeout
+
+    @property
+    def failed(self):
+        return self.status is None or self.status >= 400
+
+
+class VirtualUser:
+    """
+    1人の仮想ユーザー。クッキー（セッション・CSRFトークン）を保持し、
+    操作ごとのリクエストの処理時間を samples に記録する
+    """
+
+    def __init__(self, base_url, session_key, items, sale_ids, rng,
+                 pages=3, csv_rows=20, timeout=30.0):
+        url = urlsplit(base_url)
+        self.origin = '{}://{}'.format(url.scheme, url.netloc)
+        self.connection_class = (http.client.HTTPSConnection
+                                 if url.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.netloc = url.netloc
+        self.cookies = {settings.SESSION_COOKIE_NAME: session_key}
+        # [(ID, 名前), ...]
+        self.items = items
+        self.sale_ids = sale_ids
+        self.rng = rng
+        self.pages = pages
+        self.csv_rows = csv_rows
+        self.timeout = timeout
+        self.samples = []
+
+    def request(self, endpoint, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        headers['Cookie'] = '; '.join(
+            '{}={}'.format(name, value)
+            for name, value in self.cookies.items())
+        if method == 'POST':
+            headers['X-CSRFToken'] = self.cookies.get(
+                settings.CSRF_COOKIE_NAME, '')
+            headers['Origin'] = self.origin
+            headers['Referer'] = self.origin + path
+        connection = self.connection_class(self.netloc, timeout=self.timeout)
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            self.samples.append(
+                Sample(endpoint, time.perf_counter() - started, None))
+            return None
+        finally:
+            connection.close()
+        duration = time.perf_counter() - started
+        for header in response.msg.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        self.samples.append(Sample(
+            endpoint, duration, response.status,
+            response.status >= 500 and
+            any(marker in content for marker in LOCK_TIMEOUT_MARKERS)))
+        return content
+
+    def run(self, operation):
+        getattr(self, operation)()
+
+    def index(self):
+        path = reverse('sales:index')
+        content = self.request('GET sales:index', 'GET', path)
+        for _ in range(self.pages - 1):
+            match = _NEXT_CURSOR.search(
+                (content or b'').decode('utf-8', 'replace'))
+            if match is None:
+                break
+            content = self.request(
+                'GET sales:index (next)', 'GET',
+                '{}?cursor={}'.format(path, match.group(1)))
+
+    def sale_form(self):
+        return {
+            'item': self.rng.choice(self.items)[0],
+            'item_num': self.rng.randint(1, 10),
+            'saled_at': localtime(now()).strftime('%Y-%m-%d %H:%M:%S'),
+        }
+
+    def post_form(self, endpoint, path, data):
+        self.request(endpoint, 'POST', path, urlencode(data), {
+            'Content-Type': 'application/x-www-form-urlencoded',
+        })
+
+    def register(self):
+        path = reverse('sales:register')
+        self.request('GET sales:register', 'GET', path)
+        self.post_form('POST sales:register', path, self.sale_form())
+
+    def edit(self):
+        if not self.sale_ids:
+            return
+        path = reverse('sales:edit', args=[self.rng.choice(self.sale_ids)])
+        self.request('GET sales:edit', 'GET', path)
+        self.post_form('POST sales:edit', path, self.sale_form())
+
+    def csv_upload(self):
+        if settings.CSRF_COOKIE_NAME not in self.cookies:
+            # CSRFトークンを受け取るため、一覧を開いておく
+            self.request('GET sales:index', 'GET', reverse('sales:index'))
+        boundary = uuid.uuid4().hex
+        body = b''.join([
+            '--{}\r\n'.format(boundary).encode(),
+            b'Content-Disposition: form-data; name="file"; '
+            b'filename="loadtest.csv"\r\n',
+            b'Content-Type: text/csv\r\n\r\n',
+            make_csv(self.csv_rows, [name for _, name in self.items],
+                     self.rng),
+            '\r\n--{}--\r\n'.format(boundary).encode(),
+        ])
+        self.request('POST sales:csv_upload', 'POST',
+                     reverse('sales:csv_upload'), body, {
+                         'Content-Type':
+                             'multipart/form-data; boundary=' + boundary,
+                     })
+
+    def statistics(self):
+        self.request('GET sales:statistics', 'GET',
+                     reverse('sales:statistics'))
+
+
+class LoadTest:
+    """
+    users 人の仮想ユーザーが、duration 秒の間（requests を指定した場合は
+    1人あたり requests 回の操作を終えるまで）、mix の割合で操作を選んで繰り返す
+    操作の間は 0〜think_time 秒（一様分布）待つ
+    """
+
+    def __init__(self, base_url, sessions, items, sale_ids, mix,
+                 duration=60.0, requests=None, think_time=0.0, seed=None,
+                 **user_options):
+        self.users = [
+            VirtualUser(base_url, session, items, sale_ids,
+                        random.Random(None if seed is None else seed + i),
+                        **user_options)
+            for i, session in enumerate(sessions)]
+        self.operations = [name for name in OPERATIONS if mix.get(name)]
+        self.weights = [mix[name] for name in self.operations]
+        self.duration = duration
+        self.requests = requests
+        self.think_time = think_time
+        self.elapsed = None
+
+    def run_user(self, user, deadline):
+        done = 0
+        while time.monotonic() < deadline:
+            if self.requests is not None and done >= self.requests:
+                break
+            operation = user.rng.choices(
+                self.operations, weights=self.weights)[0]
+            user.run(operation)
+            done += 1
+            if self.think_time:
+                time.sleep(user.rng.uniform(0, self.think_time))
+
+    def run(self):
+        started = time.monotonic()
+        deadline = started + self.duration
+        threads = [threading.Thread(
+            target=self.run_user, args=(user, deadline),
+            name='loadtest-{}'.format(i), daemon=True)
+            for i, user in enumerate(self.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.monotonic() - started
+        return summarize(
+            [sample for user in self.users for sample in user.samples],
+            self.elapsed)
+
+
+def summarize(samples, elapsed):
+    """
+    エンドポイントごと（と全体 'total'）の集計を返す
+    処理時間はミリ秒。失敗したリクエストも処理時間に含める
+    """
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample.endpoint].append(sample)
+    by_endpoint['total'] = samples
+    results = {}
+    for endpoint, endpoint_samples in sorted(by_endpoint.items()):
+        durations = sorted(sample.duration * 1000
+                           for sample in endpoint_samples)
+        results[endpoint] = {
+            'requests': len(endpoint_samples),
+            'throughput': len(endpoint_samples) / elapsed if elapsed else 0.0,
+            'errors': sum(1 for sample in endpoint_samples if sample.failed),
+            'lock_timeouts': sum(
+                1 for sample in endpoint_samples if sample.lock_timeout),
+            'p50_ms': percentile(durations, 50),
+            'p95_ms': percentile(durations, 95),
+            'p99_ms': percentile(durations, 99),
+            'max_ms': durations[-1] if durations else None,
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    ベースラインと比べて、p95 が threshold（割合）以上遅くなったもの、
+    またはエラー率が上がったものを返す => [(エンドポイント, 理由), ...]
+    """
+    regressions = []
+    for endpoint, result in sorted(results.items()):
+        base = baseline.get(endpoint)
+        if base is None or not result['requests'] or not base['requests']:
+            continue
+        if (base['p95_ms'] is not None and
+                result['p95_ms'] > base['p95_ms'] * (1 + threshold)):
+            regressions.append((endpoint, "p95 {:.1f}ms -> {:.1f}ms".format(
+                base['p95_ms'], result['p95_ms'])))
+        error_rate = result['errors'] / result['requests']
+        base_error_rate = base['errors'] / base['requests']
+        if error_rate > base_error_rate:
+            regressions.append((endpoint, "エラー率 {:.1%} -> {:.1%}".format(
+                base_error_rate, error_rate)))
+    return regressions
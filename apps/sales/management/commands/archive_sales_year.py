@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from apps.sales import archive
+
+
+class Command(BaseCommand):
+    help = "締めた年の販売情報を、年ごとのアーカイブDBへ移す"
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int)
+        parser.add_argument('--chunk-size', type=int,
+                            default=archive.ARCHIVE_CHUNK_SIZE)
+        parser.add_argument(
+            '--vacuum', action='store_true',
+            help="移した後に稼働中のDBをVACUUMしてファイルを小さくする（SQLiteのみ）")
+
+    def handle(self, *args, **options):
+        try:
+            result = archive.archive_year(options['year'],
+                                          options['chunk_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            "{}年の販売情報{}件を {} へ移しました（{:.1f}秒）".format(
+                result.year, result.moved,
+                archive.archive_path(result.year), result.elapsed)))
+
+        problems = archive.verify_year(result.year)
+        for problem in problems:
+            self.stderr.write(problem)
+        if problems:
+            raise CommandError("アーカイブの検証に失敗しました")
+
+        if options['vacuum'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+            self.stdout.write("稼働中のDBをVACUUMしました")
@@ -0,0 +1,67 @@
+import datetime
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Min, Max
+from django.utils.timezone import localdate
+from apps.sales.models import Sale, start_of_day
+
+
+class Command(BaseCommand):
+    help = ("登録キーの無い販売情報に登録キーを付ける"
+            "（登録キーの追加前にCSVで登録した販売情報を、再登録で重複させないため）")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        bounds = Sale.objects.filter(import_key__isnull=True).aggregate(
+            first=Min('saled_at'), last=Max('saled_at'))
+        if bounds['first'] is None:
+            self.stdout.write("登録キーの無い販売情報はありません")
+            return
+        updated = 0
+        day = localdate(bounds['first'])
+        while day <= localdate(bounds['last']):
+            next_day = day + datetime.timedelta(days=1)
+            updated += self.backfill(start_of_day(day), start_of_day(next_day))
+            day = next_day
+        self.stdout.write(self.style.SUCCESS(
+            "{}件に登録キーを付けました（{:.1f}秒）".format(
+                updated, time.monotonic() - started)))
+
+    def backfill(self, start, end):
+        """
+        [start, end) の販売情報に登録キーを付ける
+        同じ内容の行は同じ販売日時なので、1日ずつ内容の順に読み、
+        CSVの登録時と同じく2件目以降を何番目か（occurrence）で区別する
+        """
+        with transaction.atomic():
+            sales = Sale.find_in_range(start, end)
+            used = set(sales.filter(import_key__isnull=False)
+                            .values_list('import_key', flat=True))
+            rows = (sales.filter(import_key__isnull=True)
+                         .order_by('item_id', 'item_num', 'amount',
+                                   'saled_at', 'id')
+                         .values_list('id', 'item_id', 'item_num', 'amount',
+                                      'saled_at'))
+            keys = []
+            occurrences = {}
+            for row in rows:
+                content = row[1:]
+                occurrence = occurrences.get(content, 0)
+                key = Sale.make_import_key(*content, occurrence=occurrence)
+                # 登録キーの追加後に同じ内容の行を登録済みの場合は、次の番号にする
+                while key in used:
+                    occurrence += 1
+                    key = Sale.make_import_key(*content,
+                                               occurrence=occurrence)
+                occurrences[content] = occurrence + 1
+                used.add(key)
+                keys.append((key, row[0]))
+            # 行ごとに値が違うため、bulk_update（CASE式）ではなく
+            # 同じUPDATE文をまとめて実行する
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    'UPDATE {} SET import_key = %s WHERE id = %s'.format(
+                        connection.ops.quote_name(Sale._meta.db_table)),
+                    keys)
+        return len(keys)
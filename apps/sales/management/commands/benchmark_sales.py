@@ -0,0 +1,84 @@
+import json
+import platform
+import django
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+from apps.items.models import Item
+from apps.sales.benchmarks import SalesBenchmark, compare
+from apps.sales.models import Sale
+
+
+class Command(BaseCommand):
+    help = ("販売情報まわりの性能ベンチマークを実行し、結果をJSONで保存する"
+            "（ベースラインとの比較で性能劣化を検出する）")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='benchmark_results.json',
+                            help="結果を保存するJSONファイル")
+        parser.add_argument('--baseline',
+                            help="比較するベースライン（以前の結果のJSONファイル）")
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help="性能劣化とみなす実行時間の増加率")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--depths', type=int, nargs='+',
+                            default=[1, 100, 1000],
+                            help="計測する販売情報一覧のページ")
+        parser.add_argument('--csv-rows', type=int, nargs='+',
+                            default=[10000, 100000],
+                            help="計測するCSV一括登録の行数")
+        parser.add_argument('--only', nargs='+',
+                            help="名前にこの文字列を含むベンチマークだけ実行する")
+        parser.add_argument('--username',
+                            help="ログインするユーザー（既定は最初のスーパーユーザー）")
+
+    def handle(self, *args, **options):
+        user = self.get_user(options['username'])
+        benchmark = SalesBenchmark(
+            user,
+            repeat=options['repeat'],
+            depths=options['depths'],
+            csv_sizes=options['csv_rows'],
+        )
+        results = benchmark.run(only=options['only'])
+
+        for name, result in results.items():
+            self.stdout.write(
+                "{:<45} {:>9.1f}ms {:>6} queries {:>9.1f}KiB".format(
+                    name, result['wall_median'] * 1000, result['queries'],
+                    result['peak_memory'] / 1024))
+
+        with open(options['output'], 'w') as f:
+            json.dump({
+                'created_at': now().isoformat(),
+                'environment': {
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'sales': Sale.objects.count(),
+                    'items': Item.objects.count(),
+                },
+                'results': results,
+            }, f, ensure_ascii=False, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+            regressions = compare(results, baseline, options['threshold'])
+            for name, reason in regressions:
+                self.stderr.write("{}: {}".format(name, reason))
+            if regressions:
+                raise CommandError(
+                    "{}件の性能劣化を検出しました".format(len(regressions)))
+            self.stdout.write(self.style.SUCCESS("ベースラインからの性能劣化はありません"))
+
+    def get_user(self, username):
+        User = get_user_model()
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError("ユーザー {} が存在しません".format(username))
+        user = User.objects.filter(is_superuser=True).order_by('id').first()
+        if user is None:
+            raise CommandError("--username を指定するか、スーパーユーザーを作成して下さい")
+        return user
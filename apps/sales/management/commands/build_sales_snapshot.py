@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand
+from apps.sales.analytics import SalesSnapshot
+
+
+class Command(BaseCommand):
+    help = "販売情報の列指向スナップショットを作成（または差分更新）して保存する"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="スナップショットを保存するディレクトリ")
+        parser.add_argument(
+            '--refresh', action='store_true',
+            help="保存済みのスナップショットに新しい販売情報だけを追加する")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        if options['refresh']:
+            snapshot = SalesSnapshot.open(options['path'], mmap=False)
+            added = snapshot.refresh()
+        else:
+            snapshot = SalesSnapshot.from_queryset()
+            added = len(snapshot)
+        snapshot.save(options['path'])
+        self.stdout.write(self.style.SUCCESS(
+            "{}件を追加しました（合計{}件, {:.1f}秒）".format(
+                added, len(snapshot), time.monotonic() - started)))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from apps.sales.importers import SaleCsvImporter
+
+
+class Command(BaseCommand):
+    help = "販売情報CSV（果物名, 個数, 売上, 販売日時）を一括登録する"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSVファイルのパス")
+        parser.add_argument('--encoding', default='utf-8')
+        parser.add_argument(
+            '--batch-size', type=int, default=SaleCsvImporter.batch_size,
+            help="1回のbulk_createで登録する件数")
+
+    def handle(self, *args, **options):
+        importer = SaleCsvImporter(batch_size=options['batch_size'])
+        with open(options['path'], encoding=options['encoding'],
+                  newline='') as f:
+            result = importer.import_file(f)
+
+        for error in result.errors:
+            self.stderr.write("{}行目: {}".format(error.line, error.reason))
+        self.stdout.write(self.style.SUCCESS(
+            "{}件を登録しました（登録済み{}件, エラー{}件, {:.1f}秒, {:.0f}行/秒）"
+            .format(result.created, result.duplicates, result.failed,
+                    result.elapsed, result.rows_per_sec)))
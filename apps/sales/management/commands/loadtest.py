@@ -0,0 +1,136 @@
+import json
+import platform
+import django
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+from apps.items.models import Item
+from apps.sales.loadtest import (
+    DEFAULT_MIX, LoadTest, compare, create_session, parse_mix)
+from apps.sales.models import Sale
+
+
+class Command(BaseCommand):
+    help = ("起動中のサーバーに、複数のログイン済みユーザーから販売情報の操作を"
+            "同時に送る負荷試験を実行し、結果をJSONで保存する"
+            "（登録・更新はDBに残るため、開発用のDBで実行すること）")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000',
+                            help="負荷をかけるサーバー")
+        parser.add_argument('--users', type=int, default=10,
+                            help="同時に操作する仮想ユーザーの数")
+        parser.add_argument('--duration', type=float, default=60.0,
+                            help="実行時間（秒）")
+        parser.add_argument('--requests', type=int,
+                            help="仮想ユーザー1人あたりの操作の回数"
+                                 "（指定した場合は回数に達した時点で終了する）")
+        parser.add_argument('--mix', nargs='+',
+                            help="操作の割合（例: index=40 register=30 edit=10 "
+                                 "csv_upload=5 statistics=15）")
+        parser.add_argument('--think-time', type=float, default=0.0,
+                            help="操作の間の待ち時間の上限（秒）")
+        parser.add_argument('--pages', type=int, default=3,
+                            help="index で開く一覧のページ数")
+        parser.add_argument('--csv-rows', type=int, default=20,
+                            help="csv_upload でアップロードするCSVの行数")
+        parser.add_argument('--timeout', type=float, default=30.0,
+                            help="1リクエストの応答を待つ時間（秒）")
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--output', default='loadtest_results.json',
+                            help="結果を保存するJSONファイル")
+        parser.add_argument('--baseline',
+                            help="比較するベースライン（以前の結果のJSONファイル）")
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help="性能劣化とみなす p95 の増加率")
+        parser.add_argument('--username',
+                            help="ログインするユーザー（既定は最初のスーパーユーザー）")
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix']) if options['mix'] else DEFAULT_MIX
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['users'] < 1:
+            raise CommandError("--users は1以上を指定して下さい")
+        user = self.get_user(options['username'])
+        items = list(Item.objects.active().order_by('id')
+                                 .values_list('id', 'name'))
+        if not items:
+            raise CommandError("果物が登録されていません")
+        # edit で更新する販売情報（新しいものから）
+        sale_ids = list(Sale.objects.order_by('-saled_at', '-id')
+                                    .values_list('id', flat=True)[:1000])
+
+        load_test = LoadTest(
+            options['url'],
+            [create_session(user) for _ in range(options['users'])],
+            items, sale_ids, mix,
+            duration=options['duration'],
+            requests=options['requests'],
+            think_time=options['think_time'],
+            seed=options['seed'],
+            pages=options['pages'],
+            csv_rows=options['csv_rows'],
+            timeout=options['timeout'],
+        )
+        results = load_test.run()
+
+        self.stdout.write(
+            "{:<26} {:>7} {:>8} {:>9} {:>9} {:>9} {:>6} {:>5}".format(
+                'endpoint', 'count', 'req/s', 'p50(ms)', 'p95(ms)', 'p99(ms)',
+                'errors', 'locks'))
+        for endpoint, result in results.items():
+            self.stdout.write(
+                "{:<26} {:>7} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>6} {:>5}"
+                .format(endpoint, result['requests'], result['throughput'],
+                        result['p50_ms'] or 0.0, result['p95_ms'] or 0.0,
+                        result['p99_ms'] or 0.0, result['errors'],
+                        result['lock_timeouts']))
+
+        with open(options['output'], 'w') as f:
+            json.dump({
+                'created_at': now().isoformat(),
+                'config': {
+                    'url': options['url'],
+                    'users': options['users'],
+                    'duration': options['duration'],
+                    'requests': options['requests'],
+                    'mix': mix,
+                    'think_time': options['think_time'],
+                    'pages': options['pages'],
+                    'csv_rows': options['csv_rows'],
+                    'seed': options['seed'],
+                },
+                'environment': {
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'sales': Sale.objects.count(),
+                    'items': len(items),
+                },
+                'elapsed': load_test.elapsed,
+                'results': results,
+            }, f, ensure_ascii=False, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+            regressions = compare(results, baseline, options['threshold'])
+            for endpoint, reason in regressions:
+                self.stderr.write("{}: {}".format(endpoint, reason))
+            if regressions:
+                raise CommandError(
+                    "{}件の性能劣化を検出しました".format(len(regressions)))
+            self.stdout.write(self.style.SUCCESS("ベースラインからの性能劣化はありません"))
+
+    def get_user(self, username):
+        User = get_user_model()
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError("ユーザー {} が存在しません".format(username))
+        user = User.objects.filter(is_superuser=True).order_by('id').first()
+        if user is None:
+            raise CommandError("--username を指定するか、スーパーユーザーを作成して下さい")
+        return user
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.sales.models import SALE_ROLLUPS
+
+
+class Command(BaseCommand):
+    help = "販売情報から時間帯別・日別・週別・月別売上集計を再構築（または検証）する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help="再構築せず、集計テーブルと販売情報の食い違いを報告する")
+
+    def handle(self, *args, **options):
+        rollups = SALE_ROLLUPS
+        if options['verify']:
+            mismatched = 0
+            for rollup in rollups:
+                keys = rollup.verify()
+                mismatched += len(keys)
+                for period, item_id in keys:
+                    self.stdout.write("{}: period={} item_id={}".format(
+                        rollup.__name__, period, item_id))
+            if mismatched:
+                raise CommandError(
+                    "{}件の集計が販売情報と一致しません".format(mismatched))
+            self.stdout.write(self.style.SUCCESS("集計は販売情報と一致しています"))
+            return
+
+        for rollup in rollups:
+            count = rollup.rebuild()
+            self.stdout.write(self.style.SUCCESS(
+                "{}: {}件を再構築しました".format(rollup.__name__, count)))
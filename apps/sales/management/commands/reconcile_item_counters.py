@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.sales.models import Sale
+
+
+class Command(BaseCommand):
+    help = "果物ごとの販売実績（累計個数・累計売上・最終販売日時）を販売情報から修復（または検証）する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help="修復せず、販売実績と販売情報の食い違いを報告する")
+
+    def handle(self, *args, **options):
+        mismatched = Sale.reconcile_item_counters(verify=options['verify'])
+        for item_id, stored, counter in mismatched:
+            self.stdout.write("item_id={} 販売実績={} 販売情報={}".format(
+                item_id, stored, counter))
+
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS("販売実績は販売情報と一致しています"))
+        elif options['verify']:
+            raise CommandError(
+                "{}件の果物の販売実績が販売情報と一致しません".format(len(mismatched)))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                "{}件の果物の販売実績を修復しました".format(len(mismatched))))
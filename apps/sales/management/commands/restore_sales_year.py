@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.sales import archive
+
+
+class Command(BaseCommand):
+    help = "アーカイブDBの販売情報を稼働中のDBへ戻す"
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int)
+        parser.add_argument('--chunk-size', type=int,
+                            default=archive.ARCHIVE_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            result = archive.restore_year(options['year'],
+                                          options['chunk_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            "{}年の販売情報{}件を稼働中のDBへ戻しました（{:.1f}秒）".format(
+                result.year, result.moved, result.elapsed)))
@@ -0,0 +1,45 @@
+import multiprocessing
+from django.core.management.base import BaseCommand
+from django.db import connections
+from apps.sales.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = ("CSV一括登録ジョブ（ImportJob）・果物の削除ジョブ（ItemPurgeJob）を"
+            "処理するワーカーを起動する")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=2, help="ワーカープロセス数")
+        parser.add_argument(
+            '--poll-interval', type=float, default=2.0,
+            help="待機中のジョブが無いときの確認間隔（秒）")
+        parser.add_argument(
+            '--once', action='store_true',
+            help="待機中のジョブを処理し終えたら終了する")
+
+    def handle(self, *args, **options):
+        kwargs = {
+            'poll_interval': options['poll_interval'],
+            'once': options['once'],
+        }
+        if options['workers'] <= 1:
+            run_worker(**kwargs)
+            return
+
+        # 親プロセスのDB接続を子プロセスへ引き継がない
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=run_worker, kwargs=kwargs)
+            for _ in range(options['workers'])
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
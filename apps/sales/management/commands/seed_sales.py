@@ -0,0 +1,76 @@
+import datetime
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+from apps.items.models import Item, ItemCatalogue
+from apps.sales import report_cache
+from apps.sales.models import Sale, SALE_ROLLUPS
+
+
+class Command(BaseCommand):
+    help = "性能測定用の果物・販売情報を一括生成する"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=50,
+                            help="果物の件数（既存の果物を含む）")
+        parser.add_argument('--sales', type=int, default=100000,
+                            help="生成する販売情報の件数")
+        parser.add_argument('--days', type=int, default=365,
+                            help="販売日時を分布させる日数（今日から遡る）")
+        parser.add_argument('--skew', type=float, default=1.0,
+                            help="果物ごとの売れ行きの偏り（Zipf分布の指数, 0で均等）")
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        started = time.monotonic()
+
+        items = self.ensure_items(options['items'], rng)
+        # 人気順位に応じた重み（Zipf分布）
+        weights = [1 / (rank ** options['skew'])
+                   for rank in range(1, len(items) + 1)]
+        span = options['days'] * 24 * 60 * 60
+        end = now()
+
+        remaining = options['sales']
+        with transaction.atomic():
+            while remaining > 0:
+                size = min(remaining, options['batch_size'])
+                chosen = rng.choices(items, weights=weights, k=size)
+                Sale.objects.bulk_create([
+                    Sale(
+                        item_id=item.id,
+                        item_num=item_num,
+                        amount=item.price * item_num,
+                        saled_at=end - datetime.timedelta(
+                            seconds=rng.randrange(span)),
+                    )
+                    for item, item_num in zip(
+                        chosen, (rng.randint(1, 10) for _ in chosen))
+                ])
+                remaining -= size
+            # bulk_create は集計テーブル・販売実績を更新しないため、
+            # 生成後に作り直し、期間別売上情報・APIのキャッシュを無効にする
+            for rollup in SALE_ROLLUPS:
+                rollup.rebuild()
+            Sale.reconcile_item_counters()
+            report_cache.bump_data_version()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            "果物{}件・販売情報{}件を生成しました（{:.1f}秒）".format(
+                len(items), options['sales'], elapsed)))
+
+    def ensure_items(self, count, rng):
+        items = list(Item.objects.order_by('id')[:count])
+        created = Item.objects.bulk_create([
+            Item(name="果物{:04d}".format(i), price=rng.randrange(50, 1000, 10))
+            for i in range(len(items), count)
+        ])
+        if created:
+            # bulk_create は Item.save を通らないため、果物マスタのキャッシュを更新する
+            ItemCatalogue.invalidate()
+        return list(Item.objects.order_by('id')[:count])
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.sales import archive
+
+
+class Command(BaseCommand):
+    help = "アーカイブDBと集計テーブルを突き合わせて検証する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'year', type=int, nargs='*',
+            help="検証する年（省略した場合はアーカイブ済みのすべての年）")
+
+    def handle(self, *args, **options):
+        years = options['year'] or archive.archived_years()
+        failed = False
+        for year in years:
+            problems = archive.verify_year(year)
+            for problem in problems:
+                self.stderr.write("{}: {}".format(year, problem))
+            if problems:
+                failed = True
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    "{}年のアーカイブは正常です".format(year)))
+        if failed:
+            raise CommandError("アーカイブの検証に失敗しました")
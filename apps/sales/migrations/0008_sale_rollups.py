@@ -0,0 +1,95 @@
+# Generated by Django 2.1.4 on 2026-10-18 18:16
+
+from collections import defaultdict
+from django.db import migrations, models
+from django.utils.timezone import localtime
+import django.db.models.deletion
+
+
+def build_rollups(apps, schema_editor):
+    # 既存の販売情報から日別・月別集計を作成
+    Sale = apps.get_model('sales', 'Sale')
+    DailySaleRollup = apps.get_model('sales', 'DailySaleRollup')
+    MonthlySaleRollup = apps.get_model('sales', 'MonthlySaleRollup')
+
+    daily = defaultdict(lambda: [0, 0, 0])
+    monthly = defaultdict(lambda: [0, 0, 0])
+    sales = Sale.objects.values_list(
+        'item_id', 'saled_at', 'amount', 'item_num').iterator()
+    for item_id, saled_at, amount, item_num in sales:
+        date = localtime(saled_at).date()
+        for bucket in (daily[(date, item_id)],
+                       monthly[(date.replace(day=1), item_id)]):
+            bucket[0] += amount
+            bucket[1] += item_num
+            bucket[2] += 1
+
+    for model, buckets in ((DailySaleRollup, daily),
+                           (MonthlySaleRollup, monthly)):
+        model.objects.bulk_create((
+            model(period=period, item_id=item_id, amount=amount,
+                  item_num=item_num, sale_count=count)
+            for (period, item_id), (amount, item_num, count)
+            in buckets.items()
+        ), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0001_initial'),
+        ('sales', '0007_auto_20181229_1521'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sale',
+            name='amount',
+            field=models.PositiveIntegerField(blank=True, verbose_name='売上'),
+        ),
+        migrations.CreateModel(
+            name='MonthlySaleRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True,
+                                        primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(verbose_name='期間')),
+                ('amount', models.BigIntegerField(
+                    default=0, verbose_name='売上')),
+                ('item_num', models.BigIntegerField(
+                    default=0, verbose_name='個数')),
+                ('sale_count', models.PositiveIntegerField(
+                    default=0, verbose_name='件数')),
+                ('item', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, to='items.Item', verbose_name='果物')),
+            ],
+            options={
+                'verbose_name': '月別売上集計',
+                'verbose_name_plural': '月別売上集計',
+                'abstract': False,
+                'unique_together': {('period', 'item')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySaleRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True,
+                                        primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(verbose_name='期間')),
+                ('amount', models.BigIntegerField(
+                    default=0, verbose_name='売上')),
+                ('item_num', models.BigIntegerField(
+                    default=0, verbose_name='個数')),
+                ('sale_count', models.PositiveIntegerField(
+                    default=0, verbose_name='件数')),
+                ('item', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, to='items.Item', verbose_name='果物')),
+            ],
+            options={
+                'verbose_name': '日別売上集計',
+                'verbose_name_plural': '日別売上集計',
+                'abstract': False,
+                'unique_together': {('period', 'item')},
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
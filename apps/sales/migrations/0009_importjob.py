@@ -0,0 +1,52 @@
+# Generated by Django 2.1.4 on 2026-10-18 09:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sales', '0008_sale_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True,
+                 primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(
+                    upload_to='sales_imports/%Y/%m/%d/', verbose_name='CSVファイル')),
+                ('status', models.CharField(choices=[('queued', '待機中'), ('running', '処理中'), ('done', '完了'), (
+                    'failed', '失敗')], db_index=True, default='queued', max_length=10, verbose_name='状態')),
+                ('total_rows', models.PositiveIntegerField(
+                    blank=True, null=True, verbose_name='総行数')),
+                ('rows_done', models.PositiveIntegerField(
+                    default=0, verbose_name='処理済み行数')),
+                ('rows_created', models.PositiveIntegerField(
+                    default=0, verbose_name='登録件数')),
+                ('rows_failed', models.PositiveIntegerField(
+                    default=0, verbose_name='エラー行数')),
+                ('errors', models.TextField(blank=True,
+                 default='[]', verbose_name='エラー行')),
+                ('message', models.TextField(blank=True, verbose_name='メッセージ')),
+                ('worker', models.CharField(blank=True,
+                 max_length=100, verbose_name='ワーカー')),
+                ('created_at', models.DateTimeField(
+                    auto_now_add=True, verbose_name='登録日時')),
+                ('started_at', models.DateTimeField(
+                    blank=True, null=True, verbose_name='開始日時')),
+                ('finished_at', models.DateTimeField(
+                    blank=True, null=True, verbose_name='終了日時')),
+                ('created_by', models.ForeignKey(blank=True, null=True,
+                 on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='登録者')),
+            ],
+            options={
+                'verbose_name': 'CSV一括登録ジョブ',
+                'verbose_name_plural': 'CSV一括登録ジョブ',
+            },
+        ),
+    ]
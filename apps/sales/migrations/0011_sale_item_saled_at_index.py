@@ -0,0 +1,18 @@
+# Generated by Django 2.1.4 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0010_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(
+                fields=['item', 'saled_at'], name='sales_sale_item_saled_at_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.1.4 on 2026-10-18 09:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0011_sale_item_saled_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='import_job',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                                    related_name='sales', to='sales.ImportJob', verbose_name='一括登録ジョブ'),
+        ),
+    ]
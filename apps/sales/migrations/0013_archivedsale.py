@@ -0,0 +1,26 @@
+# Generated by Django 2.1.4 on 2026-10-18 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0012_sale_import_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedSale',
+            fields=[
+                ('id', models.AutoField(auto_created=True,
+                 primary_key=True, serialize=False, verbose_name='ID')),
+                ('item_num', models.PositiveIntegerField(verbose_name='個数')),
+                ('amount', models.PositiveIntegerField(verbose_name='売上')),
+                ('saled_at', models.DateTimeField(verbose_name='販売日時')),
+            ],
+            options={
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 2.1.4 on 2026-10-18 09:46
+
+import datetime
+from collections import defaultdict
+from django.db import migrations, models
+from django.utils.timezone import localtime
+import django.db.models.deletion
+
+
+def build_rollups(apps, schema_editor):
+    # 既存の販売情報から時間帯別・週別集計を作成
+    # （アーカイブDBの販売情報は manage.py rebuild_sale_rollups で集計する）
+    Sale = apps.get_model('sales', 'Sale')
+    HourlySaleRollup = apps.get_model('sales', 'HourlySaleRollup')
+    WeeklySaleRollup = apps.get_model('sales', 'WeeklySaleRollup')
+
+    hourly = defaultdict(lambda: [0, 0, 0])
+    weekly = defaultdict(lambda: [0, 0, 0])
+    sales = Sale.objects.values_list(
+        'item_id', 'saled_at', 'amount', 'item_num').iterator()
+    for item_id, saled_at, amount, item_num in sales:
+        local = localtime(saled_at)
+        hour = local.replace(minute=0, second=0, microsecond=0)
+        date = local.date()
+        week = date - datetime.timedelta(days=date.weekday())
+        for bucket in (hourly[(hour, item_id)], weekly[(week, item_id)]):
+            bucket[0] += amount
+            bucket[1] += item_num
+            bucket[2] += 1
+
+    for model, buckets in ((HourlySaleRollup, hourly),
+                           (WeeklySaleRollup, weekly)):
+        model.objects.bulk_create((
+            model(period=period, item_id=item_id, amount=amount,
+                  item_num=item_num, sale_count=count)
+            for (period, item_id), (amount, item_num, count)
+            in buckets.items()
+        ), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0002_keyset_pagination_indexes'),
+        ('sales', '0013_archivedsale'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeeklySaleRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True,
+                 primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(verbose_name='期間')),
+                ('amount', models.BigIntegerField(default=0, verbose_name='売上')),
+                ('item_num', models.BigIntegerField(default=0, verbose_name='個数')),
+                ('sale_count', models.PositiveIntegerField(
+                    default=0, verbose_name='件数')),
+                ('item', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, to='items.Item', verbose_name='果物')),
+            ],
+            options={
+                'verbose_name': '週別売上集計',
+                'verbose_name_plural': '週別売上集計',
+                'abstract': False,
+                'unique_together': {('period', 'item')},
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlySaleRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True,
+                 primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.BigIntegerField(default=0, verbose_name='売上')),
+                ('item_num', models.BigIntegerField(default=0, verbose_name='個数')),
+                ('sale_count', models.PositiveIntegerField(
+                    default=0, verbose_name='件数')),
+                ('period', models.DateTimeField(verbose_name='期間')),
+                ('item', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, to='items.Item', verbose_name='果物')),
+            ],
+            options={
+                'verbose_name': '時間帯別売上集計',
+                'verbose_name_plural': '時間帯別売上集計',
+                'abstract': False,
+                'unique_together': {('period', 'item')},
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
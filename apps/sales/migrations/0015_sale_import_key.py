@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0014_hourly_weekly_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='rows_duplicated',
+            field=models.PositiveIntegerField(default=0, verbose_name='重複件数'),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='import_key',
+            field=models.CharField(
+                blank=True, editable=False, max_length=40, null=True, unique=True, verbose_name='登録キー'),
+        ),
+    ]
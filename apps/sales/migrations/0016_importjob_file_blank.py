@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0015_sale_import_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='importjob',
+            name='file',
+            field=models.FileField(
+                blank=True, upload_to='sales_imports/%Y/%m/%d/', verbose_name='CSVファイル'),
+        ),
+    ]
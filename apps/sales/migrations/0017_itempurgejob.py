@@ -0,0 +1,48 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('items', '0004_item_deleted_at'),
+        ('sales', '0016_importjob_file_blank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemPurgeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True,
+                 primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', '待機中'), ('running', '処理中'), ('done', '完了'), (
+                    'failed', '失敗')], db_index=True, default='queued', max_length=10, verbose_name='状態')),
+                ('message', models.TextField(blank=True, verbose_name='メッセージ')),
+                ('worker', models.CharField(blank=True,
+                 max_length=100, verbose_name='ワーカー')),
+                ('created_at', models.DateTimeField(
+                    auto_now_add=True, verbose_name='登録日時')),
+                ('started_at', models.DateTimeField(
+                    blank=True, null=True, verbose_name='開始日時')),
+                ('finished_at', models.DateTimeField(
+                    blank=True, null=True, verbose_name='終了日時')),
+                ('item_name', models.CharField(max_length=190, verbose_name='果物の名称')),
+                ('total_sales', models.PositiveIntegerField(
+                    blank=True, null=True, verbose_name='販売情報の件数')),
+                ('sales_deleted', models.PositiveIntegerField(
+                    default=0, verbose_name='削除済みの件数')),
+                ('created_by', models.ForeignKey(blank=True, null=True,
+                 on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='登録者')),
+                ('item', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                 related_name='purge_jobs', to='items.Item', verbose_name='果物')),
+            ],
+            options={
+                'verbose_name': '果物の削除ジョブ',
+                'verbose_name_plural': '果物の削除ジョブ',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0017_itempurgejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='最終応答日時'),
+        ),
+        migrations.AddField(
+            model_name='itempurgejob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='最終応答日時'),
+        ),
+    ]
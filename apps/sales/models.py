@@ -1,11 +1,146 @@
-from django.utils.timezone import localtime
+from django.utils.timezone import (
+    now, localtime, localdate, make_aware, get_current_timezone, utc)
 import datetime
-from django.db import models
+import hashlib
+import json
+from django.conf import settings
+from django.db import models, transaction, connections, router, IntegrityError
 from django.shortcuts import get_object_or_404
-from django.db.models import Sum
+from django.db.models import Sum, Count, Max, F, Q
+from django.db.models.functions import (
+    TruncHour, TruncDay, TruncWeek, TruncMonth)
 from dateutil.relativedelta import relativedelta
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, namedtuple, defaultdict
 from apps.items.models import Item
+from . import report_cache
+
+YearMonth = namedtuple('YearMonth', ('year', 'month'))
+YearWeek = namedtuple('YearWeek', ('year', 'week'))
+YearMonthDay = namedtuple('YearMonthDay', ('year', 'month', 'day'))
+YearMonthDayHour = namedtuple(
+    'YearMonthDayHour', ('year', 'month', 'day', 'hour'))
+
+
+def year_month(date):
+    return YearMonth(year=date.year, month=date.month)
+
+
+def year_week(date):
+    # ISO週（月曜日始まり）
+    year, week, _ = date.isocalendar()
+    return YearWeek(year=year, week=week)
+
+
+def year_month_day(date):
+    return YearMonthDay(year=date.year, month=date.month, day=date.day)
+
+
+def year_month_day_hour(dt):
+    return YearMonthDayHour(
+        year=dt.year, month=dt.month, day=dt.day, hour=dt.hour)
+
+
+def recent_hours(span):
+    # 現在の時間帯から遡ってspan時間分の時刻（ローカル時間）を新しい順に返す
+    this_hour = localtime().replace(minute=0, second=0, microsecond=0)
+    return [localtime(this_hour - datetime.timedelta(hours=i))
+            for i in range(span)]
+
+
+def recent_days(span):
+    # 今日から遡ってspan日分の日付を新しい順に返す
+    today = localdate()
+    return [today + relativedelta(days=-i) for i in range(span)]
+
+
+def start_of_week(date):
+    # ISO週の初日（月曜日）
+    return date - datetime.timedelta(days=date.weekday())
+
+
+def recent_weeks(span):
+    # 今週から遡ってspan週分の週の初日を新しい順に返す
+    this_week = start_of_week(localdate())
+    return [this_week - datetime.timedelta(weeks=i) for i in range(span)]
+
+
+def recent_months(span):
+    # 今月から遡ってspanヶ月分の月初日を新しい順に返す
+    this_month = localdate().replace(day=1)
+    return [this_month + relativedelta(months=-i) for i in range(span)]
+
+
+def start_of_day(date):
+    # ローカル時間での日付の開始時刻（aware datetime）
+    return make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def start_of_hour(date, hour):
+    # ローカル時間での日付・時の開始時刻（aware datetime）
+    return make_aware(datetime.datetime.combine(date, datetime.time(hour)))
+
+
+def build_reports(periods, report_key, rows):
+    """
+    期間・果物単位の集計行 (期間, 果物名, 売上, 個数) から
+    期間別売上情報dict（Sale.get_recent_monthly_reports の形式）を作る
+    """
+    reports = OrderedDict()
+    for period in periods:
+        reports[report_key(period)] = {
+            'amount': 0,
+            'item_reports': {}
+        }
+    for period, item_name, amount, item_num in rows:
+        key = report_key(period)
+        # 対象期間外の集計行であれば何も処理しない
+        if key not in reports:
+            continue
+        reports[key]['amount'] += amount
+        item_report = reports[key]['item_reports'].setdefault(
+            item_name, {'item_num': 0, 'amount': 0})
+        item_report['item_num'] += item_num
+        item_report['amount'] += amount
+    return reports
+
+
+# 販売情報の増減（販売日・時・果物単位）。件数・売上・個数は符号付き
+# saled_at は販売日時（まとめた増減では、その中で最も新しい販売日時）
+SaleDelta = namedtuple(
+    'SaleDelta',
+    ('item_id', 'date', 'hour', 'amount', 'item_num', 'count', 'saled_at'))
+
+SALE_DELTA_FIELDS = ('item_id', 'saled_at', 'amount', 'item_num')
+
+
+def sale_delta(item_id, saled_at, amount, item_num, sign=1):
+    # 1件の販売情報を、販売日・時（ローカル時間）単位の増減に変換
+    local = localtime(saled_at)
+    return SaleDelta(
+        item_id=item_id,
+        date=local.date(),
+        hour=local.hour,
+        amount=sign * amount,
+        item_num=sign * item_num,
+        count=sign,
+        saled_at=saled_at,
+    )
+
+
+class SaleQuerySet(models.QuerySet):
+
+    def delete(self):
+        # 一括削除でも集計テーブルを更新する
+        with transaction.atomic(using=self.db):
+            deltas = [sale_delta(*values, sign=-1)
+                      for values in (self.values_list(*SALE_DELTA_FIELDS)
+                                         .iterator())]
+            result = super().delete()
+            Sale.record_deltas(deltas)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
 
 
 class Sale(models.Model):
@@ -13,16 +148,186 @@ class Sale(models.Model):
     item_num = models.PositiveIntegerField("個数")
     amount = models.PositiveIntegerField("売上", blank=True)
     saled_at = models.DateTimeField("販売日時")
+    # CSV一括登録ジョブで登録した場合のジョブ（一括操作の対象の絞り込み用）
+    import_job = models.ForeignKey(
+        'ImportJob', verbose_name="一括登録ジョブ", null=True, blank=True,
+        editable=False, related_name='sales', on_delete=models.SET_NULL)
+    # CSV一括登録した行の内容から作るキー（同じCSVの再登録で重複させないため）
+    # 画面から登録した販売情報はNone
+    import_key = models.CharField(
+        "登録キー", max_length=40, unique=True, null=True, blank=True,
+        editable=False)
+
+    objects = SaleQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # 一覧のカーソル方式ページネーション・期間指定の検索用
+            models.Index(fields=['saled_at', 'id'],
+                         name='sales_sale_saled_at_id_idx'),
+            # 果物・期間指定の検索用
+            models.Index(fields=['item', 'saled_at'],
+                         name='sales_sale_item_saled_at_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         # amountフィールドが空欄の時(ページからの新規登録)は、単価*個数を売上とする
         if self.amount is None:
-            self.amount = self.item.price * self.item_num
-        super().save(*args, **kwargs)
+            item = Item.get_cached_or_none(self.item_id) or self.item
+            self.amount = item.price * self.item_num
+        with transaction.atomic():
+            # 更新時は変更前の値を集計から差し引く
+            deltas = self._stored_deltas(sign=-1)
+            super().save(*args, **kwargs)
+            deltas.append(sale_delta(
+                self.item_id, self.saled_at, self.amount, self.item_num))
+            Sale.record_deltas(deltas)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            deltas = self._stored_deltas(sign=-1)
+            result = super().delete(*args, **kwargs)
+            Sale.record_deltas(deltas)
+        return result
+
+    def _stored_deltas(self, sign):
+        # DBに保存されている（変更前の）値から増減を作る
+        if self.pk is None or self._state.adding:
+            return []
+        stored = (Sale.objects.select_for_update()
+                              .filter(pk=self.pk)
+                              .values_list(*SALE_DELTA_FIELDS)
+                              .first())
+        if stored is None:
+            return []
+        return [sale_delta(*stored, sign=sign)]
+
+    @staticmethod
+    def make_import_key(item_id, item_num, amount, saled_at, occurrence=0):
+        """
+        CSVの行の内容（果物・個数・売上・販売日時）から登録キーを作る
+        同じCSVに同じ内容の行が複数ある場合は、何番目の行か（occurrence）で区別する
+        """
+        content = '{}|{}|{}|{}|{}'.format(
+            item_id, item_num, amount,
+            saled_at.astimezone(utc).strftime('%Y-%m-%dT%H:%M:%S'), occurrence)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    @classmethod
+    def find_existing_import_keys(cls, keys, start=None, end=None,
+                                  chunk_size=500):
+        """
+        keys のうち、既に登録されている登録キーの集合を返す
+        稼働中のDBと、[start, end) と重なる年のアーカイブDBを調べる
+        """
+        keys = list(keys)
+        existing = set()
+        for queryset in cls.sources(start, end):
+            for i in range(0, len(keys), chunk_size):
+                existing.update(queryset.filter(
+                    import_key__in=keys[i:i + chunk_size],
+                ).values_list('import_key', flat=True))
+        return existing
+
+    @staticmethod
+    def record_deltas(deltas):
+        """
+        販売情報の登録・更新・削除（一括処理を含む）による増減を
+        集計テーブルへ反映する
+        """
+        deltas = list(deltas)
+        if not deltas:
+            return
+        for rollup in SALE_ROLLUPS:
+            rollup.apply_deltas(deltas)
+        Sale.record_item_counters(deltas)
+        report_cache.bump_data_version()
+
+    @staticmethod
+    def record_item_counters(deltas):
+        """
+        果物ごとの販売実績（累計個数・累計売上・最終販売日時）に増減を反映する
+        販売情報が減った果物は、最終販売日時を販売情報から求め直す
+        """
+        totals = {}
+        for delta in deltas:
+            total = totals.setdefault(delta.item_id, [0, 0, None, False])
+            total[0] += delta.item_num
+            total[1] += delta.amount
+            if delta.count > 0:
+                if total[2] is None or delta.saled_at > total[2]:
+                    total[2] = delta.saled_at
+            elif delta.count < 0:
+                total[3] = True
+        for item_id, (units, revenue, latest, removed) in totals.items():
+            if units or revenue or latest is not None:
+                Item.add_sales(item_id, units, revenue, latest)
+            if removed:
+                Item.set_last_saled_at(
+                    item_id, Sale.get_last_saled_at(item_id))
+
+    @classmethod
+    def compute_item_counters(cls):
+        """
+        販売情報（アーカイブDBを含む）から果物ごとの販売実績を集計する
+        => {果物ID: [累計個数, 累計売上, 最終販売日時]}
+        """
+        counters = {}
+        for queryset in cls.sources():
+            rows = (queryset.order_by().values('item_id')
+                    .annotate(units=Sum('item_num'), revenue=Sum('amount'),
+                              latest=Max('saled_at')))
+            for row in rows:
+                counter = counters.setdefault(row['item_id'], [0, 0, None])
+                counter[0] += row['units']
+                counter[1] += row['revenue']
+                if counter[2] is None or row['latest'] > counter[2]:
+                    counter[2] = row['latest']
+        return counters
+
+    @classmethod
+    def reconcile_item_counters(cls, verify=False):
+        """
+        果物ごとの販売実績を販売情報から集計し直し、食い違う果物を修復する
+        （verify の場合は修復しない）
+        => [(果物ID, 販売実績, 販売情報からの集計), ...]
+        """
+        with transaction.atomic():
+            expected = cls.compute_item_counters()
+            mismatched = []
+            for item_id, units, revenue, latest in Item.objects.values_list(
+                    'id', 'units_sold', 'revenue', 'last_saled_at'):
+                counter = expected.get(item_id, [0, 0, None])
+                if [units, revenue, latest] != counter:
+                    mismatched.append((item_id, [units, revenue, latest],
+                                       counter))
+            if not verify:
+                for item_id, stored, counter in mismatched:
+                    # 果物マスタのキャッシュは更新しない（Item.add_sales と同じ）
+                    models.QuerySet.update(
+                        Item.objects.filter(id=item_id),
+                        units_sold=counter[0], revenue=counter[1],
+                        last_saled_at=counter[2])
+        return mismatched
+
+    @classmethod
+    def get_last_saled_at(cls, item_id):
+        # 果物の最終販売日時（アーカイブDBを含む。販売情報が無ければNone）
+        # 稼働中のDB、新しい年のアーカイブDBの順に探す
+        sources = cls.sources()
+        for queryset in sources[:1] + sources[:0:-1]:
+            latest = (queryset.filter(item_id=item_id)
+                              .order_by('-saled_at')
+                              .values_list('saled_at', flat=True)
+                              .first())
+            if latest is not None:
+                return latest
+        return None
 
     @classmethod
     def get_all_object(cls):
-        return cls.objects.all()
+        # 削除中の果物（販売情報の削除を待っている）の販売情報は含めない
+        return cls.objects.filter(item__deleted_at__isnull=True)
 
     @classmethod
     def get_by_id_or_404(cls, id):
@@ -32,18 +337,31 @@ class Sale(models.Model):
     def delete_by_id(cls, id):
         cls.objects.get(id=id).delete()
 
+    @classmethod
+    def find_in_range(cls, start, end):
+        # [start, end) の販売情報を取得（saled_at のインデックスを使う）
+        return cls.objects.filter(saled_at__gte=start, saled_at__lt=end)
+
+    @classmethod
+    def find_by_item_in_range(cls, item, start, end):
+        # 指定された果物の [start, end) の販売情報を取得
+        return cls.find_in_range(start, end).filter(item=item)
+
     @classmethod
     def find_by_year_month(cls, year, month):
         # 指定された年月から、全ての販売情報を取得
-        return (cls.objects.filter(saled_at__year=year)
-                           .filter(saled_at__month=month))
+        first_day = datetime.date(year, month, 1)
+        return cls.find_in_range(
+            start_of_day(first_day),
+            start_of_day(first_day + relativedelta(months=1)))
 
     @classmethod
     def find_by_year_month_day(cls, year, month, day):
         # 指定された年月日から、全ての販売情報を取得
-        return (cls.objects.filter(saled_at__year=year)
-                           .filter(saled_at__month=month)
-                           .filter(saled_at__day=day))
+        date = datetime.date(year, month, day)
+        return cls.find_in_range(
+            start_of_day(date),
+            start_of_day(date + relativedelta(days=1)))
 
     @staticmethod
     def total_amount_of_queryset(queryset):
@@ -59,13 +377,69 @@ class Sale(models.Model):
             return queryset.aggregate(Sum('item_num'))['item_num__sum']
         return 0
 
+    @staticmethod
+    def sources(start=None, end=None):
+        """
+        [start, end) の販売情報を持つクエリセットのリスト
+        （稼働中のDBと、期間の重なる年のアーカイブDB）を返す
+        find_in_range などは稼働中のDBだけを対象とするため、
+        アーカイブ済みの年も含めて読む場合はこちらを使う
+        """
+        # archive は models を参照するため、ここで読み込む
+        from . import archive
+        return [Sale.objects.all()] + archive.archived_querysets(start, end)
+
     @classmethod
     def get_entire_amount(cls):
-        sales = cls.objects.all()
-        amount = 0
-        for sale in sales:
-            amount += sale.amount
-        return amount
+        return sum(queryset.aggregate(Sum('amount'))['amount__sum'] or 0
+                   for queryset in cls.sources())
+
+    @classmethod
+    def aggregate_by_period(cls, trunc, start, end, queryset=None):
+        """
+        [start, end) の販売情報を、期間（ローカル時間で切り捨て）・果物単位で
+        DB側で集計する（queryset を省略した場合はアーカイブDBも含める）
+        trunc には TruncDay, TruncMonth などを指定する
+        """
+        querysets = ([queryset] if queryset is not None
+                     else cls.sources(start, end))
+        totals = defaultdict(lambda: [0, 0, 0])
+        for queryset in querysets:
+            rows = (queryset.filter(saled_at__gte=start, saled_at__lt=end)
+                            .annotate(period=trunc(
+                                'saled_at', tzinfo=get_current_timezone()))
+                            .values('period', 'item_id')
+                            .annotate(total_amount=Sum('amount'),
+                                      total_item_num=Sum('item_num'),
+                                      sale_count=Count('id'))
+                            .order_by())
+            for row in rows:
+                total = totals[(row['period'], row['item_id'])]
+                total[0] += row['total_amount']
+                total[1] += row['total_item_num']
+                total[2] += row['sale_count']
+        return [
+            {'period': period, 'item_id': item_id, 'total_amount': amount,
+             'total_item_num': item_num, 'sale_count': count}
+            for (period, item_id), (amount, item_num, count)
+            in sorted(totals.items())
+        ]
+
+    @classmethod
+    def _get_recent_reports(cls, trunc, periods, end, report_key):
+        # periods（新しい順）の先頭から end までを集計する
+        if not periods:
+            return OrderedDict()
+        rows = cls.aggregate_by_period(
+            trunc, start_of_day(periods[-1]), start_of_day(end))
+        items = Item.get_catalogue().by_id
+        return build_reports(periods, report_key, (
+            (row['period'].date(), items[row['item_id']].name,
+             row['total_amount'], row['total_item_num'])
+            for row in rows
+            # アーカイブDBには削除済みの果物の販売情報が残りうる
+            if row['item_id'] in items
+        ))
 
     @classmethod
     def get_recent_monthly_reports(cls, span):
@@ -88,53 +462,13 @@ class Sale(models.Model):
                 }
             }
         }
+        対象期間の販売情報だけを、DB側で月・果物単位に集計して取得する
         """
-
-        # 対象月のタプル(yyyy,mm)を作り、monthly_sale_reportsのキーとして設定
-        monthly_sale_reports = OrderedDict()
-        today = datetime.date.today()
-        YearMonth = namedtuple('YearMonth', ('year', 'month'))
-        for i in range(span):
-            day = today + relativedelta(months=-i)
-            year_month = YearMonth(
-                year=day.year,
-                month=day.month
-            )
-            monthly_sale_reports[year_month] = {
-                'amount': 0,
-                'item_reports': {}
-            }
-
-        sales = Sale.objects.all()
-        for sale in sales:
-            # saleの販売日をタプルに変換 => (2018,12)
-            saled_at_date = localtime(sale.saled_at).date()
-            saled_at = YearMonth(
-                year=saled_at_date.year,
-                month=saled_at_date.month,
-            )
-
-            # 対象期間外のsaleであれば何も処理しない
-            if saled_at not in monthly_sale_reports.keys():
-                continue
-
-            # 対象月の売上総額を加算
-            monthly_sale_reports[saled_at]['amount'] += sale.amount
-            # item_reportsにsaleの果物がキーとして存在するとき
-            if (sale.item.name in
-                    monthly_sale_reports[saled_at]['item_reports']):
-                (monthly_sale_reports[saled_at]['item_reports']
-                 [sale.item.name]['item_num']) += sale.item_num
-                (monthly_sale_reports[saled_at]['item_reports']
-                 [sale.item.name]['amount']) += sale.amount
-            # item_reportsにsaleの果物がキーとして存在しないとき
-            else:
-                (monthly_sale_reports[saled_at]
-                 ['item_reports'][sale.item.name]) = {
-                    'item_num': sale.item_num,
-                    'amount': sale.amount
-                }
-        return monthly_sale_reports
+        months = recent_months(span)
+        return cls._get_recent_reports(
+            TruncMonth, months,
+            months[0] + relativedelta(months=1) if months else None,
+            year_month)
 
     @classmethod
     def get_recent_daily_reports(cls, span):
@@ -157,52 +491,627 @@ class Sale(models.Model):
                 }
             }
         }
+        対象期間の販売情報だけを、DB側で日・果物単位に集計して取得する
         """
+        days = recent_days(span)
+        return cls._get_recent_reports(
+            TruncDay, days,
+            days[0] + relativedelta(days=1) if days else None,
+            year_month_day)
+
+
+class SaleRollup(models.Model):
+    """
+    期間・果物単位の売上集計（販売情報の登録・更新・削除時に差分更新する）
+    """
+    item = models.ForeignKey(Item, verbose_name="果物", on_delete=models.CASCADE)
+    period = models.DateField("期間")
+    amount = models.BigIntegerField("売上", default=0)
+    item_num = models.BigIntegerField("個数", default=0)
+    sale_count = models.PositiveIntegerField("件数", default=0)
+
+    class Meta:
+        abstract = True
+        unique_together = ('period', 'item')
+
+    # これより多い期間数の売上情報は、キャッシュを使わずに集計テーブルから取得する
+    cache_max_periods = 62
+    # get_recent_reports で指定できる期間数の上限
+    max_span = 366
 
-        # 対象日のタプル(yyyy,mm,dd)を作り、daily_sale_reportsのキーとして設定
-        daily_sale_reports = OrderedDict()
-        today = datetime.date.today()
-        YearMonthDay = namedtuple('YearMonthDay', ('year', 'month', 'day'))
-        for i in range(span):
-            day = today + relativedelta(days=-i)
-            year_month_day = YearMonthDay(
-                year=day.year,
-                month=day.month,
-                day=day.day
+    @staticmethod
+    def period_of(delta):
+        # 増減（SaleDelta）の販売日・時から集計期間（の初日）を求める
+        raise NotImplementedError
+
+    @staticmethod
+    def period_from_trunc(value):
+        # trunc で切り捨てた販売日時を、集計期間の値に変換する
+        return value.date()
+
+    @classmethod
+    def group_deltas(cls, deltas):
+        # 増減を（期間, 果物）単位でまとめる => {(期間, 果物ID): [売上, 個数, 件数]}
+        buckets = defaultdict(lambda: [0, 0, 0])
+        for delta in deltas:
+            bucket = buckets[(cls.period_of(delta), delta.item_id)]
+            bucket[0] += delta.amount
+            bucket[1] += delta.item_num
+            bucket[2] += delta.count
+        return buckets
+
+    @classmethod
+    def apply_deltas(cls, deltas):
+        buckets = cls.group_deltas(deltas)
+        changed = [(key, values) for key, values in buckets.items()
+                   if any(values)]
+        connection = connections[router.db_for_write(cls)]
+        if cls.supports_upsert(connection):
+            # 件数が減る行は INSERT できない（sale_count の CHECK 制約）ため、
+            # UPDATE で反映する
+            cls.upsert_buckets(connection, [
+                bucket for bucket in changed if bucket[1][2] >= 0])
+            cls.decrement_buckets(connection, [
+                bucket for bucket in changed if bucket[1][2] < 0])
+        else:
+            cls.update_buckets(changed)
+            # 販売情報が無くなった集計行は削除する
+            for (period, item_id), (_, _, count) in changed:
+                if count < 0:
+                    cls.objects.filter(
+                        period=period, item_id=item_id, sale_count=0).delete()
+        report_cache.invalidate(
+            cls.granularity, {period for period, _ in buckets})
+
+    @staticmethod
+    def supports_upsert(connection):
+        # INSERT ... ON CONFLICT DO UPDATE（SQLiteは3.24以降）
+        if connection.vendor == 'postgresql':
+            return True
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 24, 0)
+        return False
+
+    # 1文で書き込む集計行の数（SQLiteの変数の上限 999 に収まるように）
+    upsert_batch_size = 150
+
+    @classmethod
+    def upsert_buckets(cls, connection, changed):
+        """
+        増減を INSERT ... ON CONFLICT DO UPDATE でまとめて反映する
+        （期間, 果物）ごとに UPDATE・INSERT を発行するより文の数が少ない
+        """
+        quote = connection.ops.quote_name
+        table = quote(cls._meta.db_table)
+        period_field = cls._meta.get_field('period')
+        sums = ('amount', 'item_num', 'sale_count')
+        for i in range(0, len(changed), cls.upsert_batch_size):
+            batch = changed[i:i + cls.upsert_batch_size]
+            params = []
+            for (period, item_id), values in batch:
+                params.append(period_field.get_db_prep_value(
+                    period, connection))
+                params.append(item_id)
+                params.extend(values)
+            sql = (
+                'INSERT INTO {table} ({period}, {item}, {columns}) '
+                'VALUES {values} '
+                'ON CONFLICT ({period}, {item}) DO UPDATE SET {updates}'
+            ).format(
+                table=table,
+                period=quote('period'),
+                item=quote('item_id'),
+                columns=', '.join(quote(column) for column in sums),
+                values=', '.join(['(%s, %s, %s, %s, %s)'] * len(batch)),
+                updates=', '.join(
+                    '{0} = {1}.{0} + excluded.{0}'.format(quote(column), table)
+                    for column in sums),
             )
-            daily_sale_reports[year_month_day] = {
-                'amount': 0,
-                'item_reports': {}
-            }
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
 
-        sales = Sale.objects.all()
-        for sale in sales:
-            # saleの販売日をタプルに変換 => (2018,12,31)
-            saled_at_date = localtime(sale.saled_at).date()
-            saled_at = YearMonthDay(
-                year=saled_at_date.year,
-                month=saled_at_date.month,
-                day=saled_at_date.day
+    @classmethod
+    def decrement_buckets(cls, connection, changed):
+        """
+        件数が減る増減を、同じ UPDATE 文の executemany でまとめて反映し、
+        販売情報が無くなった集計行を削除する
+        （販売情報の削除が多いと、集計行ごとにクエリを組み立てる時間がかさむため）
+        """
+        if not changed:
+            return
+        quote = connection.ops.quote_name
+        table = quote(cls._meta.db_table)
+        period_field = cls._meta.get_field('period')
+        keys = [(period_field.get_db_prep_value(period, connection), item_id)
+                for (period, item_id), _ in changed]
+        where = '{} = %s AND {} = %s'.format(quote('period'), quote('item_id'))
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'UPDATE {table} SET {updates} WHERE {where}'.format(
+                    table=table,
+                    updates=', '.join(
+                        '{0} = {0} + %s'.format(quote(column))
+                        for column in ('amount', 'item_num', 'sale_count')),
+                    where=where),
+                [tuple(values) + key
+                 for key, (_, values) in zip(keys, changed)])
+            cursor.executemany(
+                'DELETE FROM {table} WHERE {where} AND {count} = 0'.format(
+                    table=table, where=where, count=quote('sale_count')),
+                keys)
+
+    @classmethod
+    def update_buckets(cls, changed):
+        for (period, item_id), (amount, item_num, count) in changed:
+            rows = cls.objects.filter(period=period, item_id=item_id)
+            updated = rows.update(
+                amount=F('amount') + amount,
+                item_num=F('item_num') + item_num,
+                sale_count=F('sale_count') + count,
             )
+            if updated:
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(
+                        period=period,
+                        item_id=item_id,
+                        amount=amount,
+                        item_num=item_num,
+                        sale_count=count,
+                    )
+            except IntegrityError:
+                # 別のプロセスが同じ行を先に作成した場合
+                rows.update(
+                    amount=F('amount') + amount,
+                    item_num=F('item_num') + item_num,
+                    sale_count=F('sale_count') + count,
+                )
+
+    @classmethod
+    def compute_from_sales(cls, start=None, end=None):
+        """
+        販売情報（アーカイブDBを含む）から集計をやり直す
+        => {(期間, 果物ID): [売上, 個数, 件数]}
+        """
+        items = Item.get_catalogue().by_id
+        buckets = defaultdict(lambda: [0, 0, 0])
+        for queryset in Sale.sources(start, end):
+            if start is not None:
+                queryset = queryset.filter(saled_at__gte=start)
+            if end is not None:
+                queryset = queryset.filter(saled_at__lt=end)
+            rows = (queryset.annotate(period=cls.trunc(
+                                'saled_at', tzinfo=get_current_timezone()))
+                            .values('period', 'item_id')
+                            .annotate(total_amount=Sum('amount'),
+                                      total_item_num=Sum('item_num'),
+                                      sale_count=Count('id'))
+                            .order_by())
+            for row in rows.iterator():
+                # アーカイブDBに残った削除済みの果物の販売情報は集計しない
+                if row['item_id'] not in items:
+                    continue
+                bucket = buckets[(cls.period_from_trunc(row['period']),
+                                  row['item_id'])]
+                bucket[0] += row['total_amount']
+                bucket[1] += row['total_item_num']
+                bucket[2] += row['sale_count']
+        return dict(buckets)
+
+    @classmethod
+    def rebuild(cls):
+        with transaction.atomic():
+            buckets = cls.compute_from_sales()
+            report_cache.invalidate(cls.granularity, set(
+                cls.objects.values_list('period', flat=True).distinct()) |
+                {period for period, _ in buckets})
+            cls.objects.all().delete()
+            cls.objects.bulk_create((
+                cls(period=period,
+                    item_id=item_id,
+                    amount=amount,
+                    item_num=item_num,
+                    sale_count=count)
+                for (period, item_id), (amount, item_num, count)
+                in buckets.items()
+            ), batch_size=500)
+        return len(buckets)
 
-            # 対象期間外のsaleであれば何も処理しない
-            if saled_at not in daily_sale_reports.keys():
+    @classmethod
+    def verify(cls):
+        """
+        集計テーブルと販売情報を突き合わせ、食い違う（期間, 果物ID）を返す
+        """
+        expected = cls.compute_from_sales()
+        stored = {
+            (period, item_id): [amount, item_num, count]
+            for period, item_id, amount, item_num, count
+            in cls.objects.values_list(
+                'period', 'item_id', 'amount', 'item_num', 'sale_count')
+        }
+        return sorted(
+            key for key in set(expected) | set(stored)
+            if expected.get(key) != stored.get(key)
+        )
+
+    @classmethod
+    def get_entire_amount(cls):
+        # 削除中の果物（販売情報の削除を待っている）は含めない
+        return (cls.objects.filter(item__deleted_at__isnull=True)
+                           .aggregate(Sum('amount'))['amount__sum'] or 0)
+
+    @classmethod
+    def get_recent_reports(cls, span):
+        """
+        直近span期間分の売上情報を、Sale.get_recent_monthly_reports
+        と同じ形式のdictで返す
+        """
+        return cls.get_reports(cls.recent_periods(span))
+
+    @classmethod
+    def get_reports(cls, periods):
+        # periods（期間の初日のリスト）の売上情報を get_recent_reports の形式で返す
+        if not periods:
+            return OrderedDict()
+        period_rows = cls.get_period_rows(periods)
+        items = Item.get_catalogue().by_id
+        return build_reports(periods, cls.report_key, (
+            (period, items[item_id].name, amount, item_num)
+            for period in periods
+            for item_id, amount, item_num in period_rows[period]
+            # 削除中の果物（販売情報の削除を待っている）は含めない
+            if item_id in items
+        ))
+
+    @classmethod
+    def get_summary(cls, periods):
+        """
+        periods 全体の合計を、売上情報の1期間分と同じ形式
+        {'amount': 売上, 'item_reports': {果物名: {'item_num', 'amount'}}} で返す
+        果物ごとの合計はDBで求める（期間数によらず果物の数の行だけを読む）
+        """
+        summary = {'amount': 0, 'item_reports': {}}
+        if not periods:
+            return summary
+        items = Item.get_catalogue().by_id
+        rows = (cls.objects.filter(period__gte=min(periods),
+                                   period__lte=max(periods))
+                           .order_by('item_id').values('item_id')
+                           .annotate(amount=Sum('amount'),
+                                     item_num=Sum('item_num'))
+                           .values_list('item_id', 'amount', 'item_num'))
+        for item_id, amount, item_num in rows:
+            # 削除中の果物（販売情報の削除を待っている）は含めない
+            if item_id not in items:
                 continue
+            summary['amount'] += amount
+            summary['item_reports'][items[item_id].name] = {
+                'item_num': item_num, 'amount': amount}
+        return summary
 
-            # 対象日の売上総額を加算
-            daily_sale_reports[saled_at]['amount'] += sale.amount
-            # item_reportsにsaleの果物がキーとして存在するとき
-            if (sale.item.name in
-                    daily_sale_reports[saled_at]['item_reports']):
-                (daily_sale_reports[saled_at]['item_reports']
-                 [sale.item.name]['item_num']) += sale.item_num
-                (daily_sale_reports[saled_at]['item_reports']
-                 [sale.item.name]['amount']) += sale.amount
-            # item_reportsにsaleの果物がキーとして存在しないとき
-            else:
-                (daily_sale_reports[saled_at]
-                 ['item_reports'][sale.item.name]) = {
-                    'item_num': sale.item_num,
-                    'amount': sale.amount
-                }
-        return daily_sale_reports
+    @classmethod
+    def get_period_rows(cls, periods):
+        """
+        期間ごとの集計行 {期間: [(果物ID, 売上, 個数), ...]} を返す
+        キャッシュに無い期間だけを集計テーブルから取得する
+        """
+        if len(periods) > cls.cache_max_periods:
+            return cls.fetch_period_rows(periods)
+        period_rows = report_cache.get_reports(cls.granularity, periods)
+        missing = [period for period in periods if period not in period_rows]
+        if missing:
+            fetched = cls.fetch_period_rows(missing)
+            report_cache.set_reports(cls.granularity, fetched)
+            period_rows.update(fetched)
+        return period_rows
+
+    @classmethod
+    def fetch_period_rows(cls, periods):
+        # 期間の範囲（インデックス）で1回だけ取得し、periods 以外の行は捨てる
+        fetched = {period: [] for period in periods}
+        rollups = (cls.objects.filter(period__gte=min(periods),
+                                      period__lte=max(periods))
+                              .order_by('period', 'item_id')
+                              .values_list('period', 'item_id',
+                                           'amount', 'item_num'))
+        for period, item_id, amount, item_num in rollups:
+            rows = fetched.get(period)
+            if rows is not None:
+                rows.append((item_id, amount, item_num))
+        return fetched
+
+
+class HourlySaleRollup(SaleRollup):
+    # 期間は時間帯の開始時刻
+    period = models.DateTimeField("期間")
+
+    granularity = 'hourly'
+    trunc = TruncHour
+    report_key = staticmethod(year_month_day_hour)
+    recent_periods = staticmethod(recent_hours)
+    max_span = 24 * 366
+
+    class Meta(SaleRollup.Meta):
+        verbose_name = "時間帯別売上集計"
+        verbose_name_plural = "時間帯別売上集計"
+
+    @staticmethod
+    def period_of(delta):
+        return start_of_hour(delta.date, delta.hour)
+
+    @staticmethod
+    def period_from_trunc(value):
+        return localtime(value)
+
+    @classmethod
+    def get_heatmap(cls, span, item=None):
+        """
+        直近span日分の、曜日（月〜日）×時間帯（0〜23時）ごとの売上を返す
+        => [[売上] * 24] * 7
+        item を指定した場合は、その果物の売上だけを集計する
+        """
+        days = recent_days(span)
+        # 削除中の果物（販売情報の削除を待っている）は含めない
+        rollups = cls.objects.filter(
+            period__gte=start_of_day(days[-1]),
+            period__lt=start_of_day(days[0] + datetime.timedelta(days=1)),
+            item__deleted_at__isnull=True)
+        if item is not None:
+            rollups = rollups.filter(item=item)
+        heatmap = [[0] * 24 for _ in range(7)]
+        # 果物ごとの行はDBで合計し、1時間1行にしてから振り分ける
+        rows = (rollups.order_by().values('period')
+                .annotate(total=Sum('amount')).values_list('period', 'total'))
+        for period, amount in rows:
+            period = localtime(period)
+            heatmap[period.weekday()][period.hour] += amount
+        return heatmap
+
+
+class DailySaleRollup(SaleRollup):
+    granularity = 'daily'
+    trunc = TruncDay
+    report_key = staticmethod(year_month_day)
+    recent_periods = staticmethod(recent_days)
+    max_span = 366 * 5
+
+    class Meta(SaleRollup.Meta):
+        verbose_name = "日別売上集計"
+        verbose_name_plural = "日別売上集計"
+
+    @staticmethod
+    def period_of(delta):
+        return delta.date
+
+
+class WeeklySaleRollup(SaleRollup):
+    # 期間はISO週の初日（月曜日）
+    granularity = 'weekly'
+    trunc = TruncWeek
+    report_key = staticmethod(year_week)
+    recent_periods = staticmethod(recent_weeks)
+    max_span = 53 * 5
+
+    class Meta(SaleRollup.Meta):
+        verbose_name = "週別売上集計"
+        verbose_name_plural = "週別売上集計"
+
+    @staticmethod
+    def period_of(delta):
+        return start_of_week(delta.date)
+
+
+class MonthlySaleRollup(SaleRollup):
+    granularity = 'monthly'
+    trunc = TruncMonth
+    report_key = staticmethod(year_month)
+    recent_periods = staticmethod(recent_months)
+    max_span = 12 * 10
+
+    class Meta(SaleRollup.Meta):
+        verbose_name = "月別売上集計"
+        verbose_name_plural = "月別売上集計"
+
+    @staticmethod
+    def period_of(delta):
+        return delta.date.replace(day=1)
+
+
+# 販売情報の増減を反映する集計テーブル
+SALE_ROLLUPS = (
+    HourlySaleRollup, DailySaleRollup, WeeklySaleRollup, MonthlySaleRollup)
+
+
+class BackgroundJob(models.Model):
+    """
+    バックグラウンドで処理するジョブの共通部分
+    （manage.py run_import_workers で処理する）
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, "待機中"),
+        (RUNNING, "処理中"),
+        (DONE, "完了"),
+        (FAILED, "失敗"),
+    )
+
+    status = models.CharField(
+        "状態", max_length=10, choices=STATUS_CHOICES, default=QUEUED,
+        db_index=True)
+    message = models.TextField("メッセージ", blank=True)
+    worker = models.CharField("ワーカー", max_length=100, blank=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, verbose_name="登録者", null=True,
+        blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField("登録日時", auto_now_add=True)
+    started_at = models.DateTimeField("開始日時", null=True, blank=True)
+    finished_at = models.DateTimeField("終了日時", null=True, blank=True)
+    # 処理中のジョブが最後に応答した（進捗を書き込んだ）日時
+    heartbeat_at = models.DateTimeField("最終応答日時", null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def get_by_id_or_404(cls, id):
+        return get_object_or_404(cls, id=id)
+
+    @classmethod
+    def stale_filter(cls, timeout):
+        """
+        処理中のまま timeout 秒以上応答の無い（ワーカーが停止した）ジョブの条件
+        応答を記録する前のジョブは開始日時で判断する
+        """
+        limit = now() - datetime.timedelta(seconds=timeout)
+        return Q(status=cls.RUNNING) & (
+            Q(heartbeat_at__lt=limit) |
+            Q(heartbeat_at__isnull=True, started_at__lt=limit))
+
+    @classmethod
+    def resumable_filter(cls):
+        # 停止したワーカーから確保し直して、最初からやり直せるジョブの条件
+        return Q()
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    def estimate_remaining(self, done, total):
+        # 処理済みの件数の速度から残り時間（秒）を見積もる
+        if (self.status != self.RUNNING or not total or not done or
+                self.started_at is None):
+            return None
+        elapsed = (now() - self.started_at).total_seconds()
+        return elapsed / done * max(total - done, 0)
+
+
+class ImportJob(BackgroundJob):
+    """
+    バックグラウンドで処理する販売情報CSV一括登録ジョブ
+    """
+    # アップロードを受信しながら登録した場合は保存しない（空）
+    file = models.FileField("CSVファイル", upload_to='sales_imports/%Y/%m/%d/',
+                            blank=True)
+    total_rows = models.PositiveIntegerField("総行数", null=True, blank=True)
+    rows_done = models.PositiveIntegerField("処理済み行数", default=0)
+    rows_created = models.PositiveIntegerField("登録件数", default=0)
+    rows_duplicated = models.PositiveIntegerField("重複件数", default=0)
+    rows_failed = models.PositiveIntegerField("エラー行数", default=0)
+    # エラー行 [[行番号, 理由], ...] のJSON（先頭から上限件数まで）
+    errors = models.TextField("エラー行", blank=True, default='[]')
+
+    class Meta:
+        verbose_name = "CSV一括登録ジョブ"
+        verbose_name_plural = "CSV一括登録ジョブ"
+
+    @classmethod
+    def resumable_filter(cls):
+        # 受信しながら登録したジョブはCSVファイルが無いため、やり直せない
+        return ~Q(file='')
+
+    @property
+    def error_rows(self):
+        return json.loads(self.errors or '[]')
+
+    @property
+    def eta_seconds(self):
+        return self.estimate_remaining(self.rows_done, self.total_rows)
+
+    def progress(self):
+        return {
+            'id': self.pk,
+            'status': self.status,
+            'total_rows': self.total_rows,
+            'rows_done': self.rows_done,
+            'rows_created': self.rows_created,
+            'rows_duplicated': self.rows_duplicated,
+            'rows_failed': self.rows_failed,
+            'eta_seconds': self.eta_seconds,
+            'message': self.message,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class ItemPurgeJob(BackgroundJob):
+    """
+    削除（論理削除）した果物の販売情報を、少しずつ削除するジョブ
+    販売情報をすべて削除し終えたら、果物の行も削除する
+    """
+    # 果物の行を削除した後はNone
+    item = models.ForeignKey(
+        Item, verbose_name="果物", null=True, blank=True,
+        related_name='purge_jobs', on_delete=models.SET_NULL)
+    item_name = models.CharField("果物の名称", max_length=190)
+    total_sales = models.PositiveIntegerField(
+        "販売情報の件数", null=True, blank=True)
+    sales_deleted = models.PositiveIntegerField("削除済みの件数", default=0)
+
+    class Meta:
+        verbose_name = "果物の削除ジョブ"
+        verbose_name_plural = "果物の削除ジョブ"
+
+    @classmethod
+    def enqueue(cls, item, user=None):
+        # 果物を論理削除し、販売情報を削除するジョブを登録する
+        with transaction.atomic():
+            Item.delete_by_id(item.id)
+            return cls.objects.create(
+                item=item, item_name=item.name, created_by=user)
+
+    @classmethod
+    def get_unfinished(cls):
+        return cls.objects.filter(
+            status__in=(cls.QUEUED, cls.RUNNING)).order_by('created_at', 'id')
+
+    @property
+    def eta_seconds(self):
+        return self.estimate_remaining(self.sales_deleted, self.total_sales)
+
+    def progress(self):
+        return {
+            'id': self.pk,
+            'status': self.status,
+            'item_name': self.item_name,
+            'total_sales': self.total_sales,
+            'sales_deleted': self.sales_deleted,
+            'eta_seconds': self.eta_seconds,
+            'message': self.message,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class ArchivedSale(models.Model):
+    """
+    年ごとのアーカイブDB（manage.py archive_sales_year）に移した販売情報
+    テーブルはアーカイブDBにだけ作り、果物・ジョブは稼働中のDBにあるため
+    外部キー制約は作らない
+    """
+    item = models.ForeignKey(
+        Item, verbose_name="果物", db_constraint=False,
+        related_name='+', on_delete=models.DO_NOTHING)
+    item_num = models.PositiveIntegerField("個数")
+    amount = models.PositiveIntegerField("売上")
+    saled_at = models.DateTimeField("販売日時")
+    import_job = models.ForeignKey(
+        ImportJob, verbose_name="一括登録ジョブ", null=True, blank=True,
+        db_constraint=False, related_name='+', on_delete=models.DO_NOTHING)
+    # Sale.import_key（アーカイブ済みの年のCSVの再登録で重複させないため）
+    import_key = models.CharField(
+        "登録キー", max_length=40, null=True, blank=True, editable=False)
+
+    class Meta:
+        managed = False
+        indexes = [
+            models.Index(fields=['saled_at', 'id'],
+                         name='sales_archsale_saled_at_idx'),
+            models.Index(fields=['item', 'saled_at'],
+                         name='sales_archsale_item_saled_idx'),
+            models.Index(fields=['import_key'],
+                         name='sales_archsale_import_key_idx'),
+        ]
@@ -0,0 +1,94 @@
+"""
+期間別売上情報のキャッシュ
+
+キャッシュのキーは (集計単位, 期間)。販売情報の登録・更新・削除
+（一括処理を含む）で集計テーブルが更新されたとき、その期間のキャッシュだけを
+コミット後に削除する。
+バックエンドは settings.SALES_REPORT_CACHE で指定したキャッシュを使う。
+
+あわせて、販売情報が変更されるたびに更新するデータバージョンを保持する
+（APIのETagなど、変更の有無だけを安く知りたい場合に使う）。
+"""
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+HITS_KEY = 'sales:report:hits'
+MISSES_KEY = 'sales:report:misses'
+DATA_VERSION_KEY = 'sales:data:version'
+
+
+def get_cache():
+    return caches[getattr(settings, 'SALES_REPORT_CACHE', 'default')]
+
+
+def report_key(granularity, period):
+    return 'sales:report:{}:{}'.format(granularity, period.isoformat())
+
+
+def _count(key, n):
+    if not n:
+        return
+    cache = get_cache()
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, n)
+    except ValueError:
+        # 別プロセスが同時に削除した場合
+        cache.set(key, n, timeout=None)
+
+
+def get_reports(granularity, periods):
+    # キャッシュにある期間の売上情報を {期間: 売上情報} で返す
+    keys = {report_key(granularity, period): period for period in periods}
+    found = get_cache().get_many(keys.keys())
+    _count(HITS_KEY, len(found))
+    _count(MISSES_KEY, len(keys) - len(found))
+    return {keys[key]: report for key, report in found.items()}
+
+
+def set_reports(granularity, reports):
+    # reports: {期間: 売上情報}
+    get_cache().set_many({
+        report_key(granularity, period): report
+        for period, report in reports.items()
+    })
+
+
+def invalidate(granularity, periods):
+    # 書き込み中の値を読んだ結果が残らないよう、コミット後に削除する
+    keys = [report_key(granularity, period) for period in periods]
+    if keys:
+        transaction.on_commit(lambda: get_cache().delete_many(keys))
+
+
+def data_version():
+    cache = get_cache()
+    version = cache.get(DATA_VERSION_KEY)
+    if version is None:
+        cache.add(DATA_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(DATA_VERSION_KEY)
+    return version
+
+
+def _set_data_version():
+    get_cache().set(DATA_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def bump_data_version():
+    # コミット前に読んだプロセスが古い値を残さないよう、コミット後にも更新する
+    _set_data_version()
+    transaction.on_commit(_set_data_version)
+
+
+def stats():
+    cache = get_cache()
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total if total else None,
+    }
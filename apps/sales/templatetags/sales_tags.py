@@ -0,0 +1,27 @@
+from django import template
+from apps.sales.models import (
+    YearMonth, YearWeek, YearMonthDay, YearMonthDayHour)
+
+register = template.Library()
+
+WEEKDAYS = "月火水木金土日"
+
+
+@register.filter
+def period_label(key):
+    # 期間別売上情報のキー（YearMonth など）を表示用の文字列にする
+    if isinstance(key, YearMonthDayHour):
+        return "{}年{}月{}日 {}時".format(*key)
+    if isinstance(key, YearMonthDay):
+        return "{}年{}月{}日".format(*key)
+    if isinstance(key, YearWeek):
+        return "{}年 第{}週".format(*key)
+    if isinstance(key, YearMonth):
+        return "{}年{}月".format(*key)
+    return str(key)
+
+
+@register.filter
+def weekday_label(index):
+    # 0: 月曜日 〜 6: 日曜日
+    return WEEKDAYS[index]
@@ -1,3 +1,1348 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from io import StringIO
+from unittest import mock, skipUnless
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from django.contrib.admin.templatetags.admin_list import date_hierarchy
+from django.contrib.auth import get_user_model
+from django.db import connection, connections, router
+from django.db.models import Sum
+from django.db.models.functions import TruncDay, TruncMonth
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import (
+    LiveServerTestCase, TestCase, TransactionTestCase, override_settings)
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.timezone import localdate, localtime, make_aware, now
+from fruitshopadmin import db
+from fruitshopadmin.pagination import EstimatedCountPaginator
+from apps.items.models import Item
+from . import archive, benchmarks, loadtest, report_cache
+from .analytics import SalesSnapshot
+from .bulk import BulkDelete, BulkReassignItem, BulkShiftSaledAt
+from .exporters import iter_chunks, iter_gzip, iter_sale_csv_lines
+from .importers import ImportResult, SaleCsvImporter
+from .jobs import claim_next_job, run_job, run_purge_job, run_worker
+from .uploadhandlers import CsvRowStream
+from .models import (
+    Sale, HourlySaleRollup, DailySaleRollup, WeeklySaleRollup,
+    MonthlySaleRollup, ImportJob, ItemPurgeJob, ArchivedSale, SALE_ROLLUPS,
+    recent_hours, year_month, year_month_day, year_month_day_hour)
 
-# Create your tests here.
+
+class SaleRangeQueryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.item = Item.objects.create(name="りんご", price=100)
+        cls.other = Item.objects.create(name="バナナ", price=50)
+        for saled_at in (
+            datetime.datetime(2018, 11, 30, 23, 59),
+            datetime.datetime(2018, 12, 1, 0, 0),
+            datetime.datetime(2018, 12, 31, 23, 59),
+            datetime.datetime(2019, 1, 1, 0, 0),
+        ):
+            Sale.objects.create(item=cls.item, item_num=1,
+                                saled_at=make_aware(saled_at))
+        Sale.objects.create(
+            item=cls.other, item_num=1,
+            saled_at=make_aware(datetime.datetime(2018, 12, 15, 12, 0)))
+
+    def test_find_by_year_month_uses_local_month_boundaries(self):
+        sales = Sale.find_by_year_month(2018, 12)
+        self.assertEqual(sales.count(), 3)
+
+    def test_find_by_year_month_day(self):
+        self.assertEqual(Sale.find_by_year_month_day(2018, 12, 31).count(), 1)
+        self.assertEqual(Sale.find_by_year_month_day(2018, 12, 2).count(), 0)
+
+    def test_find_by_item_in_range(self):
+        start = make_aware(datetime.datetime(2018, 12, 1))
+        end = make_aware(datetime.datetime(2019, 1, 1))
+        sales = Sale.find_by_item_in_range(self.other, start, end)
+        self.assertEqual(sales.count(), 1)
+
+    @skipUnless(connection.vendor == 'sqlite', "SQLiteの実行計画を確認する")
+    def test_range_queries_use_indexes(self):
+        plan = Sale.find_by_year_month(2018, 12).explain()
+        self.assertIn('sales_sale_saled_at_id_idx', plan)
+
+        start = make_aware(datetime.datetime(2018, 12, 1))
+        end = make_aware(datetime.datetime(2019, 1, 1))
+        plan = Sale.find_by_item_in_range(self.item, start, end).explain()
+        self.assertIn('sales_sale_item_saled_at_idx', plan)
+
+
+class SaleApiTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('staff', password='x')
+        cls.item = Item.objects.create(name="りんご", price=100)
+        cls.sale = Sale.objects.create(
+            item=cls.item, item_num=2,
+            saled_at=make_aware(datetime.datetime(2018, 12, 1, 12, 0)))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_projection_and_filters(self):
+        response = self.client.get(reverse('sales:api_sales'), {
+            'fields': 'id,item_name,amount',
+            'start_date': '2018-12-01',
+            'end_date': '2018-12-01',
+        })
+        self.assertEqual(response.json()['results'], [
+            {'id': self.sale.id, 'item_name': "りんご", 'amount': 200}])
+        response = self.client.get(reverse('sales:api_sales'),
+                                   {'fields': 'password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional_get(self):
+        url = reverse('sales:api_sales')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.sale.item_num = 3
+        self.sale.save()
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_hourly_etag_changes_every_hour(self):
+        url = reverse('sales:api_statistics')
+        at = make_aware(datetime.datetime(2018, 12, 1, 12, 40))
+        statuses = {}
+        for granularity in ('hourly', 'daily'):
+            with mock.patch('django.utils.timezone.now', return_value=at):
+                etag = self.client.get(
+                    url, {'granularity': granularity})['ETag']
+            with mock.patch('django.utils.timezone.now',
+                            return_value=at + datetime.timedelta(minutes=40)):
+                response = self.client.get(
+                    url, {'granularity': granularity},
+                    HTTP_IF_NONE_MATCH=etag)
+            statuses[granularity] = response.status_code
+        # 13時になると直近の時間が変わるため、時間単位の集計だけ作り直す
+        self.assertEqual(statuses, {'hourly': 200, 'daily': 304})
+
+
+class SaleRollupTests(TestCase):
+    # 集計テーブルの期間を、集計テーブルとは別の方法（販売情報1件ずつ）で求める
+    PERIODS = {
+        'hourly': lambda at: at.replace(minute=0, second=0, microsecond=0),
+        'daily': lambda at: at.date(),
+        'weekly': lambda at: at.date() - datetime.timedelta(
+            days=at.weekday()),
+        'monthly': lambda at: at.date().replace(day=1),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('staff', password='pw')
+        cls.apple = Item.objects.create(name="りんご", price=100)
+        cls.banana = Item.objects.create(name="バナナ", price=50)
+
+    def create(self, item, item_num, *args):
+        return Sale.objects.create(
+            item=item, item_num=item_num,
+            saled_at=make_aware(datetime.datetime(*args)))
+
+    def expected(self, granularity):
+        buckets = {}
+        for sale in Sale.objects.all():
+            period = self.PERIODS[granularity](localtime(sale.saled_at))
+            bucket = buckets.setdefault((period, sale.item_id), [0, 0, 0])
+            bucket[0] += sale.amount
+            bucket[1] += sale.item_num
+            bucket[2] += 1
+        return {key: tuple(bucket) for key, bucket in buckets.items()}
+
+    def assertRollupsMatchSales(self):
+        for rollup in SALE_ROLLUPS:
+            stored = {
+                (period, item_id): (amount, item_num, count)
+                for period, item_id, amount, item_num, count in
+                rollup.objects.values_list(
+                    'period', 'item_id', 'amount', 'item_num', 'sale_count')
+            }
+            self.assertEqual(stored, self.expected(rollup.granularity),
+                             rollup.granularity)
+        self.assertEqual(MonthlySaleRollup.get_entire_amount(),
+                         Sale.get_entire_amount())
+
+    def test_create_edit_and_delete(self):
+        # 月末の深夜（ローカル時間）と、日曜日→月曜日をまたぐ販売情報
+        first = self.create(self.apple, 1, 2018, 11, 30, 23, 30)
+        second = self.create(self.apple, 2, 2018, 12, 2, 23, 0)
+        third = self.create(self.banana, 3, 2018, 12, 3, 0, 30)
+        self.assertRollupsMatchSales()
+
+        # 個数だけを変える
+        second.item_num = 4
+        second.amount = None
+        second.save()
+        self.assertRollupsMatchSales()
+
+        # 別の果物・別の月（全ての集計単位で期間が変わる）へ移す
+        first.item = self.banana
+        first.amount = None
+        first.saled_at = make_aware(datetime.datetime(2018, 12, 3, 0, 10))
+        first.save()
+        self.assertRollupsMatchSales()
+        self.assertFalse(MonthlySaleRollup.objects.filter(
+            period=datetime.date(2018, 11, 1)).exists())
+
+        # 画面からの更新（同じ時間帯の別の果物へ）
+        self.client.force_login(self.user)
+        self.client.post(reverse('sales:edit', args=[third.id]), {
+            'item': self.apple.id,
+            'item_num': 3,
+            'saled_at': '2018-12-03 00:45:00',
+        })
+        self.assertEqual(Sale.objects.get(id=third.id).item_id, self.apple.id)
+        self.assertRollupsMatchSales()
+
+        # 期間に残る最後の販売情報を削除すると、集計行も無くなる
+        second.delete()
+        self.assertRollupsMatchSales()
+        self.assertFalse(WeeklySaleRollup.objects.filter(
+            period=datetime.date(2018, 11, 26)).exists())
+        self.client.post(reverse('sales:delete', args=[third.id]))
+        Sale.objects.filter(id=first.id).delete()
+        self.assertRollupsMatchSales()
+        for rollup in SALE_ROLLUPS:
+            self.assertFalse(rollup.objects.exists(), rollup.granularity)
+
+    def test_rebuild_matches_incremental_updates(self):
+        for day in range(1, 11):
+            self.create(self.apple if day % 3 else self.banana, day,
+                        2018, 12, day, day, 0)
+        Sale.objects.filter(saled_at__day__in=[2, 5]).delete()
+        self.assertRollupsMatchSales()
+        for rollup in SALE_ROLLUPS:
+            rollup.objects.all().delete()
+            rollup.rebuild()
+        self.assertRollupsMatchSales()
+
+
+def legacy_reports(span, step, report_key):
+    # DB側で集計する前の実装（全件をPythonで集計する）と同じ処理
+    reports = OrderedDict()
+    today = localdate()
+    for i in range(span):
+        reports[report_key(today + step(i))] = {
+            'amount': 0,
+            'item_reports': {}
+        }
+    for sale in Sale.objects.all():
+        saled_at = report_key(localtime(sale.saled_at).date())
+        if saled_at not in reports:
+            continue
+        reports[saled_at]['amount'] += sale.amount
+        item_report = reports[saled_at]['item_reports'].setdefault(
+            sale.item.name, {'item_num': 0, 'amount': 0})
+        item_report['item_num'] += sale.item_num
+        item_report['amount'] += sale.amount
+    return reports
+
+
+class SaleReportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        apple = Item.objects.create(name="りんご", price=100)
+        banana = Item.objects.create(name="バナナ", price=50)
+        grape = Item.objects.create(name="ぶどう", price=300)
+        today = datetime.datetime.combine(localdate(), datetime.time())
+        first_of_month = today.replace(day=1)
+        for item, item_num, saled_at in (
+            # 今日の0時ちょうどと、昨日の23時59分
+            (apple, 1, today),
+            (banana, 2, today + datetime.timedelta(hours=12)),
+            (apple, 3, today - datetime.timedelta(minutes=1)),
+            (grape, 1, today - datetime.timedelta(days=1, hours=1)),
+            # 2ヶ月前（1ヶ月前・3ヶ月前は販売情報なし）と、対象期間外の5ヶ月前
+            (banana, 4, first_of_month + relativedelta(months=-2, hours=10)),
+            (grape, 2, first_of_month + relativedelta(months=-2, days=27)),
+            (apple, 5, first_of_month + relativedelta(months=-5)),
+        ):
+            Sale.objects.create(item=item, item_num=item_num,
+                                saled_at=make_aware(saled_at))
+
+    def setUp(self):
+        # テストのトランザクションはコミットしないため、キャッシュは削除されない
+        self.addCleanup(report_cache.get_cache().clear)
+
+    def assertSameReports(self, reports, expected):
+        self.assertEqual(list(reports.keys()), list(expected.keys()))
+        self.assertEqual(reports, expected)
+
+    def test_monthly_reports_match_legacy(self):
+        expected = legacy_reports(
+            4, lambda i: relativedelta(months=-i), year_month)
+        amounts = [report['amount'] for report in expected.values()]
+        self.assertEqual(amounts[2:], [4 * 50 + 2 * 300, 0])
+        self.assertSameReports(Sale.get_recent_monthly_reports(4), expected)
+        self.assertSameReports(MonthlySaleRollup.get_recent_reports(4),
+                               expected)
+
+    def test_daily_reports_match_legacy(self):
+        expected = legacy_reports(
+            7, lambda i: relativedelta(days=-i), year_month_day)
+        self.assertEqual(len(expected[year_month_day(localdate())]
+                             ['item_reports']), 2)
+        self.assertSameReports(Sale.get_recent_daily_reports(7), expected)
+        self.assertSameReports(DailySaleRollup.get_recent_reports(7),
+                               expected)
+
+    def test_no_sales_in_span(self):
+        Sale.objects.filter(saled_at__gte=make_aware(
+            datetime.datetime.combine(localdate(), datetime.time())
+            - relativedelta(months=3))).delete()
+        expected = legacy_reports(
+            3, lambda i: relativedelta(months=-i), year_month)
+        self.assertSameReports(Sale.get_recent_monthly_reports(3), expected)
+        self.assertEqual(Sale.get_recent_monthly_reports(0), OrderedDict())
+
+    def test_entire_amount(self):
+        self.assertEqual(Sale.get_entire_amount(),
+                         sum(sale.amount for sale in Sale.objects.all()))
+        Sale.objects.all().delete()
+        self.assertEqual(Sale.get_entire_amount(), 0)
+
+
+class SaleBulkOperationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.item = Item.objects.create(name="りんご", price=100)
+        cls.other = Item.objects.create(name="バナナ", price=50)
+        for day in (1, 1, 2, 3):
+            Sale.objects.create(
+                item=cls.item, item_num=1,
+                saled_at=make_aware(datetime.datetime(2018, 12, day, 12, 0)))
+
+    def assertRollupsConsistent(self):
+        for rollup in SALE_ROLLUPS:
+            self.assertEqual(rollup.verify(), [], rollup.granularity)
+
+    def test_delete_in_chunks(self):
+        queryset = Sale.find_by_year_month_day(2018, 12, 1)
+        operation = BulkDelete(queryset, chunk_size=1)
+        self.assertEqual(operation.count(), 2)
+        result = operation.run()
+        self.assertEqual((result.affected, result.chunks), (2, 2))
+        self.assertEqual(Sale.objects.count(), 2)
+        self.assertRollupsConsistent()
+
+    def test_reassign_item(self):
+        queryset = Sale.objects.filter(item=self.item)
+        BulkReassignItem(queryset, self.other, chunk_size=3).run()
+        self.assertEqual(Sale.objects.filter(item=self.other).count(), 4)
+        self.assertRollupsConsistent()
+
+    def test_shift_saled_at(self):
+        queryset = Sale.find_by_year_month_day(2018, 12, 3)
+        BulkShiftSaledAt(queryset, datetime.timedelta(days=30)).run()
+        self.assertEqual(Sale.find_by_year_month(2019, 1).count(), 1)
+        self.assertRollupsConsistent()
+
+
+class SaleItemCounterTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.item = Item.objects.create(name="りんご", price=100)
+
+    def assertCounters(self, units, revenue, last_saled_at):
+        item = Item.objects.get(id=self.item.id)
+        self.assertEqual(
+            (item.units_sold, item.revenue, item.last_saled_at),
+            (units, revenue, last_saled_at))
+
+    def test_follows_sale_changes(self):
+        first = make_aware(datetime.datetime(2018, 12, 1, 10, 0))
+        second = make_aware(datetime.datetime(2018, 12, 2, 10, 0))
+        Sale.objects.create(item=self.item, item_num=1, saled_at=first)
+        sale = Sale.objects.create(item=self.item, item_num=2,
+                                   saled_at=second)
+        self.assertCounters(3, 300, second)
+
+        # 果物の編集で販売実績を上書きしない
+        item = Item.objects.get(id=self.item.id)
+        Sale.objects.create(item=self.item, item_num=1, saled_at=first)
+        item.save()
+        self.assertCounters(4, 400, second)
+
+        sale.delete()
+        self.assertCounters(2, 200, first)
+        SaleCsvImporter().import_rows([
+            ["りんご", "5", "500", "2018-12-03 10:00"],
+        ])
+        self.assertCounters(
+            7, 700, make_aware(datetime.datetime(2018, 12, 3, 10, 0)))
+        call_command('reconcile_item_counters', '--verify', stdout=StringIO())
+
+    def test_reconcile(self):
+        Sale.objects.create(
+            item=self.item, item_num=1,
+            saled_at=make_aware(datetime.datetime(2018, 12, 1, 10, 0)))
+        Item.add_sales(self.item.id, 10, 1000)
+        with self.assertRaises(CommandError):
+            call_command('reconcile_item_counters', '--verify',
+                         stdout=StringIO())
+        call_command('reconcile_item_counters', stdout=StringIO())
+        self.assertCounters(
+            1, 100, make_aware(datetime.datetime(2018, 12, 1, 10, 0)))
+
+
+@override_settings(SALES_REPORT_CACHE='default')
+class SaleReportCacheTests(TransactionTestCase):
+    # キャッシュはコミット後に削除するため、テストごとにコミットする
+    databases = {'default', 'replica'}
+    spans = {'hourly': 48, 'daily': 3, 'weekly': 3, 'monthly': 3}
+
+    def setUp(self):
+        report_cache.get_cache().clear()
+        self.apple = Item.objects.create(name="りんご", price=100)
+        self.banana = Item.objects.create(name="バナナ", price=50)
+        self.now = localtime().replace(second=0, microsecond=0)
+        self.yesterday = self.now - datetime.timedelta(days=1)
+        self.sale = Sale.objects.create(item=self.apple, item_num=1,
+                                        saled_at=self.yesterday)
+
+    def warm(self):
+        # 直近の期間の売上情報を読み、キャッシュに載せる
+        for rollup in SALE_ROLLUPS:
+            rollup.get_recent_reports(self.spans[rollup.granularity])
+
+    def is_cached(self, date):
+        return report_cache.get_cache().get(
+            report_cache.report_key('daily', date)) is not None
+
+    def assertReportsFresh(self):
+        # キャッシュ経由の売上情報が、集計テーブルから読み直したものと一致する
+        for rollup in SALE_ROLLUPS:
+            periods = rollup.recent_periods(self.spans[rollup.granularity])
+            self.assertEqual(rollup.get_period_rows(periods),
+                             rollup.fetch_period_rows(periods),
+                             rollup.granularity)
+            self.assertEqual(rollup.verify(), [], rollup.granularity)
+
+    def test_write_invalidates_only_its_period(self):
+        other_day = (self.now - datetime.timedelta(days=2)).date()
+        self.warm()
+        self.assertTrue(self.is_cached(other_day))
+        self.assertTrue(self.is_cached(self.now.date()))
+        Sale.objects.create(item=self.banana, item_num=2, saled_at=self.now)
+        self.assertFalse(self.is_cached(self.now.date()))
+        self.assertTrue(self.is_cached(other_day))
+        self.assertReportsFresh()
+        report = DailySaleRollup.get_recent_reports(1)[
+            year_month_day(self.now.date())]
+        self.assertEqual(report['item_reports'], {
+            "バナナ": {'item_num': 2, 'amount': 100}})
+
+    def test_edit_to_another_item_and_period(self):
+        self.warm()
+        self.sale.item = self.banana
+        self.sale.item_num = 3
+        self.sale.amount = None
+        self.sale.saled_at = self.now
+        self.sale.save()
+        self.assertFalse(self.is_cached(self.yesterday.date()))
+        self.assertFalse(self.is_cached(self.now.date()))
+        self.assertReportsFresh()
+        reports = DailySaleRollup.get_recent_reports(2)
+        self.assertEqual(
+            reports[year_month_day(self.yesterday.date())]['amount'], 0)
+        self.assertEqual(reports[year_month_day(self.now.date())]['amount'],
+                         150)
+
+    def test_delete(self):
+        self.warm()
+        self.sale.delete()
+        self.assertFalse(self.is_cached(self.yesterday.date()))
+        self.assertReportsFresh()
+        self.assertEqual(
+            DailySaleRollup.get_recent_reports(2)[
+                year_month_day(self.yesterday.date())]['amount'], 0)
+
+    def test_bulk_operations(self):
+        Sale.objects.create(item=self.apple, item_num=1, saled_at=self.now)
+        self.warm()
+        BulkShiftSaledAt(Sale.objects.filter(saled_at=self.now),
+                         datetime.timedelta(days=-1)).run()
+        self.assertReportsFresh()
+        self.warm()
+        BulkDelete(Sale.objects.all()).run()
+        self.assertReportsFresh()
+        self.assertEqual(Sale.objects.count(), 0)
+
+
+@override_settings(SALES_REPORT_CACHE='default')
+class ItemPurgeTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('staff', password='pw')
+        cls.item = Item.objects.create(name="りんご", price=100)
+        cls.other = Item.objects.create(name="バナナ", price=50)
+        saled_at = make_aware(datetime.datetime.combine(
+            localdate(), datetime.time(9, 0)))
+        for item in (cls.item, cls.item, cls.item, cls.other):
+            Sale.objects.create(item=item, item_num=1, saled_at=saled_at)
+
+    def setUp(self):
+        # テストのトランザクションはコミットしないため、キャッシュは削除されない
+        report_cache.get_cache().clear()
+
+    def test_soft_delete_and_purge(self):
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse('items:delete', args=[self.item.id]))
+        job = ItemPurgeJob.objects.get()
+        self.assertRedirects(
+            response, reverse('sales:item_purge_job', args=[job.id]))
+        # 果物はすぐに外れ、販売情報と集計は削除ジョブを待つ
+        self.assertIsNone(Item.get_by_name_or_none("りんご"))
+        self.assertNotIn(self.item, Item.get_all_objects())
+        self.assertEqual(Sale.objects.count(), 4)
+        reports = DailySaleRollup.get_recent_reports(1)
+        self.assertEqual(list(reports.values())[0]['amount'], 50)
+        # 削除中の果物の販売情報は、一覧・統計にも出さない
+        response = self.client.get(reverse('sales:index'))
+        self.assertEqual([sale.item for sale in response.context['sales']],
+                         [self.other])
+        with override_settings(CONCURRENT_SECTIONS_MAX_WORKERS=0):
+            response = self.client.get(reverse('sales:statistics'))
+        self.assertEqual(response.context['entire_sales_amount'], 50)
+        self.assertEqual(sum(map(sum, HourlySaleRollup.get_heatmap(1))), 50)
+
+        job = claim_next_job('test', ItemPurgeJob)
+        self.assertEqual(run_purge_job(job, chunk_size=2), ItemPurgeJob.DONE)
+        job.refresh_from_db()
+        self.assertEqual((job.total_sales, job.sales_deleted), (3, 3))
+        self.assertIsNone(job.item)
+        self.assertFalse(Item.objects.filter(id=self.item.id).exists())
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertEqual(Sale.get_entire_amount(), 50)
+        for rollup in SALE_ROLLUPS:
+            self.assertEqual(rollup.verify(), [], rollup.granularity)
+
+
+class SaleAdminTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'pw')
+        cls.item = Item.objects.create(name="りんご", price=100)
+        cls.other = Item.objects.create(name="バナナ", price=50)
+        for item, day in ((cls.item, 1), (cls.item, 2), (cls.other, 2)):
+            Sale.objects.create(
+                item=item, item_num=1,
+                saled_at=make_aware(datetime.datetime(2018, 12, day, 12, 0)))
+        Sale.objects.create(
+            item=cls.item, item_num=1,
+            saled_at=make_aware(datetime.datetime(2019, 1, 1, 12, 0)))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_changelist(self):
+        url = reverse('admin:sales_sale_changelist')
+        response = self.client.get(url)
+        self.assertEqual(response.context['cl'].result_count, 4)
+        years = [choice['title'] for choice in self._date_choices(response)]
+        self.assertEqual(years, ['2018', '2019'])
+
+        response = self.client.get(url, {
+            'saled_at__year': 2018, 'saled_at__month': 12,
+            'item': self.item.id})
+        self.assertEqual(response.context['cl'].result_count, 2)
+        self.assertEqual(len(self._date_choices(response)), 2)
+
+    def _date_choices(self, response):
+        return date_hierarchy(response.context['cl'])['choices']
+
+    def test_estimated_count(self):
+        queryset = Sale.objects.order_by('id')
+        with mock.patch.object(EstimatedCountPaginator, 'limit', 2):
+            self.assertEqual(EstimatedCountPaginator(queryset, 1).count, 4)
+            self.assertEqual(EstimatedCountPaginator(
+                queryset.filter(item=self.item), 1).count, 2)
+
+    def test_delete_sales_action(self):
+        url = reverse('admin:sales_sale_changelist')
+        first = Sale.objects.order_by('id').first()
+        data = {'action': 'delete_sales', 'select_across': '1',
+                'index': '0', '_selected_action': [first.id]}
+        response = self.client.post(url + '?item={}'.format(self.item.id),
+                                    data)
+        self.assertEqual(response.context['count'], 3)
+        self.assertEqual(Sale.objects.count(), 4)
+
+        data['post'] = 'yes'
+        self.client.post(url + '?item={}'.format(self.item.id), data)
+        self.assertEqual(list(Sale.objects.values_list('item', flat=True)),
+                         [self.other.id])
+        for rollup in SALE_ROLLUPS:
+            self.assertEqual(rollup.verify(), [], rollup.granularity)
+
+
+class SaleCsvImportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Item.objects.create(name="りんご", price=100)
+
+    def test_reimport_is_idempotent(self):
+        # 同じ内容の行が2件あるCSV（どちらも登録する）
+        rows = [
+            ["りんご", "1", "100", "2018-12-01 10:00"],
+            ["りんご", "1", "100", "2018-12-01 10:00"],
+            ["りんご", "2", "200", "2018-12-01 11:00"],
+            ["みかん", "1", "100", "2018-12-01 11:00"],
+        ]
+        result = SaleCsvImporter(batch_size=2).import_rows(rows)
+        self.assertEqual((result.created, result.duplicates, result.failed),
+                         (3, 0, 1))
+
+        result = SaleCsvImporter().import_rows(rows + [
+            ["りんご", "1", "100", "2018-12-01 10:00"],
+        ])
+        self.assertEqual((result.created, result.duplicates), (1, 3))
+        self.assertEqual(Sale.objects.count(), 4)
+        self.assertEqual(DailySaleRollup.verify(), [])
+
+    def test_rows_registered_concurrently_are_not_counted(self):
+        rows = [
+            ["りんご", "1", "100", "2018-12-01 10:00"],
+            ["りんご", "2", "200", "2018-12-01 11:00"],
+        ]
+        SaleCsvImporter().import_rows(rows[:1])
+        # 登録済みの行を調べた後に、別のプロセスが同じ行を登録した場合
+        find_existing = Sale.find_existing_import_keys
+        calls = []
+
+        def miss_first_lookup(*args, **kwargs):
+            calls.append(1)
+            return set() if len(calls) == 1 else find_existing(*args, **kwargs)
+
+        with mock.patch.object(Sale, 'find_existing_import_keys',
+                               side_effect=miss_first_lookup):
+            result = SaleCsvImporter().import_rows(rows)
+        self.assertEqual((result.created, result.duplicates), (1, 1))
+        self.assertEqual(Sale.objects.count(), 2)
+        for rollup in SALE_ROLLUPS:
+            self.assertEqual(rollup.verify(), [], rollup.granularity)
+        self.assertEqual(Sale.reconcile_item_counters(verify=True), [])
+
+    def test_unsorted_csv_longer_than_prune_threshold(self):
+        # 果物順（販売日時順でない）のCSV。同じ内容の行が離れた位置にもある
+        Item.objects.create(name="ぶどう", price=300)
+        rows = []
+        for name in ("りんご", "ぶどう"):
+            for i in range(60):
+                saled_at = datetime.datetime(2018, 1, 1) + datetime.timedelta(
+                    days=(i * 7) % 60)
+                rows.append([name, "1", "100",
+                             saled_at.strftime('%Y-%m-%d %H:%M')])
+        rows += rows[:30]
+        with mock.patch('apps.sales.importers.OCCURRENCE_PRUNE_THRESHOLD', 8):
+            result = SaleCsvImporter(batch_size=50).import_rows(rows)
+            self.assertEqual((result.created, result.failed), (150, 0))
+            result = SaleCsvImporter(batch_size=50).import_rows(rows)
+        self.assertEqual((result.created, result.duplicates, result.failed),
+                         (0, 150, 0))
+        self.assertEqual(DailySaleRollup.verify(), [])
+
+    def test_errors_are_collected_per_row(self):
+        rows = [
+            ["りんご", "1", "100", "2018-12-01 10:00"],
+            ["りんご", "1"],
+            ["みかん", "1", "100", "2018-12-01 10:00"],
+            ["りんご", "一", "100", "2018-12-01 10:00"],
+            ["りんご", "-1", "100", "2018-12-01 10:00"],
+            ["りんご", "1", "100", "2018/12/01 10:00"],
+            ["りんご", "2", "200", "2018-12-01 11:00"],
+        ]
+        result = SaleCsvImporter(batch_size=1).import_rows(rows)
+        self.assertEqual((result.total, result.created, result.failed),
+                         (7, 2, 5))
+        self.assertEqual(result.errors, [
+            (2, "列が不足しています"),
+            (3, "果物「みかん」は登録されていません"),
+            (4, "個数・売上が数値ではありません"),
+            (5, "個数・売上が負の値です"),
+            (6, "販売日時の形式が正しくありません"),
+        ])
+        self.assertEqual(Sale.get_entire_amount(), 300)
+
+    def test_rows_per_sec(self):
+        result = ImportResult()
+        self.assertEqual(result.rows_per_sec, 0.0)
+        result.total, result.elapsed = 300, 1.5
+        self.assertEqual(result.rows_per_sec, 200.0)
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        path = os.path.join(path, 'sales.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('りんご,1,100,2018-12-01 10:00\n'
+                    'りんご,x,100,2018-12-01 10:00\n'
+                    'りんご,2,200,2018-12-01 11:00\n')
+        stdout, stderr = StringIO(), StringIO()
+        with mock.patch('apps.sales.importers.time.monotonic',
+                        side_effect=[10.0, 10.5]):
+            call_command('import_sales', path, stdout=stdout, stderr=stderr)
+        self.assertIn("2件を登録しました（登録済み0件, エラー1件, 0.5秒, 6行/秒）",
+                      stdout.getvalue())
+        self.assertIn("2行目: 個数・売上が数値ではありません", stderr.getvalue())
+
+    def test_row_stream_handles_split_chunks(self):
+        data = ('りんご,1,100,2018-12-01 10:00\r\n'
+                '"りん\nご",2,200,"2018-12-01 11:00"\n'
+                'りんご,3,300,2018-12-01 12:00').encode()
+        stream = CsvRowStream()
+        rows = []
+        for i in range(0, len(data), 5):
+            rows.extend(stream.feed(data[i:i + 5]))
+        rows.extend(stream.feed(b'', final=True))
+        self.assertEqual([row[1] for row in rows], ['1', '2', '3'])
+        self.assertEqual(rows[1][0], "りん\nご")
+
+    def test_streaming_upload(self):
+        user = get_user_model().objects.create_user('staff', password='pw')
+        self.client.force_login(user)
+        upload = SimpleUploadedFile(
+            'sales.csv', 'りんご,1,100,2018-12-01 10:00\n'.encode(),
+            content_type='text/csv')
+        response = self.client.post(reverse('sales:csv_upload'),
+                                    {'file': upload},
+                                    HTTP_ORIGIN='http://testserver')
+        job = ImportJob.objects.get()
+        self.assertRedirects(response, reverse('sales:import_job',
+                                               args=[job.pk]))
+        self.assertEqual((job.status, job.rows_created, job.file.name),
+                         (ImportJob.DONE, 1, ''))
+        self.assertEqual(Sale.objects.filter(import_job=job).count(), 1)
+
+    def test_upload_without_origin_is_queued(self):
+        user = get_user_model().objects.create_user('staff', password='pw')
+        self.client.force_login(user)
+        upload = SimpleUploadedFile(
+            'sales.csv', 'りんご,1,100,2018-12-01 10:00\n'.encode(),
+            content_type='text/csv')
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        with override_settings(MEDIA_ROOT=media_root):
+            self.client.post(reverse('sales:csv_upload'), {'file': upload})
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, ImportJob.QUEUED)
+        self.assertFalse(Sale.objects.exists())
+
+
+class SaleImportJobTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Item.objects.create(name="りんご", price=100)
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def create_job(self, lines):
+        return ImportJob.objects.create(file=SimpleUploadedFile(
+            'sales.csv', ''.join(lines).encode(), content_type='text/csv'))
+
+    def test_state_transitions(self):
+        job = self.create_job([
+            'りんご,1,100,2018-12-01 10:00\n',
+            'りんご,x,100,2018-12-01 10:00\n',
+            'りんご,2,200,2018-12-01 11:00\n',
+        ])
+        self.assertEqual(job.status, ImportJob.QUEUED)
+        self.assertFalse(job.is_finished)
+
+        claimed = claim_next_job('worker-1')
+        self.assertEqual((claimed.id, claimed.status, claimed.worker),
+                         (job.id, ImportJob.RUNNING, 'worker-1'))
+        self.assertIsNotNone(claimed.started_at)
+        # 確保済みのジョブは別のワーカーに渡さない
+        self.assertIsNone(claim_next_job('worker-2'))
+
+        self.assertEqual(run_job(claimed), ImportJob.DONE)
+        job.refresh_from_db()
+        self.assertTrue(job.is_finished)
+        self.assertEqual(
+            (job.total_rows, job.rows_done, job.rows_created, job.rows_failed),
+            (3, 3, 2, 1))
+        self.assertEqual(job.error_rows,
+                         [[2, "個数・売上が数値ではありません"]])
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(job.eta_seconds)
+        self.assertEqual(Sale.objects.filter(import_job=job).count(), 2)
+
+    def test_worker_fails_mid_job(self):
+        job = self.create_job([
+            'りんご,{},100,2018-12-01 10:00\n'.format(i) for i in range(1, 6)
+        ])
+        find_existing = Sale.find_existing_import_keys
+        calls = []
+
+        def fail_second_batch(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise RuntimeError("disk I/O error")
+            return find_existing(*args, **kwargs)
+
+        with mock.patch.object(SaleCsvImporter, 'batch_size', 2), \
+                mock.patch.object(Sale, 'find_existing_import_keys',
+                                  side_effect=fail_second_batch), \
+                self.assertLogs('apps.sales.jobs', 'ERROR'):
+            self.assertEqual(run_job(claim_next_job('worker-1')),
+                             ImportJob.FAILED)
+        job.refresh_from_db()
+        # 失敗する前にコミットした分は残り、集計テーブルにも反映されている
+        self.assertEqual(
+            (job.status, job.message, job.rows_done, job.rows_created),
+            (ImportJob.FAILED, "disk I/O error", 4, 2))
+        self.assertEqual(Sale.objects.count(), 2)
+        for rollup in SALE_ROLLUPS:
+            self.assertEqual(rollup.verify(), [], rollup.granularity)
+
+        # 待機中に戻してやり直すと、登録済みの行は登録しない
+        ImportJob.objects.filter(id=job.id).update(status=ImportJob.QUEUED)
+        run_worker(once=True)
+        job.refresh_from_db()
+        self.assertEqual(
+            (job.status, job.rows_created, job.rows_duplicated),
+            (ImportJob.DONE, 3, 2))
+        self.assertEqual(Sale.objects.count(), 5)
+        self.assertEqual(Sale.reconcile_item_counters(verify=True), [])
+
+    def test_reclaim_stale_job(self):
+        job = self.create_job(['りんご,1,100,2018-12-01 10:00\n'])
+        upload = ImportJob.objects.create(
+            status=ImportJob.RUNNING, worker='upload:1', started_at=now())
+        self.assertEqual(claim_next_job('worker-1').id, job.id)
+        # 応答している間は、別のワーカーに渡さない
+        self.assertIsNone(claim_next_job('worker-2', stale_timeout=60))
+
+        # ワーカーが停止して応答が無くなったジョブは、別のワーカーがやり直す
+        stopped_at = now() - datetime.timedelta(seconds=61)
+        ImportJob.objects.update(heartbeat_at=stopped_at)
+        with self.assertLogs('apps.sales.jobs', 'WARNING'):
+            claimed = claim_next_job('worker-2', stale_timeout=60)
+        self.assertEqual((claimed.id, claimed.worker), (job.id, 'worker-2'))
+        self.assertGreater(claimed.heartbeat_at, stopped_at)
+        self.assertIsNone(claim_next_job('worker-3', stale_timeout=60))
+        self.assertEqual(run_job(claimed), ImportJob.DONE)
+        self.assertEqual(Sale.objects.count(), 1)
+
+        # 受信しながら登録したジョブはやり直せないため、失敗にする
+        upload.refresh_from_db()
+        self.assertEqual((upload.status, upload.message),
+                         (ImportJob.FAILED, "処理中にワーカーが停止しました"))
+
+
+class SaleExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('staff', password='pw')
+        cls.apple = Item.objects.create(name="りんご", price=100)
+        cls.banana = Item.objects.create(name="バナナ, 台湾産", price=50)
+        for item, item_num, saled_at in (
+            (cls.banana, 2, datetime.datetime(2018, 12, 1, 0, 5)),
+            (cls.apple, 1, datetime.datetime(2018, 11, 30, 23, 59)),
+            (cls.apple, 1, datetime.datetime(2018, 11, 30, 23, 59)),
+            (cls.banana, 3, datetime.datetime(2018, 12, 2, 9, 0)),
+        ):
+            Sale.objects.create(item=item, item_num=item_num,
+                                saled_at=make_aware(saled_at))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def export(self, **params):
+        response = self.client.get(reverse('sales:csv_export'), params)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def sale_values(self):
+        return sorted(Sale.objects.values_list(
+            'item_id', 'item_num', 'amount', 'saled_at'))
+
+    def test_round_trip(self):
+        response, data = self.export()
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="sales.csv"')
+        rows = list(csv.reader(StringIO(data.decode('utf-8'))))
+        # 販売日時順（ローカル時間）で、果物名のカンマは引用符で囲む
+        self.assertEqual(rows[0], ["りんご", "1", "100", "2018-11-30 23:59"])
+        self.assertEqual(rows[2], ["バナナ, 台湾産", "2", "100",
+                                   "2018-12-01 00:05"])
+        expected = self.sale_values()
+
+        Sale.objects.all().delete()
+        result = SaleCsvImporter().import_rows(rows)
+        self.assertEqual((result.created, result.failed), (4, 0))
+        self.assertEqual(self.sale_values(), expected)
+        for rollup in SALE_ROLLUPS:
+            self.assertEqual(rollup.verify(), [], rollup.granularity)
+        # 出力したCSVをもう一度登録しても増えない
+        result = SaleCsvImporter().import_rows(rows)
+        self.assertEqual((result.created, result.duplicates), (0, 4))
+
+    def test_gzip(self):
+        _, plain = self.export(start_date='2018-12-01')
+        response, data = self.export(start_date='2018-12-01', gzip='on')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="sales.csv.gz"')
+        self.assertEqual(gzip.decompress(data), plain)
+        self.assertEqual(len(plain.splitlines()), 2)
+        # 小さく区切って圧縮しても同じ内容になる
+        lines = list(iter_sale_csv_lines(Sale.sources()))
+        chunks = list(iter_chunks(lines, chunk_size=10))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(gzip.decompress(b''.join(iter_gzip(chunks))),
+                         ''.join(lines).encode('utf-8'))
+
+    def test_sources_are_merged_by_saled_at(self):
+        lines = list(iter_sale_csv_lines([
+            Sale.objects.filter(item=self.banana),
+            Sale.objects.filter(item=self.apple),
+        ]))
+        self.assertEqual([line.split(',')[-1].strip() for line in lines], [
+            '2018-11-30 23:59', '2018-11-30 23:59', '2018-12-01 00:05',
+            '2018-12-02 09:00'])
+
+
+@override_settings(CONCURRENT_SECTIONS_MAX_WORKERS=0)
+class SaleStatisticsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('staff', password='pw')
+        cls.item = Item.objects.create(name="りんご", price=100)
+        # 直近の月曜日 9時台に2件
+        today = localdate()
+        monday = today - datetime.timedelta(days=today.weekday())
+        cls.saled_at = make_aware(
+            datetime.datetime.combine(monday, datetime.time(9, 30)))
+        for _ in range(2):
+            Sale.objects.create(item=cls.item, item_num=1,
+                                saled_at=cls.saled_at)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_heatmap(self):
+        heatmap = HourlySaleRollup.get_heatmap(7)
+        self.assertEqual(heatmap[0][9], 200)
+        self.assertEqual(sum(map(sum, heatmap)), 200)
+        self.assertEqual(HourlySaleRollup.verify(), [])
+
+    def test_granularity_and_span(self):
+        url = reverse('sales:statistics')
+        response = self.client.get(url, {'granularity': 'hourly',
+                                         'span': 24 * 7})
+        self.assertEqual(len(response.context['sale_reports']), 24 * 7)
+        response = self.client.get(url, {'granularity': 'weekly',
+                                         'span': 10000})
+        self.assertTrue(response.context['form'].errors['span'])
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['daily_sale_reports']), 3)
+
+    def test_hourly_year_is_paged(self):
+        # 1年分の時間帯別（8品目）を、1週間分ずつのページと期間全体の合計で表示する
+        items = [self.item] + [
+            Item.objects.create(name="果物{}".format(i), price=100)
+            for i in range(7)]
+        span = HourlySaleRollup.max_span
+        periods = recent_hours(span)
+        HourlySaleRollup.objects.all().delete()
+        HourlySaleRollup.objects.bulk_create(
+            (HourlySaleRollup(period=period, item=item, amount=100,
+                              item_num=1, sale_count=1)
+             for period in periods for item in items), batch_size=500)
+
+        started = time.perf_counter()
+        response = self.client.get(reverse('sales:statistics'), {
+            'granularity': 'hourly', 'span': span, 'page': 2})
+        elapsed = time.perf_counter() - started
+        self.assertLess(elapsed, 0.5)
+        self.assertLess(len(response.content), 500 * 1024)
+        reports = response.context['sale_reports']
+        self.assertEqual(len(reports), 24 * 7)
+        self.assertEqual(next(iter(reports)),
+                         year_month_day_hour(periods[24 * 7]))
+        summary = response.context['sale_summary']
+        self.assertEqual(summary['amount'], 100 * 8 * span)
+        self.assertEqual(summary['item_reports']["りんご"]['item_num'], span)
+        self.assertContains(response, 'page=3')
+
+
+class SaleAnalyticsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.apple = Item.objects.create(name="りんご", price=100)
+        cls.banana = Item.objects.create(name="バナナ", price=50)
+        for item, item_num, saled_at in (
+            (cls.apple, 1, datetime.datetime(2017, 1, 1, 9, 0)),
+            (cls.apple, 2, datetime.datetime(2018, 12, 1, 0, 30)),
+            (cls.banana, 3, datetime.datetime(2018, 12, 1, 23, 0)),
+            (cls.apple, 4, datetime.datetime(2018, 12, 3, 8, 0)),
+        ):
+            Sale.objects.create(item=item, item_num=item_num,
+                                saled_at=make_aware(saled_at))
+
+    def snapshot_rows(self, snapshot, granularity, **kwargs):
+        periods, item_ids, totals = snapshot.group_by(granularity, **kwargs)
+        return [(str(period), int(item_id), int(total))
+                for period, item_id, total in zip(periods, item_ids, totals)]
+
+    def test_group_by_matches_database(self):
+        snapshot = SalesSnapshot.from_queryset()
+        start = make_aware(datetime.datetime(2018, 12, 1))
+        end = make_aware(datetime.datetime(2019, 1, 1))
+        rows = Sale.aggregate_by_period(TruncDay, start, end)
+        self.assertEqual(
+            self.snapshot_rows(snapshot, 'day', start=start, end=end),
+            [(str(row['period'].date()), row['item_id'],
+              row['total_amount']) for row in rows])
+        self.assertEqual(
+            self.snapshot_rows(snapshot, 'month', value='item_num',
+                               item_ids=[self.apple.id]),
+            [('2017-01', self.apple.id, 1), ('2018-12', self.apple.id, 6)])
+
+    def test_group_by_renumbers_selected_periods_and_items(self):
+        # 期間が離れ、果物IDが大きくても、絞り込んだ範囲の大きさで集計する
+        at = datetime.datetime(2018, 12, 1, tzinfo=datetime.timezone.utc)
+        epoch = np.array([int(at.timestamp()) - 10 * 365 * 24 * 3600,
+                          int(at.timestamp()),
+                          int(at.timestamp()) + 3600], dtype=np.int64)
+        snapshot = SalesSnapshot({
+            'item_ids': np.array([1, 2000000000, 7], dtype=np.int32),
+            'saled_at': epoch,
+            'local_at': epoch,
+            'amounts': np.array([100, 200, 300], dtype=np.uint32),
+            'item_nums': np.array([1, 2, 3], dtype=np.uint32),
+        })
+        lengths = []
+
+        def bincount(*args, **kwargs):
+            counts = real_bincount(*args, **kwargs)
+            lengths.append(len(counts))
+            return counts
+        real_bincount = np.bincount
+        with mock.patch('numpy.bincount', bincount):
+            rows = self.snapshot_rows(snapshot, 'hour', start=at)
+        self.assertEqual(rows, [('2018-12-01T00', 2000000000, 200),
+                                ('2018-12-01T01', 7, 300)])
+        # 2時間 × 2種類の果物
+        self.assertLessEqual(max(lengths), 4)
+        self.assertEqual(snapshot.top_items(), [
+            (7, 300), (2000000000, 200), (1, 100)])
+
+    def test_open_recomputes_local_time_for_another_timezone(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        SalesSnapshot.from_queryset().save(path)
+        # 2018-12-01 0:30（日本時間）は UTC では 11月30日
+        start = make_aware(datetime.datetime(2018, 11, 1))
+        with timezone.override('UTC'):
+            snapshot = SalesSnapshot.open(path)
+            rows = self.snapshot_rows(snapshot, 'day', start=start)
+        self.assertEqual(rows, [
+            ('2018-11-30', self.apple.id, 200),
+            ('2018-12-01', self.banana.id, 150),
+            ('2018-12-02', self.apple.id, 400),
+        ])
+        snapshot = SalesSnapshot.open(path)
+        self.assertEqual(
+            [row[0] for row in self.snapshot_rows(snapshot, 'day',
+                                                  start=start)],
+            ['2018-12-01', '2018-12-01', '2018-12-03'])
+
+
+class SaleArchiveTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.item = Item.objects.create(name="りんご", price=100)
+        for year in (2017, 2017, 2018):
+            Sale.objects.create(
+                item=cls.item, item_num=1,
+                saled_at=make_aware(datetime.datetime(year, 6, 1, 12, 0)))
+
+    def setUp(self):
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        settings = override_settings(SALES_ARCHIVE_DIR=archive_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(archive.unregister, 2017)
+
+    def test_archive_and_restore(self):
+        result = archive.archive_year(2017, chunk_size=1)
+        self.assertEqual(result.moved, 2)
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertEqual(archive.verify_year(2017), [])
+        # アーカイブ済みの年も含めて読める
+        self.assertEqual(Sale.get_entire_amount(), 300)
+        self.assertEqual(MonthlySaleRollup.verify(), [])
+        rows = Sale.aggregate_by_period(
+            TruncMonth, *archive.year_range(2017))
+        self.assertEqual([row['sale_count'] for row in rows], [2])
+        lines = list(iter_sale_csv_lines(Sale.sources()))
+        self.assertEqual(len(lines), 3)
+
+        result = archive.restore_year(2017)
+        self.assertEqual(result.moved, 2)
+        self.assertEqual(archive.archived_years(), [])
+        self.assertEqual(Sale.objects.count(), 3)
+        self.assertEqual(MonthlySaleRollup.verify(), [])
+
+    def test_export_merges_archived_and_hot_sales(self):
+        # 稼働中のDBの販売情報（IDが小さい）と、アーカイブした年の販売情報
+        deleted = Item.objects.create(name="ぶどう", price=300)
+        Sale.objects.create(
+            item=deleted, item_num=1,
+            saled_at=make_aware(datetime.datetime(2017, 7, 1, 12, 0)))
+        Sale.objects.create(
+            item=self.item, item_num=5,
+            saled_at=make_aware(datetime.datetime(2017, 6, 1, 12, 30)))
+        archive.archive_year(2017)
+        Item.objects.filter(id=deleted.id).delete()
+        Sale.objects.create(
+            item=self.item, item_num=4,
+            saled_at=make_aware(datetime.datetime(2017, 12, 31, 23, 59)))
+        self.client.force_login(
+            get_user_model().objects.create_user('staff', password='pw'))
+
+        response = self.client.get(reverse('sales:csv_export'),
+                                   {'start_date': '2017-01-01'})
+        rows = list(csv.reader(StringIO(
+            b''.join(response.streaming_content).decode('utf-8'))))
+        # 削除済みの果物（ぶどう）の販売情報は出力しない
+        self.assertEqual([(row[1], row[3]) for row in rows], [
+            ('1', '2017-06-01 12:00'), ('1', '2017-06-01 12:00'),
+            ('5', '2017-06-01 12:30'), ('4', '2017-12-31 23:59'),
+            ('1', '2018-06-01 12:00')])
+
+    def test_reimport_after_archive_and_restore(self):
+        rows = [
+            ["りんご", "2", "200", "2017-03-01 10:00"],
+            ["りんご", "2", "200", "2017-03-01 10:00"],
+        ]
+        self.assertEqual(SaleCsvImporter().import_rows(rows).created, 2)
+        entire_amount = Sale.get_entire_amount()
+
+        archive.archive_year(2017)
+        self.assertEqual(
+            ArchivedSale.objects.using(archive.archive_alias(2017))
+            .exclude(import_key=None).count(), 2)
+        # アーカイブ済みの年の行は登録しない（集計も二重にならない）
+        result = SaleCsvImporter().import_rows(rows)
+        self.assertEqual((result.created, result.duplicates), (0, 2))
+        self.assertEqual(Sale.get_entire_amount(), entire_amount)
+
+        archive.restore_year(2017)
+        result = SaleCsvImporter().import_rows(rows)
+        self.assertEqual((result.created, result.duplicates), (0, 2))
+        self.assertEqual(Sale.objects.count(), 5)
+        self.assertEqual(MonthlySaleRollup.verify(), [])
+
+    def test_archive_without_import_key_column_is_upgraded(self):
+        # 登録キーの追加前に作ったアーカイブDB
+        archive.archive_year(2017)
+        alias = archive.archive_alias(2017)
+        archive.unregister(2017)
+        with sqlite3.connect(archive.archive_path(2017)) as db:
+            db.execute('CREATE TABLE t AS SELECT id, item_id, item_num, '
+                       'amount, saled_at, import_job_id FROM {}'.format(
+                           ArchivedSale._meta.db_table))
+            db.execute('DROP TABLE {}'.format(ArchivedSale._meta.db_table))
+            db.execute('ALTER TABLE t RENAME TO {}'.format(
+                ArchivedSale._meta.db_table))
+        self.assertEqual(archive.archived_years(), [2017])
+        self.assertEqual(
+            ArchivedSale.objects.using(alias).filter(import_key=None).count(),
+            2)
+        with connections[alias].cursor() as cursor:
+            indexes = connections[alias].introspection.get_constraints(
+                cursor, ArchivedSale._meta.db_table)
+        self.assertIn('sales_archsale_import_key_idx', indexes)
+        self.assertIn('sales_archsale_saled_at_idx', indexes)
+
+    def test_open_year_is_rejected(self):
+        with self.assertRaises(ValueError):
+            archive.archive_year(datetime.date.today().year + 1)
+
+
+class SaleBenchmarkTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(
+            'staff', password='pw', is_staff=True)
+        cls.item = Item.objects.create(name="りんご", price=100)
+
+    def test_seed_sales_keeps_derived_data_consistent(self):
+        version = report_cache.data_version()
+        # 生成前に果物マスタのキャッシュを読み込んでおく
+        Item.get_catalogue()
+        call_command('seed_sales', items=3, sales=200, days=30, seed=1,
+                     batch_size=50, stdout=StringIO())
+        self.assertEqual(Sale.objects.count(), 200)
+        self.assertEqual(Sale.reconcile_item_counters(verify=True), [])
+        for rollup in SALE_ROLLUPS:
+            self.assertEqual(rollup.verify(), [], rollup.granularity)
+        self.assertNotEqual(report_cache.data_version(), version)
+        self.assertIsNotNone(Item.get_by_name_or_none("果物0002"))
+        self.assertEqual(Item.objects.get(id=self.item.id).units_sold,
+                         Sale.objects.filter(item=self.item).aggregate(
+                             Sum('item_num'))['item_num__sum'])
+
+    def test_make_csv_is_importable_and_repeatable(self):
+        data = benchmarks.make_csv(20, ["りんご"])
+        self.assertEqual(benchmarks.make_csv(20, ["りんご"]), data)
+        rows = list(csv.reader(StringIO(data.decode('utf-8'))))
+        self.assertEqual(len(rows), 20)
+        result = SaleCsvImporter().import_rows(rows)
+        self.assertEqual((result.created, result.failed), (20, 0))
+
+    def test_measure_rolled_back(self):
+        def create():
+            Sale.objects.create(item=self.item, item_num=1,
+                                saled_at=make_aware(
+                                    datetime.datetime(2018, 12, 1, 10, 0)))
+        result = benchmarks.measure(benchmarks.rolled_back(create), 3)
+        self.assertFalse(Sale.objects.exists())
+        self.assertGreater(result['queries'], 0)
+        self.assertGreater(result['peak_memory'], 0)
+        self.assertLessEqual(result['wall_median'], result['wall_max'])
+
+    def test_compare(self):
+        baseline = {
+            'a': {'wall_median': 0.010, 'queries': 3},
+            'b': {'wall_median': 0.010, 'queries': 3},
+        }
+        results = {
+            'a': {'wall_median': 0.011, 'queries': 3},
+            'b': {'wall_median': 0.013, 'queries': 4},
+            'c': {'wall_median': 1.0, 'queries': 100},
+        }
+        regressions = benchmarks.compare(results, baseline, 0.2)
+        self.assertEqual([name for name, _ in regressions], ['b', 'b'])
+
+    def test_run(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        for day in range(1, 16):
+            Sale.objects.create(item=self.item, item_num=1,
+                                saled_at=make_aware(
+                                    datetime.datetime(2018, 12, day, 10, 0)))
+        benchmark = benchmarks.SalesBenchmark(
+            self.user, repeat=1, depths=(1, 100), csv_sizes=(5,))
+        with override_settings(MEDIA_ROOT=media_root):
+            results = benchmark.run(only=['sales:index', 'csv_upload'])
+        # 100ページ目は販売情報が足りないため計測しない
+        self.assertEqual(sorted(results), [
+            'csv_upload 5 rows', 'sales:index first', 'sales:index last',
+            'sales:index page 1'])
+        self.assertEqual(Sale.objects.count(), 15)
+
+    def test_command_outside_test_runner(self):
+        # テストランナーが ALLOWED_HOSTS に加える 'testserver' を外して実行する
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        path = os.path.join(path, 'results.json')
+        for hosts in ({'DEBUG': True, 'ALLOWED_HOSTS': []},
+                      {'ALLOWED_HOSTS': ['.example.com']}):
+            with override_settings(**hosts):
+                call_command('benchmark_sales', username='staff', repeat=1,
+                             depths=[1], csv_rows=[], output=path,
+                             only=['sales:index first'], stdout=StringIO())
+            with open(path) as f:
+                self.assertEqual(list(json.load(f)['results']),
+                                 ['sales:index first'])
+
+
+class SaleBenchmarkQueryCountTests(TransactionTestCase):
+    # 読み込みを replica に向けるため、テストのトランザクションの外で実行する
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'staff', password='pw', is_staff=True)
+        item = Item.objects.create(name="りんご", price=100)
+        Sale.objects.create(item=item, item_num=1, saled_at=localtime())
+        # 書き込みによる primary への固定を外す（リクエストの終わりと同じ）
+        db.finish_request()
+
+    def test_counts_queries_on_every_connection(self):
+        self.assertEqual(router.db_for_read(Sale), 'replica')
+        self.assertGreater(
+            benchmarks.measure(Sale.get_entire_amount, 1)['queries'], 0)
+        # 画面のクエリは計測ミドルウェアの内側で、セクションは別のスレッドで発行する
+        statistics = benchmarks.SalesBenchmark(self.user).get(
+            reverse('sales:statistics'))
+        self.assertGreater(benchmarks.measure(statistics, 1)['queries'], 0)
+        with override_settings(CONCURRENT_SECTIONS_MAX_WORKERS=0):
+            inline = benchmarks.measure(statistics, 1)['queries']
+        self.assertEqual(benchmarks.measure(statistics, 1)['queries'], inline)
+
+
+# インメモリのSQLiteはライブサーバーのスレッドと接続を共有するため、セクションは順に実行する
+@override_settings(CONCURRENT_SECTIONS_MAX_WORKERS=0)
+class SaleLoadTestTests(LiveServerTestCase):
+
+    def setUp(self):
+        get_user_model().objects.create_superuser('admin', '', 'x')
+        item = Item.objects.create(name="りんご", price=100)
+        Sale.objects.create(item=item, item_num=1, saled_at=make_aware(
+            datetime.datetime(2019, 1, 1, 12, 0)))
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        self.output = output_dir + '/results.json'
+
+    def test_loadtest(self):
+        call_command('loadtest', '--url', self.live_server_url,
+                     '--users', '1', '--requests', '10', '--seed', '1',
+                     '--csv-rows', '3', '--output', self.output,
+                     stdout=StringIO())
+        with open(self.output) as f:
+            results = json.load(f)['results']
+        self.assertEqual(results['total']['errors'], 0)
+        self.assertGreater(results['total']['requests'], 10)
+        self.assertLessEqual(results['total']['p50_ms'],
+                             results['total']['p99_ms'])
+        self.assertGreater(Sale.objects.count(), 1)
+
+    def test_invalid_mix(self):
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix(['index=1', 'checkout=1'])
+        self.assertEqual(loadtest.parse_mix(['index=3', 'edit=1']),
+                         {'index': 3, 'edit': 1})
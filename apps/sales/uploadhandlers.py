@@ -0,0 +1,142 @@
+"""
+販売情報CSVを、アップロードの受信と並行して解析・登録するアップロードハンドラ
+
+受信したデータはメモリや一時ファイルに溜めず、届いた分から行に分けて
+SaleCsvImporter に渡す（batch_size 件ごとに登録・コミットする）。
+通信とDBへの登録が重なり、ファイルの大きさによらずメモリ・ディスクの使用量は一定。
+登録の経過はバックグラウンド処理と同じく ImportJob に記録する。
+
+CSRFの検証はリクエスト全体の受信後になるため、受信しながら登録するのは
+Origin（無ければReferer）ヘッダで同じサイトからの送信と確認できた場合だけ。
+確認できない場合は、これまでどおりファイルを受け取ってワーカーに任せる。
+"""
+import codecs
+import csv
+import time
+from urllib.parse import urlparse
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (
+    FileUploadHandler, StopFutureHandlers, StopUpload)
+from django.utils.timezone import now
+from .importers import SaleCsvImporter
+from .jobs import progress_saver, finish_job, worker_name
+from .models import ImportJob
+
+
+def is_same_origin(request):
+    origin = (request.META.get('HTTP_ORIGIN') or
+              request.META.get('HTTP_REFERER'))
+    if not origin:
+        return False
+    return urlparse(origin).netloc == request.get_host()
+
+
+class CsvRowStream:
+    """
+    少しずつ届くバイト列を受け取り、完成した行（リスト）を返す
+    クォートの中の改行は行の区切りにしない
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        # 次のデータが届くまで完成しない、最後の行の途中
+        self.pending = ''
+
+    def feed(self, data, final=False):
+        text = self.pending + self.decoder.decode(data, final)
+        records = []
+        start = position = 0
+        quoted = False
+        while True:
+            newline = text.find('\n', position)
+            if newline < 0:
+                break
+            # ダブルクォートが奇数個ならクォートの中・外が入れ替わる
+            if text.count('"', position, newline) % 2:
+                quoted = not quoted
+            position = newline + 1
+            if not quoted:
+                records.append(text[start:position])
+                start = position
+        self.pending = text[start:]
+        if final and self.pending:
+            records.append(self.pending)
+            self.pending = ''
+        return csv.reader(records)
+
+
+class StreamedSaleCsv(UploadedFile):
+    # 受信しながら登録したCSV（内容は保存していない）
+    def __init__(self, import_job, name, content_type, size):
+        super().__init__(None, name, content_type, size)
+        self.import_job = import_job
+
+
+class StreamingSaleCsvUploadHandler(FileUploadHandler):
+    field_name = 'file'
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.job = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if (field_name != self.field_name or
+                self.content_type != 'text/csv' or
+                not is_same_origin(self.request)):
+            return
+        self.job = ImportJob.objects.create(
+            status=ImportJob.RUNNING,
+            worker='upload:{}'.format(worker_name()),
+            created_by=self.request.user,
+            started_at=now(),
+            heartbeat_at=now(),
+        )
+        self.importer = SaleCsvImporter(
+            atomic=False, on_progress=progress_saver(self.job),
+            import_job=self.job)
+        self.rows = CsvRowStream()
+        self.line = 0
+        self.started = time.monotonic()
+        # 他のハンドラ（メモリ・一時ファイル）には渡さない
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.job is None:
+            return raw_data
+        self.import_rows(self.rows.feed(raw_data))
+        return None
+
+    def file_complete(self, file_size):
+        if self.job is None:
+            return None
+        self.import_rows(self.rows.feed(b'', final=True), finish=True)
+        return StreamedSaleCsv(self.job, self.file_name, self.content_type,
+                               file_size)
+
+    def import_rows(self, rows, finish=False):
+        try:
+            for row in rows:
+                self.line += 1
+                self.importer.add_row(self.line, row)
+            if finish:
+                self.importer.finish()
+        except Exception as e:
+            self.abort(str(e))
+            raise StopUpload(connection_reset=False)
+        if finish:
+            self.importer.result.elapsed = time.monotonic() - self.started
+            finish_job(self.job, self.importer.result, ImportJob.DONE)
+            self.job.status = ImportJob.DONE
+
+    def upload_complete(self):
+        # ファイルの終わりまで届かなかった場合
+        self.abort("アップロードが途中で終了しました")
+
+    def abort(self, message):
+        # 受信・登録を途中で止めた場合（登録済みのバッチはそのまま残る）
+        if self.job is None or self.job.is_finished:
+            return
+        self.importer.result.elapsed = time.monotonic() - self.started
+        finish_job(self.job, self.importer.result, ImportJob.FAILED, message)
+        self.job.status = ImportJob.FAILED
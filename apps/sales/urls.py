@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, api
 
 app_name = 'sales'
 
@@ -8,6 +8,19 @@ urlpatterns = [
     path('register/', views.register, name='register'),
     path('<int:id>/edit/', views.edit, name='edit'),
     path('<int:id>/delete/', views.delete, name='delete'),
+    path('bulk/', views.bulk, name='bulk'),
     path('csv_upload/', views.csv_upload, name='csv_upload'),
-    path('statistics/', views.statistics, name='statistics')
+    path('csv_export/', views.csv_export, name='csv_export'),
+    path('import_jobs/<int:id>/', views.import_job, name='import_job'),
+    path('import_jobs/<int:id>/status/', views.import_job_status,
+         name='import_job_status'),
+    path('item_purge_jobs/<int:id>/', views.item_purge_job,
+         name='item_purge_job'),
+    path('item_purge_jobs/<int:id>/status/', views.item_purge_job_status,
+         name='item_purge_job_status'),
+    path('statistics/', views.statistics, name='statistics'),
+    path('statistics/cache/', views.report_cache_stats,
+         name='report_cache_stats'),
+    path('api/sales/', api.sales, name='api_sales'),
+    path('api/statistics/', api.statistics, name='api_statistics'),
 ]
@@ -1,24 +1,35 @@
+from django.conf import settings
+from django.core.paginator import Paginator
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.http import require_POST
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.contrib import messages
-from django.core.paginator import Paginator
-from io import TextIOWrapper
-import csv
-import datetime
-from .models import Sale
+from django.http import JsonResponse, StreamingHttpResponse
+from fruitshopadmin.concurrency import run_sections
+from fruitshopadmin.pagination import KeysetPaginator
 from apps.items.models import Item
-from .forms import SaleForm
+from .models import (
+    Sale, HourlySaleRollup, DailySaleRollup, MonthlySaleRollup, ImportJob,
+    ItemPurgeJob)
+from .forms import SaleForm, SaleExportForm, SaleBulkForm, StatisticsForm
+from . import report_cache
+from .exporters import iter_sale_csv_lines, iter_chunks, iter_gzip
+from .uploadhandlers import StreamingSaleCsvUploadHandler
 
 
 @login_required
 def index(request):
-    sales = Sale.get_all_object().order_by('-saled_at')
-    paginator = Paginator(sales, 10)
-    page = request.GET.get('page')
-    sales = paginator.get_page(page)
+    paginator = KeysetPaginator(Sale.get_all_object(), 'saled_at', 10)
+    cursor = request.GET.get('cursor')
+    sales = paginator.get_page(cursor)
+    # 果物は結合せず、果物マスタのキャッシュから設定する
+    Item.attach_to(sales)
     return render(request, 'sales/index.html', {
         'sales': sales,
+        'sales_count': paginator.cached_count('sales:index:count'),
+        'export_form': SaleExportForm(),
     })
 
 
@@ -64,37 +75,67 @@ def delete(request, id):
     return redirect('sales:index')
 
 
+@login_required
+def bulk(request):
+    """
+    販売情報の一括操作
+    「確認」では対象件数だけを表示し、「実行」で処理する
+    """
+    preview_count = None
+    if request.method == "POST":
+        form = SaleBulkForm(request.POST)
+        if form.is_valid():
+            operation = form.get_operation(Sale.get_all_object())
+            if 'execute' not in request.POST:
+                preview_count = operation.count()
+            else:
+                result = operation.run()
+                messages.success(request, "{}件の{}が完了しました。".format(
+                    result.affected, operation.label))
+                return redirect('sales:index')
+    else:
+        form = SaleBulkForm(initial=request.GET)
+    return render(request, 'sales/bulk.html', {
+        'form': form,
+        'preview_count': preview_count,
+    })
+
+
+# 画面に表示するエラー行の上限
+CSV_ERROR_DISPLAY_LIMIT = 10
+
+
 @login_required
 @require_POST
+@csrf_exempt
 def csv_upload(request):
-    f = request.FILES['file']
-    if f.content_type == "text/csv":
-        csv_file = TextIOWrapper(f.file, encoding='utf-8')
-        data = csv.reader(csv_file)
-
-        def validate_data(item_num, amount, saled_at):
-            try:
-                int(item_num)
-                int(amount)
-                datetime.datetime.strptime(row[3], "%Y-%m-%d %H:%M")
-            except ValueError:
-                return False
-            return True
-
-        for row in data:
-            item = Item.get_by_name_or_none(row[0])
-            item_num = row[1]
-            amount = row[2]
-            saled_at = row[3]
-            if item is not None and validate_data(item_num, amount, saled_at):
-                Sale.objects.create(
-                    item=item,
-                    item_num=int(row[1]),
-                    amount=int(row[2]),
-                    saled_at=datetime.datetime.strptime(
-                        row[3], "%Y-%m-%d %H:%M")
-                )
-        return redirect('sales:index')
+    # 受信しながら登録するため、request.POST・FILES を読む前にハンドラを追加する
+    # （CSRFの検証は受信後に _csv_upload で行う）
+    handler = StreamingSaleCsvUploadHandler(request)
+    request.upload_handlers.insert(0, handler)
+    try:
+        request.POST
+    except Exception:
+        handler.abort("アップロードが途中で終了しました")
+        raise
+    return _csv_upload(request, handler.job)
+
+
+@csrf_protect
+def _csv_upload(request, streamed_job):
+    if streamed_job is not None:
+        # 受信しながら登録した場合
+        if streamed_job.status == ImportJob.DONE:
+            messages.success(request, "CSVファイルを登録しました。")
+        else:
+            messages.error(request, "CSVファイルの登録を中断しました。")
+        return redirect('sales:import_job', id=streamed_job.pk)
+    f = request.FILES.get('file')
+    if f is not None and f.content_type == "text/csv":
+        # 登録はワーカー（manage.py run_import_workers）で行う
+        job = ImportJob.objects.create(file=f, created_by=request.user)
+        messages.success(request, "CSVファイルを受け付けました。")
+        return redirect('sales:import_job', id=job.pk)
     # csv以外がアップロードされた場合
     else:
         messages.error(request, "csvファイルをアップロードして下さい")
@@ -102,16 +143,111 @@ def csv_upload(request):
 
 
 @login_required
-def statistics(request):
-    # 全期間
-    entire_sales_amount = Sale.get_entire_amount()
-    # 過去３ヶ月
-    monthly_sale_reports = Sale.get_recent_monthly_reports(3)
-    # 過去３日
-    daily_sale_reports = Sale.get_recent_daily_reports(3)
-
-    return render(request, 'sales/statistics.html', {
-        'entire_sales_amount': entire_sales_amount,
-        'monthly_sale_reports': monthly_sale_reports,
-        'daily_sale_reports': daily_sale_reports,
+def csv_export(request):
+    form = SaleExportForm(request.GET)
+    if not form.is_valid():
+        messages.error(request, "出力条件が正しくありません")
+        return redirect('sales:index')
+    # アーカイブ済みの年の販売情報も出力する
+    chunks = iter_chunks(iter_sale_csv_lines(form.filter_sources()))
+    filename = 'sales.csv'
+    if form.cleaned_data['gzip']:
+        chunks = iter_gzip(chunks)
+        filename += '.gz'
+        content_type = 'application/gzip'
+    else:
+        content_type = 'text/csv; charset=utf-8'
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        filename)
+    return response
+
+
+@login_required
+def import_job(request, id):
+    job = ImportJob.get_by_id_or_404(id)
+    return render(request, 'sales/import_job.html', {
+        'job': job,
+        'error_rows': job.error_rows[:CSV_ERROR_DISPLAY_LIMIT],
+    })
+
+
+@login_required
+def import_job_status(request, id):
+    job = ImportJob.get_by_id_or_404(id)
+    return JsonResponse(job.progress())
+
+
+@login_required
+def item_purge_job(request, id):
+    job = ItemPurgeJob.get_by_id_or_404(id)
+    return render(request, 'sales/item_purge_job.html', {
+        'job': job,
     })
+
+
+@login_required
+def item_purge_job_status(request, id):
+    job = ItemPurgeJob.get_by_id_or_404(id)
+    return JsonResponse(job.progress())
+
+
+# 販売統計情報の1ページに表示する期間数（時間帯別なら1週間分）
+STATISTICS_PERIODS_PER_PAGE = 24 * 7
+
+
+@login_required
+def statistics(request):
+    """
+    集計テーブルから、各セクションを並行に取得する
+    時間内に取得できなかったセクションはNone（表示できません）になる
+    集計単位・期間数の指定が無ければ、過去３ヶ月の月別・過去３日の日別を表示する
+    期間数が STATISTICS_PERIODS_PER_PAGE を超える場合は、ページに分けて表示し、
+    期間全体の合計（果物ごと）を別に表示する
+    """
+    form = StatisticsForm(request.GET if 'granularity' in request.GET
+                          else None)
+    sections = {
+        # 全期間
+        'entire_sales_amount': MonthlySaleRollup.get_entire_amount,
+    }
+    if form.is_bound and form.is_valid():
+        span = form.cleaned_data['span']
+        rollup = form.rollup
+        if rollup is None:
+            item = form.cleaned_data['item']
+            sections['heatmap'] = (
+                lambda: HourlySaleRollup.get_heatmap(span, item))
+        else:
+            periods = rollup.recent_periods(span)
+            page = Paginator(periods, STATISTICS_PERIODS_PER_PAGE).get_page(
+                request.GET.get('page'))
+            sections['sale_reports'] = (
+                lambda: rollup.get_reports(page.object_list))
+            if page.paginator.num_pages > 1:
+                sections['sale_summary'] = lambda: rollup.get_summary(periods)
+    elif not form.is_bound:
+        sections.update({
+            # 過去３ヶ月
+            'monthly_sale_reports':
+                lambda: MonthlySaleRollup.get_recent_reports(3),
+            # 過去３日
+            'daily_sale_reports':
+                lambda: DailySaleRollup.get_recent_reports(3),
+        })
+    context = run_sections(
+        sections,
+        timeout=getattr(settings, 'STATISTICS_SECTION_TIMEOUT', 5.0))
+    context['form'] = form if form.is_bound else StatisticsForm()
+    context['hours'] = range(24)
+    if 'sale_summary' in sections:
+        query = request.GET.copy()
+        query.pop('page', None)
+        context['page'] = page
+        context['page_query'] = query.urlencode()
+    return render(request, 'sales/statistics.html', context)
+
+
+@staff_member_required
+def report_cache_stats(request):
+    return JsonResponse(report_cache.stats())
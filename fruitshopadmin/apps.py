@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class FruitShopAdminConfig(AppConfig):
+    name = 'fruitshopadmin'
+
+    def ready(self):
+        # DB接続時の設定（connection_created）を登録する
+        from . import db  # noqa: F401
@@ -0,0 +1,90 @@
+"""
+独立した処理（画面のセクションなど）をスレッドプールで並行に実行する
+
+プールはプロセスで1つ（最大 CONCURRENT_SECTIONS_MAX_WORKERS スレッド）。
+各処理はワーカースレッドのDB接続を使うため、前後で古い接続を閉じ、
+呼び出し元の primary への固定（fruitshopadmin.db）と、リクエストの計測
+（fruitshopadmin.metrics）を引き継ぐ。
+CONCURRENT_SECTIONS_MAX_WORKERS が 0 の場合は、呼び出し元のスレッドで
+順に実行する（テストのトランザクション内のデータを読む場合など）。
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from django.conf import settings
+from django.db import close_old_connections
+from . import db, metrics
+
+logger = logging.getLogger(__name__)
+
+# 時間内に終わらなかった・失敗したセクションの値
+UNAVAILABLE = None
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(
+                    settings, 'CONCURRENT_SECTIONS_MAX_WORKERS', 4),
+                thread_name_prefix='sections')
+    return _executor
+
+
+def _run(func, pinned, request_metrics):
+    close_old_connections()
+    db.start_request(pinned=pinned)
+    try:
+        with metrics.recording(request_metrics):
+            return func()
+    finally:
+        db.finish_request()
+        close_old_connections()
+
+
+def _run_inline(sections):
+    results = {}
+    for name, func in sections.items():
+        try:
+            results[name] = func()
+        except Exception:
+            logger.exception("section %s failed", name)
+            results[name] = UNAVAILABLE
+    return results
+
+
+def run_sections(sections, timeout):
+    """
+    sections: {名前: 引数なしの関数} を並行に実行し、{名前: 結果} を返す
+    timeout 秒（{名前: 秒} で個別にも指定できる）以内に終わらなかった
+    セクションと、例外で失敗したセクションの結果は UNAVAILABLE になる
+    全体の所要時間は、合計ではなく最も遅いセクション（または timeout）になる
+    """
+    if getattr(settings, 'CONCURRENT_SECTIONS_MAX_WORKERS', 4) == 0:
+        return _run_inline(sections)
+    executor = get_executor()
+    started = time.monotonic()
+    pinned = db.is_pinned()
+    request_metrics = metrics.current()
+    futures = {name: executor.submit(_run, func, pinned, request_metrics)
+               for name, func in sections.items()}
+    results = {}
+    for name, future in futures.items():
+        limit = timeout.get(name) if isinstance(timeout, dict) else timeout
+        remaining = max(0.0, started + limit - time.monotonic())
+        try:
+            results[name] = future.result(timeout=remaining)
+        except TimeoutError:
+            # 実行前なら取り消す（実行中の処理は止められないため結果を捨てる）
+            future.cancel()
+            logger.warning("section %s timed out after %.1fs", name, limit)
+            results[name] = UNAVAILABLE
+        except Exception:
+            logger.exception("section %s failed", name)
+            results[name] = UNAVAILABLE
+    return results
@@ -0,0 +1,97 @@
+"""
+DBのルーティング（書き込みは primary、読み込みは replica）と接続時の設定
+
+replica が DATABASES に無い場合は、すべて primary（default）を使う。
+次の場合は、読み込みも primary に向ける
+・primary でトランザクション中（コミット前の書き込みを読むため）
+・そのリクエストで書き込んだ後、または直前に書き込んだ利用者のリクエスト
+  （DATABASE_READ_YOUR_WRITES_SECONDS 秒間。ReadYourWritesMiddleware が判定する）
+"""
+import threading
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+PRIMARY = 'default'
+REPLICA = 'replica'
+
+# SQLiteの接続ごとに設定するPRAGMA（settings.SQLITE_PRAGMAS で上書きできる）
+SQLITE_PRAGMAS = (
+    # 読み込み中でも書き込めるようにする
+    ('journal_mode', 'WAL'),
+    # WALではコミットごとのfsyncを省略しても壊れない
+    ('synchronous', 'NORMAL'),
+    # ロック中は最大5秒待つ
+    ('busy_timeout', '5000'),
+    # ページキャッシュ 約20MB
+    ('cache_size', '-20000'),
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', str(256 * 1024 * 1024)),
+)
+
+_state = threading.local()
+
+
+def start_request(pinned=False):
+    _state.pinned = pinned
+    _state.wrote = False
+
+
+def finish_request():
+    # リクエスト中に書き込んだかを返し、状態を戻す
+    wrote = getattr(_state, 'wrote', False)
+    _state.pinned = False
+    _state.wrote = False
+    return wrote
+
+
+def pin_to_primary():
+    _state.pinned = True
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+def has_replica():
+    return REPLICA in connections.databases
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if not has_replica() or is_pinned():
+            return PRIMARY
+        if connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        # 以降の読み込みは、書き込みが見える primary から行う
+        _state.wrote = True
+        pin_to_primary()
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, REPLICA}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replica は primary の複製のため、マイグレーションは primary だけに行う
+        return db == PRIMARY
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', SQLITE_PRAGMAS)
+    with connection.cursor() as cursor:
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        if connection.alias == REPLICA:
+            # replica からは書き込めないようにする
+            cursor.execute('PRAGMA query_only = ON')
@@ -0,0 +1,141 @@
+"""
+リクエスト単位の計測値（処理時間・SQL・テンプレート）の記録と集計
+
+計測は fruitshopadmin.middleware.RequestMetricsMiddleware が行う。
+ビューごとの直近の処理時間はプロセス内に保持し、
+/internal/metrics/ （スタッフのみ）でパーセンタイルを確認できる。
+"""
+import os
+import re
+import threading
+import time
+from collections import deque, Counter
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import connections
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+
+_local = threading.local()
+_lock = threading.Lock()
+_durations = {}
+
+# IN (%s, %s, ...) の個数の違いは同じ形のクエリとみなす
+_IN_PLACEHOLDERS = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+def window_size():
+    return getattr(settings, 'REQUEST_METRICS_WINDOW', 1000)
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.rendering = False
+        self.shapes = Counter()
+        # 画面のセクションのスレッド（fruitshopadmin.concurrency）からも記録する
+        self._lock = threading.Lock()
+        # 計測中（ベンチマークなど）に始めた計測では、外側にも記録する
+        self.outer = None
+
+    def record_query(self, sql, duration):
+        shape = _IN_PLACEHOLDERS.sub('IN (...)', sql)
+        with self._lock:
+            self.queries += 1
+            self.sql_time += duration
+            self.shapes[shape] += 1
+        if self.outer is not None:
+            self.outer.record_query(sql, duration)
+
+    def repeated_queries(self, threshold):
+        # 同じ形のクエリが threshold 回以上発行されたもの（N+1の疑い）
+        return [(sql, count) for sql, count in self.shapes.most_common()
+                if count >= threshold]
+
+
+def current():
+    # 計測中のリクエストの RequestMetrics（計測していなければNone）
+    return getattr(_local, 'metrics', None)
+
+
+def record_query(execute, sql, params, many, context):
+    # DB接続の execute_wrapper。計測中のリクエストにクエリを記録する
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_metrics = current()
+        if request_metrics is not None:
+            request_metrics.record_query(sql, time.perf_counter() - started)
+
+
+@contextmanager
+def recording(request_metrics):
+    """
+    with の中でこのスレッドが発行したクエリを request_metrics に記録する
+    DB接続はスレッドごとのため、別のスレッドで実行する処理
+    （画面のセクションなど）は、そのスレッドでも recording に入る
+    recording の中で入れ子にすると、内側のクエリは外側にも記録する
+    request_metrics がNoneなら何もしない
+    """
+    if request_metrics is None:
+        yield
+        return
+    previous = current()
+    if previous is not None and previous is not request_metrics:
+        request_metrics.outer = previous
+    _local.metrics = request_metrics
+    try:
+        with ExitStack() as stack:
+            # 入れ子の場合、このスレッドの接続には外側で登録済み
+            if previous is None:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(record_query))
+            yield
+    finally:
+        _local.metrics = previous
+
+
+def record_duration(view_name, duration):
+    with _lock:
+        durations = _durations.get(view_name)
+        if durations is None:
+            durations = _durations[view_name] = deque(maxlen=window_size())
+    durations.append(duration)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summary():
+    with _lock:
+        snapshot = {name: sorted(durations)
+                    for name, durations in _durations.items()}
+    return {
+        name: {
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000,
+        }
+        for name, values in sorted(snapshot.items())
+    }
+
+
+@staff_member_required
+def metrics_view(request):
+    return JsonResponse({
+        'pid': os.getpid(),
+        'window': window_size(),
+        'views': summary(),
+    })
@@ -0,0 +1,191 @@
+import json
+import logging
+import random
+import time
+from django.conf import settings
+from django.template.backends.django import Template
+from . import db, metrics, profiling
+
+logger = logging.getLogger('fruitshopadmin.requests')
+
+
+def _instrument_templates():
+    # テンプレートの描画時間を、計測中のリクエストに加算する
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    def instrumented_render(self, *args, **kwargs):
+        request_metrics = metrics.current()
+        # 描画中に別のテンプレートを描画する場合（ウィジェットなど）は外側だけ数える
+        if request_metrics is None or request_metrics.rendering:
+            return render(self, *args, **kwargs)
+        request_metrics.rendering = True
+        started = time.perf_counter()
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            request_metrics.template_time += time.perf_counter() - started
+            request_metrics.rendering = False
+
+    instrumented_render.instrumented = True
+    Template.render = instrumented_render
+
+
+class RequestMetricsMiddleware:
+    """
+    リクエストごとの処理時間・SQLの件数と時間・テンプレートの描画時間を計測し、
+    構造化ログ（JSON）として出力する
+    同じ形のクエリが繰り返し発行されていればN+1の疑いとして警告する
+
+    処理時間はすべてのリクエストで記録し、SQL・テンプレートの計測は
+    REQUEST_METRICS_SAMPLE_RATE の割合のリクエストだけで行う
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(
+            settings, 'REQUEST_METRICS_SAMPLE_RATE', 1.0)
+        self.n_plus_one_threshold = getattr(
+            settings, 'REQUEST_METRICS_N_PLUS_ONE_THRESHOLD', 5)
+        _instrument_templates()
+
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            started = time.perf_counter()
+            response = self.get_response(request)
+            metrics.record_duration(
+                self.view_name(request), time.perf_counter() - started)
+            return response
+
+        request_metrics = metrics.RequestMetrics()
+        with metrics.recording(request_metrics):
+            started = time.perf_counter()
+            response = self.get_response(request)
+            # ストリーミングでないレスポンスは、ここまでで描画済み
+            duration = time.perf_counter() - started
+
+        view_name = self.view_name(request)
+        metrics.record_duration(view_name, duration)
+        self.log(request, response, view_name, duration, request_metrics)
+        return response
+
+    @staticmethod
+    def view_name(request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unresolved'
+        return match.view_name
+
+    def log(self, request, response, view_name, duration, request_metrics):
+        repeated = request_metrics.repeated_queries(self.n_plus_one_threshold)
+        record = {
+            'view': view_name,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(duration * 1000, 2),
+            'view_ms': round(
+                (duration - request_metrics.template_time) * 1000, 2),
+            'template_ms': round(request_metrics.template_time * 1000, 2),
+            'sql_ms': round(request_metrics.sql_time * 1000, 2),
+            'queries': request_metrics.queries,
+        }
+        if repeated:
+            record['n_plus_one'] = [
+                {'sql': sql, 'count': count} for sql, count in repeated]
+            logger.warning(json.dumps(record, ensure_ascii=False))
+        else:
+            logger.info(json.dumps(record, ensure_ascii=False))
+
+
+class ReadYourWritesMiddleware:
+    """
+    書き込んだ利用者の直後のリクエストでは、読み込みも primary から行う
+    （replica への反映が遅れても、自分の変更が見えるようにする）
+    書き込んだかどうかは fruitshopadmin.db.PrimaryReplicaRouter が記録し、
+    DATABASE_READ_YOUR_WRITES_SECONDS 秒間有効なCookieで引き継ぐ
+    """
+    cookie_name = 'primary_until'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.seconds = getattr(
+            settings, 'DATABASE_READ_YOUR_WRITES_SECONDS', 5)
+
+    def __call__(self, request):
+        try:
+            until = float(request.COOKIES.get(self.cookie_name, 0))
+        except ValueError:
+            until = 0
+        db.start_request(pinned=until > time.time())
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = db.finish_request()
+        if wrote and self.seconds:
+            response.set_cookie(
+                self.cookie_name, str(time.time() + self.seconds),
+                max_age=self.seconds, httponly=True, samesite='Lax')
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    指定されたリクエストのビューをプロファイラの下で実行し、
+    プロファイルを保存する（fruitshopadmin.profiling）
+    ・スタッフが PROFILING_QUERY_PARAM（?_profile=1）か X-Profile: 1 ヘッダを
+      付けたリクエスト
+    ・PROFILING_SAMPLED_VIEWS {ビュー名: N} のビューの、N件に1件のリクエスト
+      （cProfile は使わず、一定間隔でスタックを採るだけにする）
+    利用者を判定するため AuthenticationMiddleware より後に置く
+    ビューだけを対象とするため、ビューの後で描画する TemplateResponse や
+    ストリーミングのレスポンスの生成は含まれない
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    @staticmethod
+    def trigger(request, view_name):
+        query_param = getattr(settings, 'PROFILING_QUERY_PARAM', '_profile')
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_staff and (
+                request.GET.get(query_param) == '1' or
+                request.META.get('HTTP_X_PROFILE') == '1'):
+            return 'requested'
+        rate = getattr(settings, 'PROFILING_SAMPLED_VIEWS', {}).get(view_name)
+        if rate and random.random() < 1.0 / rate:
+            return 'sampled'
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_name = RequestMetricsMiddleware.view_name(request)
+        trigger = self.trigger(request, view_name)
+        if trigger is None or not profiling.try_acquire():
+            return None
+        try:
+            # サンプリングしたリクエストは StackSampler だけでプロファイルする
+            profile = profiling.RequestProfile(
+                deterministic=trigger == 'requested')
+            response = None
+            try:
+                with profile:
+                    response = view_func(request, *view_args, **view_kwargs)
+            finally:
+                name = profile.save({
+                    'view': view_name,
+                    'method': request.method,
+                    'path': request.get_full_path(),
+                    'status': getattr(response, 'status_code', None),
+                    'trigger': trigger,
+                    'user': request.user.get_username()
+                    if request.user.is_authenticated else None,
+                })
+        finally:
+            profiling.release()
+        response['X-Profile-Name'] = name
+        return response
@@ -0,0 +1,239 @@
+import base64
+import json
+from datetime import datetime
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections, router
+from django.db.models import DateTimeField, Q, Min, Max
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+# 件数（概数）をキャッシュする秒数
+COUNT_CACHE_TIMEOUT = 60
+# EstimatedCountPaginator が数える件数の上限
+ESTIMATED_COUNT_LIMIT = 10000
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(direction, value, pk):
+    # 並べ替えの列は日時または整数（NULLを許す列の NULL は None）
+    if value is not None and not isinstance(value, int):
+        value = value.isoformat()
+    data = json.dumps([direction, value, pk])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def _is_int(value):
+    # JSON の true/false も int になるため除く
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor, field=None):
+    """
+    encode_cursor の値を (direction, value, pk) に戻す
+    field（並べ替えの列のモデルのフィールド）を指定した場合は、
+    value がその型（日時または整数）であることも確かめる
+    value が None（NULL）のカーソルは、NULLを許す field を指定した場合だけ使える
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode())
+        direction, value, pk = json.loads(data.decode())
+        if value is not None and not _is_int(value):
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError(value)
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    if direction not in ('next', 'prev') or not _is_int(pk):
+        raise InvalidCursor(cursor)
+    if value is None:
+        if field is None or not field.null:
+            raise InvalidCursor(cursor)
+    elif field is not None and (
+            isinstance(field, DateTimeField) != isinstance(value, datetime)):
+        raise InvalidCursor(cursor)
+    return direction, value, pk
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        # 空のページからはカーソルを作れないため、前後のリンクは出さない
+        self.has_next = has_next and bool(object_list)
+        self.has_previous = has_previous and bool(object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _position(self, obj):
+        if isinstance(obj, dict):
+            # values() の行（field と id を含めておく）
+            return obj[self.paginator.field], obj['id']
+        return getattr(obj, self.paginator.field), obj.pk
+
+    def next_cursor(self):
+        return encode_cursor('next', *self._position(self.object_list[-1]))
+
+    def previous_cursor(self):
+        return encode_cursor('prev', *self._position(self.object_list[0]))
+
+
+class KeysetPaginator:
+    """
+    (field, id) の降順で並べるカーソル方式のページネーション
+    OFFSETやCOUNT(*)を使わないため、どのページも同じコストで取得できる
+    NULLを許す field の場合、NULL の行は値のある行の後に id の降順で並べる
+    （値のある行と NULL の行を別々のクエリで取得し、どちらもインデックスを使う）
+
+    カーソル:
+        None   => 最初のページ
+        'last' => 最後のページ
+        それ以外 => KeysetPage.next_cursor / previous_cursor が返す値
+    """
+
+    def __init__(self, queryset, field, per_page):
+        self.queryset = queryset
+        self.field = field
+        self.per_page = per_page
+
+    @cached_property
+    def model_field(self):
+        return self.queryset.model._meta.get_field(self.field)
+
+    def get_page(self, cursor=None):
+        if cursor == 'last':
+            return self._last_page()
+        if cursor:
+            try:
+                direction, value, pk = decode_cursor(cursor, self.model_field)
+            except InvalidCursor:
+                return self._first_page()
+            if direction == 'next':
+                return self._page_after(value, pk)
+            return self._page_before(value, pk)
+        return self._first_page()
+
+    def _sections(self, descending):
+        # 並び順の区間 [(queryset, NULLの区間か), ...]（昇順は逆順）
+        if not self.model_field.null:
+            return [(self.queryset, False)]
+        sections = [
+            (self.queryset.filter(**{self.field + '__isnull': False}), False),
+            (self.queryset.filter(**{self.field + '__isnull': True}), True),
+        ]
+        return sections if descending else sections[::-1]
+
+    def _ordered(self, queryset, descending, is_null):
+        fields = ['pk'] if is_null else [self.field, 'pk']
+        if descending:
+            fields = ['-' + field for field in fields]
+        return queryset.order_by(*fields)
+
+    def _beyond(self, value, pk, descending):
+        # 並び順で (value, pk) より後ろの行の条件
+        lookup = '__lt' if descending else '__gt'
+        if value is None:
+            return Q(**{'pk' + lookup: pk})
+        return (Q(**{self.field + lookup: value}) |
+                Q(**{self.field: value, 'pk' + lookup: pk}))
+
+    def _fetch(self, descending, position=None):
+        """
+        並び順（descending=False なら逆順）で position (value, pk) より後ろの行を
+        per_page + 1 件まで取得する（position が None なら先頭から）
+        """
+        limit = self.per_page + 1
+        rows = []
+        for queryset, is_null in self._sections(descending):
+            if position is not None:
+                # position より前の区間は読まない
+                if (position[0] is None) != is_null:
+                    continue
+                queryset = queryset.filter(
+                    self._beyond(*position, descending=descending))
+                position = None
+            rows.extend(self._ordered(queryset, descending, is_null)
+                        [:limit - len(rows)])
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def _first_page(self):
+        rows = self._fetch(descending=True)
+        return KeysetPage(rows[:self.per_page], self,
+                          has_next=len(rows) > self.per_page,
+                          has_previous=False)
+
+    def _last_page(self):
+        rows = self._fetch(descending=False)
+        return KeysetPage(rows[:self.per_page][::-1], self,
+                          has_next=False,
+                          has_previous=len(rows) > self.per_page)
+
+    def _page_after(self, value, pk):
+        rows = self._fetch(descending=True, position=(value, pk))
+        return KeysetPage(rows[:self.per_page], self,
+                          has_next=len(rows) > self.per_page,
+                          has_previous=True)
+
+    def _page_before(self, value, pk):
+        rows = self._fetch(descending=False, position=(value, pk))
+        return KeysetPage(rows[:self.per_page][::-1], self,
+                          has_next=True,
+                          has_previous=len(rows) > self.per_page)
+
+    def cached_count(self, cache_key):
+        # 総件数はCOUNT_CACHE_TIMEOUT秒キャッシュした値を使う（概数）
+        return cache.get_or_set(
+            cache_key, self.queryset.count, COUNT_CACHE_TIMEOUT)
+
+
+def estimate_table_rows(model):
+    """
+    テーブルの行数の概数（COUNT(*)で全件を数えない）
+    PostgreSQL は統計情報（pg_class.reltuples）、それ以外は主キーの範囲から求める
+    """
+    connection = connections[router.db_for_read(model)]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                [model._meta.db_table])
+            row = cursor.fetchone()
+        # 一度も ANALYZE していないテーブルは -1（または0）
+        if row is not None and row[0] > 0:
+            return int(row[0])
+    # SQLiteは MIN と MAX を別々の文にすると、主キーの端を読むだけで済む
+    manager = model._default_manager
+    first = manager.aggregate(value=Min('pk'))['value']
+    if first is None:
+        return 0
+    return manager.aggregate(value=Max('pk'))['value'] - first + 1
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    件数を limit 件までしか数えないページネーション（管理画面の一覧用）
+    limit を超える場合、絞り込みが無ければテーブル全体の概数を、
+    絞り込みがあれば limit を件数とする（limit より後のページは表示しない）
+    """
+    limit = ESTIMATED_COUNT_LIMIT
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        # LIMIT を付けた副問い合わせで数えるため、limit 件を超えて読まない
+        counted = queryset.order_by()[:self.limit + 1].count()
+        if counted <= self.limit:
+            return counted
+        if not queryset.query.where:
+            return max(estimate_table_rows(queryset.model), self.limit)
+        return self.limit
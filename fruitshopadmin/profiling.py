@@ -0,0 +1,257 @@
+"""
+リクエスト単位のプロファイル（本番環境で遅いページの調査用）
+
+fruitshopadmin.middleware.ProfilingMiddleware が、次のリクエストのビューを
+プロファイラの下で実行する
+・スタッフが ?_profile=1 または X-Profile: 1 ヘッダを付けたリクエスト
+・PROFILING_SAMPLED_VIEWS {ビュー名: N} のビューの、N件に1件のリクエスト
+サンプリングしたリクエストは、オーバーヘッドの小さい StackSampler だけで
+プロファイルする。cProfile（全ての関数呼び出しを記録する）はスタッフが
+指定したリクエストだけに使う。
+
+プロファイルは PROFILING_DIR に、1件ごとに次のファイルとして保存する
+・<名前>.pstats     cProfile の結果（pstats・snakeviz などで読む。
+                    cProfile を使ったリクエストのみ）
+・<名前>.collapsed  一定間隔で採ったスタックの集計（flamegraph.pl・speedscope 用）
+・<名前>.json       リクエストの情報（ビュー・パス・状態・処理時間など）
+件数（PROFILING_MAX_PROFILES）・合計サイズ（PROFILING_MAX_BYTES）を超えた分は
+古い順に削除する。/internal/profiles/ （スタッフのみ）で一覧できる。
+"""
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404
+from django.shortcuts import render
+from django.utils.timezone import now
+
+# 保存したプロファイルの名前（<日時（マイクロ秒まで）>_<ID>。名前の順が保存の順）
+PROFILE_NAME = re.compile(r'^\d{8}T\d{12}_[0-9a-f]{8}$')
+PROFILE_KINDS = {
+    'pstats': 'application/octet-stream',
+    'collapsed': 'text/plain; charset=utf-8',
+}
+
+_lock = threading.Lock()
+_running = [0]
+
+
+def profiling_dir():
+    return getattr(settings, 'PROFILING_DIR',
+                   os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+def max_profiles():
+    return getattr(settings, 'PROFILING_MAX_PROFILES', 100)
+
+
+def max_bytes():
+    return getattr(settings, 'PROFILING_MAX_BYTES', 100 * 1024 * 1024)
+
+
+def sample_interval():
+    # スタックを採る間隔（秒）
+    return getattr(settings, 'PROFILING_SAMPLE_INTERVAL', 0.005)
+
+
+def try_acquire():
+    # 同時にプロファイルするリクエストを PROFILING_MAX_CONCURRENT 件までにする
+    with _lock:
+        if _running[0] >= getattr(settings, 'PROFILING_MAX_CONCURRENT', 2):
+            return False
+        _running[0] += 1
+        return True
+
+
+def release():
+    with _lock:
+        _running[0] -= 1
+
+
+def frame_label(code):
+    # 関数名 (ファイル:行)。ファイルはプロジェクトまたは site-packages からの相対パス
+    filename = code.co_filename
+    marker = filename.rfind('site-packages' + os.sep)
+    if marker >= 0:
+        filename = filename[marker + len('site-packages' + os.sep):]
+    elif filename.startswith(settings.BASE_DIR):
+        filename = os.path.relpath(filename, settings.BASE_DIR)
+    return '{} ({}:{})'.format(code.co_name, filename, code.co_firstlineno)
+
+
+class StackSampler:
+    """
+    別スレッドから一定間隔で対象スレッドのスタックを採り、
+    collapsed形式（"根;…;葉" => 回数）で集計する
+    対象はリクエストのスレッドと、画面のセクションを実行するスレッド
+    （fruitshopadmin.concurrency。別のリクエストの処理が混ざることがある）
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='profiling-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _targets(self):
+        targets = {self.thread_id: 'request'}
+        for thread in threading.enumerate():
+            if thread.name.startswith('sections'):
+                targets[thread.ident] = thread.name
+        return targets
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, name in self._targets().items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(name)
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in self.stacks.most_common())
+
+
+class RequestProfile:
+    """
+    with の中の処理を StackSampler（deterministic の場合は cProfile も）で
+    プロファイルし、save() で保存する
+    """
+
+    def __init__(self, deterministic=True):
+        self.profile = cProfile.Profile() if deterministic else None
+        self.sampler = StackSampler(threading.get_ident(), sample_interval())
+        self.duration = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.sampler.start()
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.disable()
+        self.duration = time.perf_counter() - self.started
+        self.sampler.stop()
+        return False
+
+    def save(self, metadata):
+        directory = profiling_dir()
+        os.makedirs(directory, exist_ok=True)
+        name = '{}_{}'.format(now().strftime('%Y%m%dT%H%M%S%f'),
+                              uuid.uuid4().hex[:8])
+        path = os.path.join(directory, name)
+        kinds = ['collapsed']
+        if self.profile is not None:
+            self.profile.dump_stats(path + '.pstats')
+            kinds.insert(0, 'pstats')
+        with open(path + '.collapsed', 'w', encoding='utf-8') as f:
+            f.write(self.sampler.collapsed())
+        metadata = dict(
+            metadata,
+            name=name,
+            kinds=kinds,
+            created_at=now().isoformat(),
+            duration_ms=round(self.duration * 1000, 2),
+            samples=self.sampler.samples,
+            pid=os.getpid(),
+        )
+        # 一覧は .json を読むため、最後に書く
+        with open(path + '.json', 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        prune()
+        return name
+
+
+def profile_paths(name):
+    base = os.path.join(profiling_dir(), name)
+    return [base + '.json'] + [base + '.' + kind for kind in PROFILE_KINDS]
+
+
+def list_profiles():
+    # 保存済みのプロファイルの情報を新しい順に返す
+    try:
+        filenames = os.listdir(profiling_dir())
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for filename in sorted(filenames, reverse=True):
+        name, ext = os.path.splitext(filename)
+        if ext != '.json' or not PROFILE_NAME.match(name):
+            continue
+        try:
+            with open(os.path.join(profiling_dir(), filename),
+                      encoding='utf-8') as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            # 削除中・書き込み中のもの
+            continue
+        # kinds の無いものは cProfile を必ず使っていた頃のもの
+        metadata.setdefault('kinds', list(PROFILE_KINDS))
+        metadata['bytes'] = sum(
+            os.path.getsize(path) for path in profile_paths(name)
+            if os.path.exists(path))
+        profiles.append(metadata)
+    return profiles
+
+
+def prune():
+    # 件数・合計サイズの上限を超えた分を古い順に削除する
+    kept_bytes = 0
+    for i, metadata in enumerate(list_profiles()):
+        kept_bytes += metadata['bytes']
+        if i < max_profiles() and kept_bytes <= max_bytes():
+            continue
+        for path in profile_paths(metadata['name']):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+@staff_member_required
+def profiles_view(request):
+    return render(request, 'internal/profiles.html', {
+        'profiles': list_profiles(),
+        'max_profiles': max_profiles(),
+        'max_bytes': max_bytes(),
+    })
+
+
+@staff_member_required
+def profile_download(request, name, kind):
+    if not PROFILE_NAME.match(name) or kind not in PROFILE_KINDS:
+        raise Http404
+    path = os.path.join(profiling_dir(), '{}.{}'.format(name, kind))
+    if not os.path.exists(path):
+        raise Http404
+    return FileResponse(open(path, 'rb'), as_attachment=True,
+                        content_type=PROFILE_KINDS[kind],
+                        filename='{}.{}'.format(name, kind))
@@ -31,9 +31,12 @@ INSTALLED_APPS = [
     'apps.user',
     'apps.items',
     'apps.sales',
+    'fruitshopadmin',
 ]
 
 MIDDLEWARE = [
+    'fruitshopadmin.middleware.RequestMetricsMiddleware',
+    'fruitshopadmin.middleware.ReadYourWritesMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -41,6 +44,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'fruitshopadmin.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'fruitshopadmin.urls'
@@ -67,13 +71,77 @@ WSGI_APPLICATION = 'fruitshopadmin.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
+# 書き込みは default（primary）、集計・一覧などの読み込みは replica を使う
+# （fruitshopadmin.db.PrimaryReplicaRouter）。
+# SQLiteでは同じファイルを読み込み専用の接続で開き、WALモードで
+# 読み込みが書き込みを待たせないようにする。
+# PostgreSQLでは、replica にストリーミングレプリケーションの複製を指定する。
+#   'default': {'ENGINE': 'django.db.backends.postgresql',
+#               'HOST': 'primary', ...},
+#   'replica': {'ENGINE': 'django.db.backends.postgresql',
+#               'HOST': 'replica', ...},
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {'timeout': 20},
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {'timeout': 20},
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['fruitshopadmin.db.PrimaryReplicaRouter']
+
+# 書き込んだ利用者の読み込みを primary に向け続ける秒数（0で無効）
+DATABASE_READ_YOUR_WRITES_SECONDS = 5
+
+# 画面のセクションを並行に取得するスレッド数（fruitshopadmin.concurrency）
+# 0 の場合は並行にせず、リクエストのスレッドで順に取得する
+CONCURRENT_SECTIONS_MAX_WORKERS = 4
+# 販売統計情報の各セクションの待ち時間（秒）
+STATISTICS_SECTION_TIMEOUT = 5.0
+
+# リクエストのプロファイル（fruitshopadmin.profiling）
+# スタッフは ?_profile=1 か X-Profile: 1 ヘッダでいつでもプロファイルできる
+# {ビュー名: N} のビューは、N件に1件のリクエストをプロファイルする
+PROFILING_SAMPLED_VIEWS = {}
+PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+# 保存するプロファイルの件数・合計サイズの上限（超えた分は古い順に削除）
+PROFILING_MAX_PROFILES = 100
+PROFILING_MAX_BYTES = 100 * 1024 * 1024
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 期間別売上情報・果物マスタのバージョンなど、複数プロセスで共有するキャッシュ
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'shared'),
+        'TIMEOUT': 60 * 60 * 24,
+    },
 }
 
+SALES_REPORT_CACHE = 'shared'
+ITEM_CATALOGUE_CACHE = 'shared'
+
+# テスト中はキャッシュをすべて LocMemCache にする（cache/ に書き込まない）
+TEST_RUNNER = 'fruitshopadmin.test_runner.TestRunner'
+
+# 締めた年の販売情報のアーカイブDB（manage.py archive_sales_year）の置き場所
+SALES_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -116,6 +184,10 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, "static"),
 )
 
+# Uploaded files (CSV import jobs)
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+
 AUTH_USER_MODEL = 'user.User'
 
 LOGIN_URL = 'home:login'
@@ -123,3 +195,29 @@ LOGIN_REDIRECT_URL = 'home:index'
 LOGOUT_REDIRECT_URL = 'home:index'
 
 NUMBER_GROUPING = 3
+
+# Request metrics (fruitshopadmin.middleware.RequestMetricsMiddleware)
+# SQL・テンプレートを計測するリクエストの割合
+# 計測したリクエストは1件ごとにJSONの1行をログに出力する（処理時間は全件記録する）
+REQUEST_METRICS_SAMPLE_RATE = 0.1
+# 同じ形のクエリがこの回数以上発行されたらN+1の疑いとして警告する
+REQUEST_METRICS_N_PLUS_ONE_THRESHOLD = 5
+# パーセンタイルの計算に使う、ビューごとの直近のリクエスト数
+REQUEST_METRICS_WINDOW = 1000
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'fruitshopadmin.requests': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,40 @@
+"""
+manage.py test のテストランナー
+
+テスト中はすべてのキャッシュをプロセス内（LocMemCache）にする。
+設定の 'shared'（FileBasedCache）のままだと、テストの期間別売上情報・
+果物マスタがリポジトリの cache/ に書き込まれ、開発用サーバーに表示されてしまう。
+また、リクエストごとの計測値のログ（fruitshopadmin.requests）は出力しない。
+"""
+import logging
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+def test_caches():
+    # 設定と同じ名前のキャッシュを、それぞれ別の LocMemCache にする
+    return {
+        alias: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'test-{}'.format(alias),
+            'TIMEOUT': config.get('TIMEOUT', 300),
+        }
+        for alias, config in settings.CACHES.items()
+    }
+
+
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.test_settings = override_settings(CACHES=test_caches())
+        self.test_settings.enable()
+        self.request_logger = logging.getLogger('fruitshopadmin.requests')
+        self.request_log_level = self.request_logger.level
+        self.request_logger.setLevel(logging.CRITICAL)
+
+    def teardown_test_environment(self, **kwargs):
+        self.request_logger.setLevel(self.request_log_level)
+        self.test_settings.disable()
+        super().teardown_test_environment(**kwargs)
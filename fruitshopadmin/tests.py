@@ -0,0 +1,290 @@
+import base64
+import datetime
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import time
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
+from django.test import (
+    SimpleTestCase, TestCase, TransactionTestCase, override_settings)
+from django.urls import reverse
+from django.utils.timezone import make_aware
+from apps.items.models import Item
+from . import db, metrics, profiling
+from .concurrency import run_sections, UNAVAILABLE
+from .pagination import (
+    InvalidCursor, KeysetPaginator, decode_cursor, encode_cursor)
+
+
+def raw_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+class PrimaryReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.router = db.PrimaryReplicaRouter()
+        db.start_request()
+        self.addCleanup(db.finish_request)
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.router.db_for_read(None), db.REPLICA)
+
+    def test_reads_after_write_go_to_primary(self):
+        self.assertEqual(self.router.db_for_write(None), db.PRIMARY)
+        self.assertEqual(self.router.db_for_read(None), db.PRIMARY)
+        self.assertTrue(db.finish_request())
+
+    def test_pinned_request_reads_primary(self):
+        db.start_request(pinned=True)
+        self.assertEqual(self.router.db_for_read(None), db.PRIMARY)
+
+    def test_migrations_only_on_primary(self):
+        self.assertTrue(self.router.allow_migrate(db.PRIMARY, 'sales'))
+        self.assertFalse(self.router.allow_migrate(db.REPLICA, 'sales'))
+
+
+class CursorTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        at = make_aware(datetime.datetime(2018, 12, 1, 12, 0))
+        self.assertEqual(decode_cursor(encode_cursor('next', at, 3)),
+                         ('next', at, 3))
+        self.assertEqual(decode_cursor(encode_cursor('prev', 120, 4)),
+                         ('prev', 120, 4))
+
+    def test_malformed_cursors_are_rejected(self):
+        for cursor in (
+            'not base64!',
+            raw_cursor(['next', 1]),
+            raw_cursor(['back', 1, 1]),
+            raw_cursor(['next', 'yesterday', 1]),
+            raw_cursor(['next', '2018-13-01T00:00:00+09:00', 1]),
+            # 主キーが整数でないもの
+            raw_cursor(['next', 1, 'abc']),
+            raw_cursor(['next', 1, [1]]),
+            raw_cursor(['next', 1, None]),
+            raw_cursor(['next', 1, 1.5]),
+            raw_cursor(['next', True, 1]),
+        ):
+            with self.subTest(cursor=cursor), self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+
+    def test_value_must_match_field_type(self):
+        updated_at = Item._meta.get_field('updated_at')
+        revenue = Item._meta.get_field('revenue')
+        at = encode_cursor('next', make_aware(datetime.datetime(2018, 12, 1)),
+                           1)
+        number = encode_cursor('next', 100, 1)
+        self.assertEqual(decode_cursor(at, updated_at)[1].year, 2018)
+        self.assertEqual(decode_cursor(number, revenue)[1], 100)
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(number, updated_at)
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(at, revenue)
+
+    def test_null_value_only_for_nullable_field(self):
+        last_saled_at = Item._meta.get_field('last_saled_at')
+        cursor = encode_cursor('next', None, 1)
+        self.assertEqual(decode_cursor(cursor, last_saled_at),
+                         ('next', None, 1))
+        for field in (None, Item._meta.get_field('updated_at')):
+            with self.subTest(field=field), self.assertRaises(InvalidCursor):
+                decode_cursor(cursor, field)
+
+
+class KeysetPaginatorTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for price in (100, 50, 30):
+            Item.objects.create(name=str(price), price=price)
+
+    def test_invalid_cursor_shows_first_page(self):
+        paginator = KeysetPaginator(Item.objects.all(), 'updated_at', 2)
+        first = [item.id for item in paginator.get_page()]
+        for cursor in (raw_cursor(['next', '2018-12-01T00:00:00', 'abc']),
+                       encode_cursor('next', 100, first[-1])):
+            with self.subTest(cursor=cursor):
+                page = paginator.get_page(cursor)
+                self.assertEqual([item.id for item in page], first)
+
+    def test_nulls_are_paged_after_values(self):
+        # 最終販売日時の降順、販売実績の無い果物（NULL）は id の降順で最後に並ぶ
+        items = list(Item.objects.order_by('id'))
+        items += [Item.objects.create(name=str(i), price=10) for i in range(2)]
+        for days, item in enumerate(items[:3]):
+            Item.add_sales(item.id, 1, 10, make_aware(
+                datetime.datetime(2018, 12, 10 - days)))
+        expected = [item.id for item in items[:3]] + [
+            item.id for item in items[:2:-1]]
+        paginator = KeysetPaginator(Item.objects.all(), 'last_saled_at', 2)
+
+        pages, page = [], paginator.get_page()
+        while True:
+            pages.append([item.id for item in page])
+            if not page.has_next:
+                break
+            page = paginator.get_page(page.next_cursor())
+        self.assertEqual(pages, [expected[0:2], expected[2:4], expected[4:]])
+
+        backward, page = [], paginator.get_page('last')
+        while True:
+            backward.insert(0, [item.id for item in page])
+            if not page.has_previous:
+                break
+            page = paginator.get_page(page.previous_cursor())
+        self.assertEqual(backward, [expected[:1], expected[1:3],
+                                    expected[3:5]])
+
+    def test_item_index_with_invalid_cursor(self):
+        user = get_user_model().objects.create_user('staff', password='pw')
+        self.client.force_login(user)
+        response = self.client.get(reverse('items:index'), {
+            'sort': 'revenue',
+            'cursor': raw_cursor(['next', 0, {'id': 1}]),
+        })
+        self.assertEqual(response.status_code, 200)
+
+
+class TestRunnerTests(SimpleTestCase):
+
+    def test_caches_are_process_local(self):
+        # テストが共有キャッシュ（cache/）に書き込まないこと
+        for alias in ('default', 'shared'):
+            self.assertIsInstance(caches[alias], LocMemCache)
+
+
+class RunSectionsTests(SimpleTestCase):
+
+    def test_sections_run_concurrently(self):
+        started = time.monotonic()
+        results = run_sections({
+            'a': lambda: time.sleep(0.2) or 'a',
+            'b': lambda: time.sleep(0.2) or 'b',
+        }, timeout=2)
+        self.assertEqual(results, {'a': 'a', 'b': 'b'})
+        self.assertLess(time.monotonic() - started, 0.35)
+
+    def test_slow_or_failing_section_is_unavailable(self):
+        with self.assertLogs('fruitshopadmin.concurrency', 'WARNING'):
+            results = run_sections({
+                'fast': lambda: 1,
+                'slow': lambda: time.sleep(0.5),
+                'broken': lambda: 1 / 0,
+            }, timeout={'fast': 1, 'slow': 0.1, 'broken': 1})
+        self.assertEqual(results, {
+            'fast': 1, 'slow': UNAVAILABLE, 'broken': UNAVAILABLE})
+
+
+class RequestMetricsTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    @staticmethod
+    def query():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    def test_queries_in_sections_are_recorded(self):
+        # セクションのスレッドで発行したクエリも、リクエストの計測に含める
+        request_metrics = metrics.RequestMetrics()
+        with metrics.recording(request_metrics):
+            self.query()
+            run_sections({str(i): self.query for i in range(3)}, timeout=5)
+        self.assertIsNone(metrics.current())
+        # （セクションのスレッドが接続を開いた場合は、その初期化のクエリも含む）
+        self.assertEqual(request_metrics.shapes['SELECT 1'], 4)
+        self.assertEqual(request_metrics.repeated_queries(4),
+                         [('SELECT 1', 4)])
+
+    @override_settings(REQUEST_METRICS_SAMPLE_RATE=1.0)
+    def test_sampled_request_is_logged(self):
+        user = get_user_model().objects.create_user(
+            'staff', password='pw', is_staff=True)
+        self.client.force_login(user)
+        before = metrics.summary().get('items:index', {}).get('count', 0)
+        with self.assertLogs('fruitshopadmin.requests', 'INFO') as logs:
+            self.client.get(reverse('items:index'))
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['view'], 'items:index')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+        views = self.client.get(reverse('metrics')).json()['views']
+        self.assertEqual(views['items:index']['count'], before + 1)
+
+
+class ProfilingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = get_user_model().objects.create_user(
+            'staff', password='pw', is_staff=True)
+        cls.user = get_user_model().objects.create_user('user', password='pw')
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = override_settings(PROFILING_DIR=directory,
+                                     PROFILING_SAMPLE_INTERVAL=0.001)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_staff_can_request_profile(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('items:index'), {'_profile': '1'})
+        name = response['X-Profile-Name']
+        profile, = profiling.list_profiles()
+        self.assertEqual((profile['name'], profile['view'], profile['status']),
+                         (name, 'items:index', 200))
+        self.assertEqual(profile['kinds'], ['pstats', 'collapsed'])
+        path = profiling.profile_paths(name)[1]
+        self.assertTrue(pstats.Stats(path).total_calls)
+
+        response = self.client.get(
+            reverse('profile_download', args=[name, 'collapsed']))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('profiles'))
+        self.assertContains(response, name)
+
+    def test_other_users_are_only_sampled(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('items:index'), {'_profile': '1'})
+        self.assertNotIn('X-Profile-Name', response)
+        with self.settings(PROFILING_SAMPLED_VIEWS={'items:index': 1}):
+            response = self.client.get(reverse('items:index'))
+        self.assertIn('X-Profile-Name', response)
+
+    def test_sampled_profile_uses_only_stack_sampler(self):
+        self.client.force_login(self.user)
+        with self.settings(PROFILING_SAMPLED_VIEWS={'items:index': 1}):
+            name = self.client.get(reverse('items:index'))['X-Profile-Name']
+        profile, = profiling.list_profiles()
+        self.assertEqual((profile['trigger'], profile['kinds']),
+                         ('sampled', ['collapsed']))
+        pstats_path, collapsed_path = profiling.profile_paths(name)[1:]
+        self.assertFalse(os.path.exists(pstats_path))
+        self.assertTrue(os.path.exists(collapsed_path))
+        self.client.force_login(self.staff)
+        response = self.client.get(
+            reverse('profile_download', args=[name, 'pstats']))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('profiles'))
+        self.assertNotContains(
+            response, reverse('profile_download', args=[name, 'pstats']))
+        self.assertContains(
+            response, reverse('profile_download', args=[name, 'collapsed']))
+
+    @override_settings(PROFILING_MAX_PROFILES=2)
+    def test_retention(self):
+        self.client.force_login(self.staff)
+        names = [self.client.get(reverse('items:index'),
+                                 HTTP_X_PROFILE='1')['X-Profile-Name']
+                 for _ in range(3)]
+        kept = [profile['name'] for profile in profiling.list_profiles()]
+        self.assertEqual(len(kept), 2)
+        self.assertEqual(kept, names[:0:-1])
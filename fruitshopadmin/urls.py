@@ -1,8 +1,13 @@
 from django.contrib import admin
 from django.urls import path, include
+from . import metrics, profiling
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('internal/metrics/', metrics.metrics_view, name='metrics'),
+    path('internal/profiles/', profiling.profiles_view, name='profiles'),
+    path('internal/profiles/<str:name>/<str:kind>/',
+         profiling.profile_download, name='profile_download'),
     path('', include('apps.home.urls')),
     path('items/', include('apps.items.urls')),
     path('sales/', include('apps.sales.urls')),